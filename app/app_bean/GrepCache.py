@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+from bean.BeanManager import Bean
+from collections import OrderedDict
+from config import NodeConfig
+import os
+
+
+GREP_CACHE = "grep_c"
+CACHE_BYTES = getattr(NodeConfig, "GREP_CACHE_BYTES", 64 * 1024 * 1024)
+ENTRY_BYTES = CACHE_BYTES / 8      # 一次查找的结果超过这么多字节就不缓存了，避免一个结果把其他的都挤出去
+CHECK_BYTES = 64                   # 记录缓存位置之前的这么多字节，用于发现文件被截断之后又写入了新的数据
+TAIL_BYTES = 64 * 1024             # 最后一行还没有写完的时候，最多往前这么远找换行符
+
+
+class CacheEntry(object):
+    """
+    一次完整查找的结果，只覆盖到文件中 end 之前的完整的行
+    """
+    def __init__(self, log_path, ino, end, lines, check, records):
+        object.__init__(self)
+        self.log_path = log_path
+        self.ino = ino
+        self.end = end                    # 查找到的位置，总是一行的开头
+        self.lines = lines                # end之前的行数，None表示不知道，这样的结果不能增量的扩展
+        self.check = check                # end之前的几个字节
+        self.records = records            # 匹配的行，(偏移, 行号, 行)
+        self.bytes = sum(len(record[2]) for record in records)
+
+
+#
+# 运行在Node进程上面，缓存最近完整查找过的结果，同一个文件用同样的条件查找的时候可以直接返回，
+# 缓存以 (设备, inode, 查找的内容, 忽略大小写, 按字符串查找) 作为key，按照LRU淘汰，总的字节数不超过CACHE_BYTES
+#
+# 日志一般只会在后面追加，所以文件变大了的话缓存的结果仍然有效，只需要查找后面新增加的那一段，然后合并起来，
+# 文件被切割（inode变了）或者被截断（变小了，或者缓存位置之前的数据变了）之后，缓存直接作废
+#
+class GrepCache(Bean):
+    def __init__(self, max_bytes=CACHE_BYTES):
+        Bean.__init__(self, GREP_CACHE)
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()           # key与CacheEntry的关联，按照最近使用的顺序排列
+        self._bytes = 0
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.bytes
+        return entry
+
+    def get(self, log_path, pattern_key):
+        """
+        查找文件当前的缓存，文件已经被截断了的话，缓存会被删除
+        :param pattern_key:  (查找的内容, 忽略大小写, 按字符串查找)
+        :return:             CacheEntry，没有的话返回None
+        """
+        try:
+            with open(log_path, "rb") as f:
+                st = os.fstat(f.fileno())
+                key = (st.st_dev, st.st_ino) + pattern_key
+                entry = self._entries.get(key)
+                if entry is None:
+                    return None
+                f.seek(entry.end - len(entry.check))
+                check = f.read(len(entry.check))
+        except (IOError, OSError):
+            return None
+        if st.st_size < entry.end or check != entry.check or (entry.lines is None and st.st_size != entry.end):
+            self._remove(key)
+            return None
+        self._entries[key] = self._entries.pop(key)                 # 移到最后，表示最近使用过
+        return entry
+
+    def put(self, log_path, pattern_key, ino, end, lines, records):
+        """
+        保存一次完整查找的结果，文件最后没有写完的那一行以及它的结果不会被缓存
+        :param ino:      查找开始的时候文件的inode，文件已经被切割了的话就不缓存了
+        :param end:      查找到的位置
+        :param lines:    end之前的行数，None表示不知道
+        :param records:  按偏移排好序的所有匹配的行
+        """
+        with open(log_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != ino or st.st_size < end:
+                return
+            start = max(0, end - TAIL_BYTES)
+            f.seek(start)
+            data = f.read(end - start)
+        index = data.rfind("\n")
+        if index < 0:
+            return                                                  # 最后一行太长了，不缓存
+        end = start + index + 1
+        while records and records[-1][0] >= end:
+            records = records[:-1]
+        entry = CacheEntry(log_path, ino, end, lines, data[max(0, index + 1 - CHECK_BYTES):index + 1], records)
+        if entry.bytes > min(ENTRY_BYTES, self._max_bytes):
+            return
+        key = (st.st_dev, ino) + pattern_key
+        self._remove(key)
+        for old_key, old in self._entries.items():
+            if old.log_path == log_path and old.ino != ino:
+                self._remove(old_key)                               # 文件已经被切割了，以前的结果没有用了
+        self._entries[key] = entry
+        self._bytes += entry.bytes
+        while self._bytes > self._max_bytes:
+            self._remove(next(iter(self._entries)))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+from bean.BeanManager import Bean
+from config import NodeConfig
+from gevent.event import Event
+import logging
+
+
+GREP_MANAGER = "grep_m"
+MAX_RUNNING = getattr(NodeConfig, "GREP_MAX_RUNNING", 2)     # 同时最多执行这么多个查找，其他的排队等待
+MAX_QUEUED = getattr(NodeConfig, "GREP_MAX_QUEUED", 16)      # 最多这么多个查找排队，再多的话直接拒绝
+
+
+#
+# 运行在Node进程上面，管理正在执行的查找，同一个文件用同样的条件同时查找的时候（例如告警之后好几个人同时在查），
+# 只会执行一次，所有的LogGrep都共享它，每一个LogGrep通过自己的游标来获取结果，最后一个人离开之后查找才会被停止
+#
+# 已经结束了的查找不会再被共享，之后同样的查找会重新创建，不过可以用上GrepCache里面的结果
+#
+# 另外这里还控制同时执行的查找的数量，避免几个很重的查找把机器的cpu和磁盘都占满了，影响机器上正在运行的服务，
+# 超过MAX_RUNNING之后新的查找按顺序排队，排队的位置通过Grep的状态返回给远端，排队的也太多了的话直接拒绝
+#
+class GrepManager(Bean):
+    def __init__(self, max_running=MAX_RUNNING, max_queued=MAX_QUEUED):
+        Bean.__init__(self, GREP_MANAGER)
+        self._greps = dict()                # 查找的条件与正在执行的Grep的关联
+        self._max_running = max_running
+        self._max_queued = max_queued
+        self._running = set()               # 正在执行的Grep
+        self._waiting = []                  # 排队等待执行的Grep，按照排队的顺序
+        self._events = dict()               # 排队的Grep与用于唤醒它的Event的关联
+
+    @staticmethod
+    def _key(log_path, content, options):
+        return log_path, repr(content), repr(sorted((options or {}).items()))
+
+    def subscribe(self, log_path, content, options, create):
+        """
+        订阅一个查找，如果同样条件的查找正在执行，那么直接共享它，否则通过create创建一个新的
+        :param log_path:  需要查找的文件
+        :param content:   需要查找的内容
+        :param options:   查找的选项
+        :param create:    没有可以共享的查找的时候，调用这个函数来创建一个Grep
+        :return:          Grep，排队的查找太多了的话抛出异常
+        """
+        key = self._key(log_path, content, options)
+        grep = self._greps.get(key)
+        if grep is None or grep.over:
+            # 还没有开始执行的查找，包括刚创建的还没有来得及进入队列的
+            waiting = sum(1 for value in self._greps.values() if not value.over and value not in self._running)
+            if waiting >= self._max_running - len(self._running) + self._max_queued:
+                raise IOError("too many greps queued: %d" % waiting)
+            grep = create()
+            self._greps[key] = grep
+        else:
+            logging.info("grep shared, path:%s, subscribers:%d", log_path, grep.subscribers + 1)
+        grep.add_subscriber()
+        return grep
+
+    def unsubscribe(self, grep):
+        """
+        取消订阅，如果已经没有订阅者了，那么停止这个查找
+        """
+        if grep.remove_subscriber() <= 0:
+            grep.stop()
+            for key, value in self._greps.items():
+                if value is grep:
+                    del self._greps[key]
+
+    def admit(self, grep):
+        """
+        在Grep的协程里面调用，同时执行的查找没有超过上限的话直接返回，否则排队等待，直到轮到它了
+        """
+        if len(self._running) < self._max_running and not self._waiting:
+            self._running.add(grep)
+            return
+        event = Event()
+        self._waiting.append(grep)
+        self._events[grep] = event
+        logging.info("grep queued, position:%d", len(self._waiting))
+        event.wait()
+
+    def release(self, grep):
+        """
+        查找结束或者被停止了（包括还在排队的时候），让出位置给排队的查找
+        """
+        self._running.discard(grep)
+        if grep in self._events:
+            self._waiting.remove(grep)
+            del self._events[grep]
+        while self._waiting and len(self._running) < self._max_running:
+            grep = self._waiting.pop(0)
+            self._running.add(grep)
+            self._events.pop(grep).set()
+
+    def position(self, grep):
+        """
+        :return:  查找在队列中的位置，从1开始，已经在执行了的话返回0
+        """
+        return self._waiting.index(grep) + 1 if grep in self._events else 0
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+from bean.BeanManager import Bean
+from app_lib.LogIndex import LogIndex, TimeParser, to_timestamp, search_time, DEFAULT_TIME_REGEX, DEFAULT_TIME_FORMAT
+from app_lib.SegmentIndex import SegmentIndex, list_segments, segment_key, build_index_in_child
+from app_lib.GrepEngine import is_compressed
+from lib.LetPool import run_task
+from config import NodeConfig
+import gevent
+import os
+import logging
+import traceback
+
+
+INDEX_MANAGER = "index_m"
+UPDATE_INTERVAL = 5               # 每隔这么多秒更新一次所有日志的索引
+SEGMENT_TICKS = 12                # 每更新这么多次检查一次是否有新切割出来的文件需要建立三元组索引，还有没建立完的话每次都建立一个
+INDEX_DIR = getattr(NodeConfig, "INDEX_DIR", "index")
+
+
+#
+# 运行在Node进程上面，为配置的每一个日志文件维护一个LogIndex，定期的处理文件新增加的数据，
+# 这样子按时间或者行号定位的时候就不需要扫描整个文件了
+#
+# 另外日志切割出来的文件是不会再变化的，这里在后台为它们建立三元组索引，保存在INDEX_DIR下面，
+# 查找这些文件的时候可以跳过不可能匹配的块，压缩过的文件在解压的过程中建立索引，整个文件都不可能匹配的话直接跳过，
+# 建立索引在单独的协程里面执行，每次只建立一个文件的，刚启动或者切割出来了很多文件的时候也不会让日志的索引停止更新
+#
+class IndexManager(Bean):
+    def __init__(self, log_infos):
+        """
+        :param log_infos:  需要监控的日志，名字到配置的字典，配置可以直接是日志的路径，
+                           也可以是 {"path": 路径, "time_regex": 时间的正则, "time_format": 时间的格式}
+        """
+        Bean.__init__(self, INDEX_MANAGER)
+        self._indexes = dict()                  # 日志名字与LogIndex的关联
+        for log_name, info in log_infos.items():
+            if isinstance(info, dict):
+                parser = TimeParser(info.get("time_regex", DEFAULT_TIME_REGEX),
+                                    info.get("time_format", DEFAULT_TIME_FORMAT))
+                self._indexes[log_name] = LogIndex(info["path"], parser)
+            else:
+                self._indexes[log_name] = LogIndex(info)
+        self._segments = dict()                 # 切割出来的文件的标识与SegmentIndex的关联
+        self._ticks = 0
+        self._updating = False                  # 是否正在更新日志的索引
+        self._building = False                  # 是否正在为切割出来的文件建立索引
+        self._pending = False                   # 上一次检查的时候是否还有切割出来的文件没有建立索引
+        self._failed = set()                    # 建立索引失败了的文件，定期检查的时候才会重试，不会每次都卡在它们上面
+        self._timer = gevent.get_hub().loop.timer(0, UPDATE_INTERVAL)
+        self._timer.start(self._on_timer)
+
+    def get_index(self, log_name):
+        """
+        :return:  日志对应的LogIndex，没有的话返回None
+        """
+        return self._indexes.get(log_name)
+
+    def get_segments(self, log_name):
+        """
+        :return:  日志切割出来的文件，[(文件名, 大小, 是否已经建立了索引)]，从新到老排序
+        """
+        index = self._indexes.get(log_name)
+        if index is None:
+            return []
+        out = []
+        for name, path in list_segments(index.log_path):
+            try:
+                key = segment_key(path)
+            except OSError:
+                continue
+            out.append((name, os.path.getsize(path), key in self._segments))
+        return out
+
+    def resolve_segment(self, log_name, name):
+        """
+        找到日志切割出来的某一个文件
+        :return:  (路径, SegmentIndex)，还没有建立索引的话SegmentIndex为None，文件不存在的话抛出异常
+        """
+        index = self._indexes[log_name]
+        for segment_name, path in list_segments(index.log_path):
+            if segment_name == name:
+                try:
+                    return path, self._segments.get(segment_key(path))
+                except OSError:
+                    break
+        raise IOError("segment not exist: %s" % name)
+
+    def prepare_options(self, log_name, options, segment_path=None):
+        """
+        将grep选项里面的时间窗口以及偏移转换为文件中的范围：
+        （1）since/until:  只查找 [since, until) 这个时间窗口里面的行，通过索引加上二分查找定位到文件中的范围
+        （2）offset:       从offset所在的那一行的开头开始，这样子返回的行号就是文件中真实的行号
+        （3）reverse:      从后往前查找的时候，固定下来查找的结束位置，然后通过索引计算出end_line，也就是end那一行的行号
+        查找的是切割出来的文件的时候，没有行和时间的索引，直接在文件上二分查找时间
+        :return:  新的选项，offset/end为文件中的范围，line_no为offset那一行的行号
+        """
+        index = self._indexes.get(log_name)
+        if not options or index is None:
+            return options
+        options = dict(options)
+        since, until = options.pop("since", None), options.pop("until", None)
+        if segment_path is not None:
+            if since is not None:
+                options["offset"] = search_time(segment_path, index.parser, to_timestamp(since))
+            if until is not None:
+                options["end"] = search_time(segment_path, index.parser, to_timestamp(until))
+            return options
+        if since is not None:
+            options["offset"], options["line_no"] = index.locate_time(to_timestamp(since))
+        elif options.get("offset") and options["offset"] < index.offset:
+            options["offset"], options["line_no"] = index.locate_line(index.line_at(options["offset"]))
+        if until is not None:
+            options["end"] = index.locate_time(to_timestamp(until))[0]
+        if options.get("reverse"):
+            if options.get("end") is None:
+                options["end"] = os.path.getsize(index.log_path)
+            options["end_line"] = index.count_lines(options["end"]) + 1
+        if options.get("line_no") is None:
+            options.pop("line_no", None)
+        return options
+
+    def prepare_sources(self, log_name, options):
+        """
+        查找日志切割出来的所有文件（包括压缩过的）以及当前的日志，或者只查找某一个压缩过的文件的时候，
+        为每一个文件准备好查找的范围，时间窗口对于没有压缩的文件转换为文件中的范围，压缩过的文件在解压的时候再过滤
+        :param options:  查找的选项，segment为 * 表示所有的文件，否则为某一个压缩过的文件
+        :return:         按时间从老到新排序的文件，格式参考HistoryScanner
+        """
+        index = self._indexes[log_name]
+        segment = options["segment"]
+        since, until = options.get("since"), options.get("until")
+        since = to_timestamp(since) if since is not None else None
+        until = to_timestamp(until) if until is not None else None
+        files = list(reversed(list_segments(index.log_path)))
+        if segment == "*":
+            files.append((os.path.basename(index.log_path), index.log_path))
+        else:
+            files = [(name, path) for name, path in files if name == segment]
+            if not files:
+                raise IOError("segment not exist: %s" % segment)
+        sources = []
+        for name, path in files:
+            source = dict(name=name, path=path)
+            try:
+                source["index"] = self._segments.get(segment_key(path))
+            except OSError:
+                continue                                # 刚好被删除了
+            if is_compressed(path):
+                source.update(parser=index.parser, since=since, until=until)
+            else:
+                if since is not None:
+                    source["start"] = search_time(path, index.parser, since)
+                if until is not None:
+                    source["end"] = search_time(path, index.parser, until)
+                if source.get("end") is not None and source.get("start", 0) >= source["end"]:
+                    continue                            # 整个文件都不在时间窗口里面
+            sources.append(source)
+        return sources
+
+    def _on_timer(self):
+        """
+        定时器的回调是在主协程里面执行的，这里启动协程来更新，上一次还没有完成的话就跳过，
+        日志的索引和切割出来的文件的索引分别在两个协程里面，互相不影响
+        """
+        if not self._updating:
+            self._updating = True
+            run_task(self._update_all)
+        if not self._building and (self._pending or self._ticks % SEGMENT_TICKS == 0):
+            self._building = True
+            run_task(self._build_segments)
+        self._ticks += 1
+
+    def _update_all(self):
+        try:
+            for index in self._indexes.values():
+                try:
+                    index.update()
+                except:
+                    logging.error("更新日志索引异常: %s", index.log_path)
+                    logging.error(traceback.format_exc())
+        finally:
+            self._updating = False
+
+    def _build_segments(self):
+        try:
+            if not self._pending:
+                self._failed.clear()
+            self._pending = self._update_segments()
+        except:
+            logging.error("更新切割文件的索引异常")
+            logging.error(traceback.format_exc())
+        finally:
+            self._building = False
+
+    def _update_segments(self):
+        """
+        为还没有索引的切割出来的文件建立三元组索引，每次最多建立一个，剩下的留到下一次，已经存在的索引文件直接加载，
+        那些对应的文件已经被删除了的索引文件也一起删除
+        :return:  是否还有文件没有建立索引
+        """
+        alive = set()
+        built, remaining = False, False
+        for log_name, index in self._indexes.items():
+            index_dir = os.path.join(INDEX_DIR, log_name)
+            for name, path in list_segments(index.log_path):
+                try:
+                    key = segment_key(path)
+                except OSError:
+                    continue
+                alive.add(key)
+                if key in self._segments or key in self._failed:
+                    continue
+                index_path = os.path.join(index_dir, key + ".tri")
+                try:
+                    if not os.path.exists(index_path):
+                        if built:
+                            remaining = True            # 这一次已经建立过一个了，留到下一次
+                            continue
+                        built = True
+                        if not os.path.isdir(index_dir):
+                            os.makedirs(index_dir)
+                        if not build_index_in_child(path, index_path):
+                            logging.error("建立切割文件的索引失败: %s", path)
+                            self._failed.add(key)
+                            continue
+                        logging.info("SegmentIndex build, path:%s", path)
+                    self._segments[key] = SegmentIndex(index_path)
+                except:
+                    logging.error("建立切割文件的索引异常: %s", path)
+                    logging.error(traceback.format_exc())
+                    self._failed.add(key)
+            if os.path.isdir(index_dir):
+                for file_name in os.listdir(index_dir):
+                    if file_name.endswith(".tri") and file_name[:-4] not in alive:
+                        os.remove(os.path.join(index_dir, file_name))
+        for key in self._segments.keys():
+            if key not in alive:
+                del self._segments[key]
+        return remaining
@@ -0,0 +1,597 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+from bean.BeanManager import Bean
+from bean.Entity import get_gem, MethodNotExist
+from app_entity.LogCenter import LOG_CENTER_NAME
+from app_entity.TailReceiver import TailReceiver
+from app_bean.TailManager import KEEP_TIME as SOURCE_KEEP_TIME
+from lib.LetPool import run_task
+from config import ServerConfig
+from gevent.lock import Semaphore
+from gevent.event import Event
+from collections import deque
+import gevent
+import struct
+import time
+import json
+import logging
+
+
+TAIL_HUB = "tail_h"
+MAX_BYTES = 256 * 1024    # 每次从远端sender获取数据的最大字节数
+PUSH_CREDIT = 4           # 推送模式下，允许远端sender已经推送过来但是还没有处理完的批数
+DEFAULT_SLEEP_TIME = 0.2
+FRAME_BYTES = 64 * 1024   # 攒够了这么多字节的行就马上发送一帧
+FRAME_DELAY = 0.05        # 没有攒够的话，第一行到了之后最多等待这么多秒就发送
+BINARY_MESSAGES = 1       # 紧凑格式的帧的类型
+BINARY_HEADER = struct.Struct("!Bd")      # 紧凑格式的帧头：类型，这些行的结束位置
+LINE_HEADER = struct.Struct("!I")         # 紧凑格式里面每一行前面的长度
+
+MODE_FULL = "full"                        # viewer跟得上，发送所有的行
+MODE_SAMPLE = "sample"                    # viewer跟不上，每SAMPLE_RATE行只发送一行
+MODE_SUMMARY = "summary"                  # 采样了还是跟不上，每秒只发送一次行数的统计以及最后的几行
+SLOW_QUEUE_BYTES = getattr(ServerConfig, "TAIL_SLOW_QUEUE_BYTES", 1024 * 1024)   # 排队的数据超过这么多字节就降级
+SLOW_LATENCY = getattr(ServerConfig, "TAIL_SLOW_LATENCY", 1.0)                   # 发送一帧超过这么多秒就降级
+MAX_QUEUE_BYTES = getattr(ServerConfig, "TAIL_MAX_QUEUE_BYTES", 8 * 1024 * 1024)  # 降级了之后排队的数据还超过这么多的话断开
+SAMPLE_RATE = getattr(ServerConfig, "TAIL_SAMPLE_RATE", 10)
+SUMMARY_LINES = 20                        # 统计里面带上最后的这么多行
+SUMMARY_INTERVAL = 1
+MODE_HOLD = 3                             # 切换了模式之后，至少保持这么多秒才会继续降级
+RECOVER_SECONDS = 10                      # 一直跟得上这么多秒之后升级一次
+
+REPLAY_LINES = getattr(ServerConfig, "TAIL_REPLAY_LINES", 100)      # 每一个数据流保留最近的这么多行，新的viewer马上就能看到
+REPLAY_BYTES = 256 * 1024                                          # 最近的行最多保留这么多字节
+# 数据流释放之后，最近的行还保留这么多秒，重新创建数据流的时候从保留下来的位置订阅，这个位置的数据需要还在node的TailSource里面，
+# 所以不能超过node上面最后一个订阅者离开之后TailSource保留的时间，再留一点余量给rpc的延迟
+REPLAY_KEEP = min(getattr(ServerConfig, "TAIL_REPLAY_KEEP", 45), SOURCE_KEEP_TIME - 15)
+
+
+class Frame(object):
+    """
+    一帧发送给web端的数据，每一种编码方式都只在第一次用到的时候编码一次，之后所有的viewer直接发送编码好的数据：
+    （1）text：   {"method": 方法, "data": 数据, "offset": 位置} 的json，数据只编码一次
+    （2）binary： 只有messages有，帧头之后每一行为 长度 + 行的原始字节，web端不需要解析json，也没有转义的开销，
+                 格式参考BINARY_HEADER以及LINE_HEADER
+    """
+    def __init__(self, method, data, offset):
+        object.__init__(self)
+        self._method = method
+        self._data = data
+        self._offset = offset
+        self._text = None
+        self._binary = None
+        self._size = None
+
+    @property
+    def method(self):
+        return self._method
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @property
+    def size(self):
+        """
+        :return:  行的字节数，只有messages有，用于统计viewer排队的数据量
+        """
+        if self._size is None:
+            self._size = sum(len(line) for line in self._data) if self._method == "messages" else 0
+        return self._size
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = json.dumps(dict(method=self._method, data=self._data, offset=self._offset))
+        return self._text
+
+    @property
+    def binary(self):
+        """
+        :return:  紧凑格式的数据，这一帧没有紧凑格式的话返回None
+        """
+        if self._binary is None and self._method == "messages":
+            chunks = [BINARY_HEADER.pack(BINARY_MESSAGES, self._offset)]
+            for line in self._data:
+                chunks.append(LINE_HEADER.pack(len(line)))
+                chunks.append(line)
+            self._binary = "".join(chunks)
+        return self._binary
+
+
+class FrameQueue(object):
+    """
+    一个viewer的发送队列，TailFeed的广播只是把帧放到队列里面，由单独的协程发送，记录排队的字节数以及发送的耗时，
+    浏览器跟不上日志的速度的时候（排队的数据超过SLOW_QUEUE_BYTES，或者发送一帧超过SLOW_LATENCY秒）逐级降级：
+    （1）sample：   丢掉还在排队的行，之后每SAMPLE_RATE行只发送一行
+    （2）summary：  还是跟不上的话，每秒只发送一次这一秒的行数、字节数以及最后的SUMMARY_LINES行
+    每次切换模式都在数据流里面发送一个mode帧告诉web端，队列一直是空的RECOVER_SECONDS秒之后逐级恢复，
+    降级了排队的数据还是超过MAX_QUEUE_BYTES的话直接断开，web端会带着位置重连
+
+    这样子一个很慢的浏览器占用的内存是有上限的，也不会影响其他的viewer
+    """
+    MODES = (MODE_FULL, MODE_SAMPLE, MODE_SUMMARY)
+
+    def __init__(self, send, overflow):
+        """
+        :param send:      发送一帧的方法，会阻塞到发送完成
+        :param overflow:  排队的数据太多的时候调用，一般是断开连接
+        """
+        object.__init__(self)
+        self._send = send
+        self._overflow = overflow
+        self._frames = deque()
+        self._bytes = 0                   # 排队的行的字节数
+        self._event = Event()
+        self._mode = MODE_FULL
+        self._changed = 0                 # 上一次切换模式的时间
+        self._healthy_since = None        # 从什么时候开始一直跟得上
+        self._latency = 0                 # 上一帧的发送耗时
+        self._sending_since = None        # 正在发送的帧开始发送的时间
+        self._offset = None
+        self._sampled = 0                 # 采样模式下已经处理的行数
+        self._summary = None              # 统计模式下这一秒的 [行数, 字节数, 最后的几行]
+        self._summary_let = None
+        self._closed = False
+        self._let = gevent.spawn(self._run)
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def depth(self):
+        """
+        :return:  (排队的帧数, 排队的行的字节数)
+        """
+        return len(self._frames), self._bytes
+
+    @property
+    def latency(self):
+        """
+        :return:  发送的耗时，正在发送的帧已经等了更久的话返回它等待的时间
+        """
+        if self._sending_since is not None:
+            return max(self._latency, time.time() - self._sending_since)
+        return self._latency
+
+    def put(self, frame):
+        if self._closed:
+            return
+        self._offset = frame.offset
+        if frame.method == "messages":
+            self._check()
+            if self._mode == MODE_SAMPLE:
+                frame = self._sample(frame)
+            elif self._mode == MODE_SUMMARY:
+                self._summarize(frame)
+                frame = None
+        if frame is not None:
+            self._push(frame)
+
+    def _push(self, frame):
+        self._frames.append(frame)
+        self._bytes += frame.size
+        self._event.set()
+        if self._bytes > MAX_QUEUE_BYTES:
+            logging.error("tail viewer too slow, queued bytes:%d", self._bytes)
+            self.close()
+            self._overflow()
+
+    def _check(self):
+        """
+        根据排队的数据量以及发送的耗时决定是否需要降级或者恢复
+        """
+        now = time.time()
+        latency = self.latency
+        if self._bytes > SLOW_QUEUE_BYTES or latency > SLOW_LATENCY:
+            self._healthy_since = None
+            if self._mode != MODE_SUMMARY and now - self._changed >= MODE_HOLD:
+                self._switch(self.MODES[self.MODES.index(self._mode) + 1], now)
+        elif len(self._frames) > 1 or latency > SLOW_LATENCY / 2:
+            self._healthy_since = None              # 还没有到降级的程度，不过也没有完全跟上，不恢复，避免来回切换
+        elif self._healthy_since is None:
+            self._healthy_since = now
+        elif self._mode != MODE_FULL and now - self._healthy_since >= RECOVER_SECONDS:
+            self._healthy_since = now
+            self._switch(self.MODES[self.MODES.index(self._mode) - 1], now)
+
+    def _switch(self, mode, now):
+        """
+        切换模式，降级的时候丢掉还在排队的行，然后在数据流里面通知web端
+        """
+        dropped = 0
+        if self.MODES.index(mode) > self.MODES.index(self._mode):
+            kept = deque()
+            for frame in self._frames:
+                if frame.method == "messages":
+                    dropped += len(frame.data)
+                else:
+                    kept.append(frame)
+            self._frames = kept
+            self._bytes = 0
+        if self._mode == MODE_SUMMARY:
+            self._flush_summary()
+            self._summary_let = None                # 统计的协程发现自己不是_summary_let之后就退出
+        self._mode = mode
+        self._changed = now
+        self._sampled = 0
+        if mode == MODE_SUMMARY:
+            self._summary = [0, 0, deque(maxlen=SUMMARY_LINES)]
+            self._summary_let = gevent.spawn(self._run_summary)
+        logging.info("tail viewer mode:%s, dropped lines:%d", mode, dropped)
+        info = dict(mode=mode, dropped=dropped)
+        if mode == MODE_SAMPLE:
+            info["rate"] = SAMPLE_RATE
+        self._push(Frame("mode", info, self._offset))
+
+    def _sample(self, frame):
+        lines = frame.data
+        start = (SAMPLE_RATE - self._sampled % SAMPLE_RATE) % SAMPLE_RATE
+        self._sampled += len(lines)
+        lines = lines[start::SAMPLE_RATE]
+        return Frame("messages", lines, frame.offset) if lines else None
+
+    def _summarize(self, frame):
+        self._summary[0] += len(frame.data)
+        self._summary[1] += frame.size
+        self._summary[2].extend(frame.data)
+
+    def _flush_summary(self):
+        count, size, last = self._summary
+        if count:
+            self._push(Frame("summary", dict(lines=count, bytes=size, last=list(last)), self._offset))
+            self._summary = [0, 0, deque(maxlen=SUMMARY_LINES)]
+
+    def _run_summary(self):
+        current = gevent.getcurrent()
+        while not self._closed and self._summary_let is current:
+            gevent.sleep(SUMMARY_INTERVAL)
+            if self._summary_let is current:
+                self._flush_summary()
+                self._check()
+
+    def _run(self):
+        """
+        按顺序发送排队的帧，记录每一帧的发送耗时，发送失败的话send自己负责关闭连接
+        """
+        while not self._closed:
+            if not self._frames:
+                self._event.clear()
+                self._event.wait()
+                continue
+            frame = self._frames.popleft()
+            self._bytes -= frame.size
+            self._sending_since = time.time()
+            try:
+                self._send(frame)
+            finally:
+                self._latency = time.time() - self._sending_since
+                self._sending_since = None
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._frames.clear()
+        self._bytes = 0
+        for let in (self._let, self._summary_let):
+            if let is not None and let is not gevent.getcurrent():
+                let.kill(block=False)
+        self._summary_let = None
+
+
+class TailFeed(object):
+    """
+    一个 (节点, 日志) 在当前进程里面唯一的上游数据流，所有在看这个日志的websocket共享它：
+    只在远端node上面创建一个LogSender，只有一个协程在接收数据，每一批数据只编码一次，
+    然后把编码好的同一个帧发送给每一个websocket
+
+    远端推送过来的数据往往是一行一批，这里把它们攒起来，够FRAME_BYTES或者过了FRAME_DELAY之后再合并成一帧发送，
+    日志写得很快的时候帧的数量以及编码的次数都会少很多
+
+    另外保留最近发送过的REPLAY_LINES行，新加入的viewer马上就能看到它们，不用等到日志有新的数据，
+    数据流刚创建的时候通过远端sender的get_tail获取一次最后的几行
+
+    每一个viewer需要有 send_frame(Frame) 以及 close() 这两个方法，参考LogViewWorker里面的LogWebSocket，
+    send_frame不能阻塞，否则一个很慢的viewer会拖慢所有的viewer，慢的viewer通过FrameQueue排队以及降级
+    """
+    def __init__(self, hub, node_name, log_name):
+        object.__init__(self)
+        self._hub = hub
+        self._node_name = node_name
+        self._log_name = log_name
+        self._viewers = set()
+        self._send_stub = None             # 远端node上面的LogSender的stub
+        self._receiver = None              # 推送模式下，接收远端sender推送的数据的entity
+        self._upstream = None              # 推送模式下，与远端node的连接
+        self._offset = None                # 已经收到的数据在日志数据流中的位置
+        self._closed = False
+        self._pending = []                 # 已经收到，还没有发送出去的行
+        self._pending_bytes = 0
+        self._flush_let = None             # 用于在FRAME_DELAY之后发送攒起来的行的协程
+        self._send_lock = Semaphore()      # 保证发送给viewer的帧的顺序
+        self._recent = deque()             # 最近发送过的行
+        self._recent_bytes = 0
+        self._recent_end = None            # 最近的这些行在日志数据流中的结束位置
+
+    @property
+    def key(self):
+        return self._node_name, self._log_name
+
+    @property
+    def viewers(self):
+        return self._viewers
+
+    @property
+    def recent(self):
+        """
+        :return:  (最近发送过的行, 这些行的结束位置)
+        """
+        return list(self._recent), self._recent_end
+
+    def seed(self, lines, offset):
+        """
+        用之前的数据流保留下来的最近的行初始化，之后应该从offset开始start
+        """
+        self._remember(lines, offset)
+
+    def replay(self, viewer, since=None):
+        """
+        把最近的行马上发送给刚加入的viewer，还没有发送出去的行之后会和其他的viewer一起收到
+        :param since:  viewer断线重连的时候带上来的位置，只发送这个位置之后的行，
+                       比保留的最老的行还要老的话先告诉viewer跳过了多少字节
+        """
+        if not self._recent:
+            return
+        lines = list(self._recent)
+        if since is not None:
+            position = self._recent_end - self._recent_bytes
+            if since < position:
+                viewer.send_frame(Frame("gap", position - since, position))
+            else:
+                skip = 0
+                while skip < len(lines) and position < since:
+                    position += len(lines[skip])
+                    skip += 1
+                lines = lines[skip:]
+        if lines:
+            viewer.send_frame(Frame("messages", lines, self._recent_end))
+
+    def _remember(self, lines, offset):
+        self._recent.extend(lines)
+        self._recent_bytes += sum(len(line) for line in lines)
+        self._recent_end = offset
+        while len(self._recent) > REPLAY_LINES or (self._recent_bytes > REPLAY_BYTES and len(self._recent) > 1):
+            self._recent_bytes -= len(self._recent.popleft())
+
+    def _forget(self):
+        self._recent.clear()
+        self._recent_bytes = 0
+
+    def start(self, offset=None):
+        """
+        通过center在远端node上面创建LogSender，然后开始接收数据，优先使用推送模式，
+        远端的node还不支持推送模式的话，退回到不断调用get_data的方式
+
+        没有指定位置的话，先通过sender获取一次日志最后的几行发送给viewer，然后从这些行之后开始接收
+        :param offset:  从哪个位置开始，一般是第一个viewer断线重连的时候带上来的，或者之前的数据流保留下来的位置
+        """
+        self._offset = offset
+        center_stub = get_gem().get_remote_entity(LOG_CENTER_NAME)
+        address, entity_id = center_stub.get_remote_info(self._node_name, self._log_name)
+        self._send_stub = get_gem().create_remote_stub(entity_id, {"ip": address[0], "port": address[1]})
+        if offset is None:
+            self._warm()
+        receiver = TailReceiver()
+        with get_gem().process_manager.get_process_client(self._send_stub.address_str) as client:
+            client.add_disconnect_listener(receiver.close)      # 先注册，订阅的过程中断线的话receiver也会被关闭
+        try:
+            if client.is_closed:
+                raise IOError("connection to node closed: %s" % self._send_stub.address_str)
+            self._send_stub.subscribe(receiver.id, self._offset, PUSH_CREDIT)
+        except MethodNotExist:
+            client.remove_disconnect_listener(receiver.close)
+            receiver.close()
+            run_task(self._run_get)
+            return
+        except:
+            client.remove_disconnect_listener(receiver.close)
+            receiver.close()
+            raise
+        self._receiver = receiver
+        self._upstream = client
+        run_task(self._run_push)
+
+    def _warm(self):
+        """
+        从远端获取日志最后的几行，马上发送给已经在等待的viewer
+        """
+        try:
+            lines, offset = self._send_stub.get_tail(REPLAY_LINES, REPLAY_BYTES)
+        except MethodNotExist:
+            return                                      # 老版本的node，与原来一样由远端从最后的几行开始推送
+        if offset is not None:
+            self._dispatch(lines, offset, 0)
+            self._flush()
+
+    def _dispatch(self, lines, offset, gap):
+        """
+        处理远端来的一批数据，跳过了数据的话先把攒起来的行发送出去，然后马上通知viewer，
+        行先攒起来，够了FRAME_BYTES马上发送，否则等待FRAME_DELAY
+        """
+        self._offset = offset
+        if gap:
+            self._flush()
+            self._forget()                              # 跳过了数据，最近的行已经不连续了
+            self._broadcast(Frame("gap", gap, offset))
+        if lines:
+            self._pending.extend(lines)
+            self._pending_bytes += sum(len(line) for line in lines)
+            if self._pending_bytes >= FRAME_BYTES:
+                self._flush()
+            elif self._flush_let is None:
+                self._flush_let = gevent.spawn_later(FRAME_DELAY, self._flush)
+
+    def _flush(self):
+        """
+        将攒起来的行合并成一帧发送给所有的viewer
+        """
+        let, self._flush_let = self._flush_let, None
+        if let is not None and let is not gevent.getcurrent():
+            let.kill(block=False)
+        if not self._pending:
+            return
+        frame = Frame("messages", self._pending, self._offset)
+        self._pending, self._pending_bytes = [], 0
+        self._remember(frame.data, frame.offset)
+        self._broadcast(frame)
+
+    def _broadcast(self, frame):
+        with self._send_lock:
+            for viewer in list(self._viewers):
+                viewer.send_frame(frame)
+
+    def _run_push(self):
+        """
+        推送模式下按顺序处理远端推送过来的数据，每处理完一批就归还一个额度给远端
+        """
+        try:
+            while not self._closed:
+                item = self._receiver.get()
+                if item is None:
+                    break
+                self._dispatch(*item)
+                self._send_stub.ack(1)
+        except:
+            logging.error("tail feed push error, node:%s, log:%s", self._node_name, self._log_name)
+        finally:
+            self._fail()
+
+    def _run_get(self):
+        """
+        不断的从远端获取日志最新的数据，每次都带上已经获取到的位置，这样子即使中途重新创建了sender也不会丢数据，
+        没有数据的时候等待的时间逐渐变长，最多一秒
+        """
+        sleep_time = DEFAULT_SLEEP_TIME
+        try:
+            while not self._closed:
+                log_data, offset, gap = self._send_stub.get_data(self._offset, MAX_BYTES)
+                self._dispatch(log_data, offset, gap)
+                if log_data:
+                    sleep_time = DEFAULT_SLEEP_TIME
+                else:
+                    gevent.sleep(sleep_time)
+                    sleep_time = min(1, sleep_time + 0.1)
+        except:
+            logging.error("tail feed get error, node:%s, log:%s", self._node_name, self._log_name)
+        finally:
+            self._fail()
+
+    def _fail(self):
+        """
+        与远端的数据流断开了，关闭所有的viewer，web端会带着已经获取到的位置重连，那时候会重新创建一个数据流
+        """
+        if self._closed:
+            return
+        self._hub.remove(self)
+        for viewer in list(self._viewers):
+            viewer.close()
+        self.close()
+
+    def close(self):
+        """
+        释放远端的sender以及当前进程里面的receiver
+        """
+        self._closed = True
+        self._viewers.clear()
+        if self._flush_let is not None:
+            self._flush_let.kill(block=False)
+            self._flush_let = None
+        self._pending = []
+        if self._receiver is not None:
+            if self._upstream is not None:
+                self._upstream.remove_disconnect_listener(self._receiver.close)
+                self._upstream = None
+            self._receiver.close()
+            self._receiver = None
+        if self._send_stub is not None:
+            try:
+                self._send_stub.close()
+            except:
+                pass
+            self._send_stub = None
+
+
+#
+# 运行在LogView进程上面，每一个 (节点, 日志) 只保持一个上游的数据流，所有在看同一个日志的websocket都挂在上面，
+# 十个人同时看一个日志，远端node上面也只有一个LogSender，当前进程也只需要编码一次
+#
+# 第一个viewer进来的时候创建数据流，最后一个viewer离开之后释放数据流，不过数据流最近的行会保留REPLAY_KEEP秒，
+# 这段时间里面又有人来看这个日志的话，马上就能看到这些行，然后从它们之后继续，不需要再到远端读取最后的几行
+#
+class TailHub(Bean):
+    def __init__(self):
+        Bean.__init__(self, TAIL_HUB)
+        self._feeds = dict()                # (节点, 日志) 与TailFeed的关联
+        self._recent = dict()               # 已经释放了的数据流的 (节点, 日志) 与 (最近的行, 结束位置, 释放的时间) 的关联
+
+    def attach(self, node_name, log_name, viewer, offset=None):
+        """
+        让viewer开始接收某一个日志的数据，已经有数据流了的话直接加入，否则创建一个新的
+        :param offset:  断线重连的时候viewer带上来的位置，已经有数据流了的话从数据流最近的行里面补上这个位置之后的行，
+                        然后从数据流当前的位置开始接收
+        :return:        TailFeed，用于之后detach，创建数据流失败的话抛出异常
+        """
+        key = (node_name, log_name)
+        feed = self._feeds.get(key)
+        if feed is not None:
+            feed.viewers.add(viewer)
+            feed.replay(viewer, offset)
+            return feed
+        now = time.time()
+        for other in [k for k, (_, _, released) in self._recent.items() if now - released > REPLAY_KEEP]:
+            del self._recent[other]
+        recent = self._recent.pop(key, None)
+        feed = TailFeed(self, node_name, log_name)
+        feed.viewers.add(viewer)
+        self._feeds[key] = feed
+        if offset is None and recent is not None:
+            feed.seed(recent[0], recent[1])             # 最近刚释放过，直接从保留下来的位置继续
+            feed.replay(viewer)
+            offset = recent[1]
+        try:
+            feed.start(offset)
+        except:
+            self.remove(feed)
+            viewers = [other for other in feed.viewers if other is not viewer]
+            feed.close()
+            for other in viewers:                       # 在创建的过程中加入的其他viewer
+                other.close()
+            raise
+        logging.info("tail feed created, node:%s, log:%s", node_name, log_name)
+        return feed
+
+    def detach(self, feed, viewer):
+        """
+        viewer不再接收数据了，数据流已经没有viewer了的话释放它
+        """
+        feed.viewers.discard(viewer)
+        if not feed.viewers:
+            self.remove(feed)
+            feed.close()
+            logging.info("tail feed released, node:%s, log:%s", *feed.key)
+
+    def remove(self, feed):
+        """
+        数据流不再使用了，保留它最近的行
+        """
+        if self._feeds.get(feed.key) is feed:
+            del self._feeds[feed.key]
+            lines, offset = feed.recent
+            if lines:
+                self._recent[feed.key] = (lines, offset, time.time())
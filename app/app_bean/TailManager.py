@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+from bean.BeanManager import Bean
+from app_lib.TailSource import TailSource
+import gevent
+import logging
+
+
+TAIL_MANAGER = "tail_m"
+KEEP_TIME = 60          # 最后一个订阅者离开之后，TailSource还保留这么多秒，这段时间里面重连的人可以从原来的位置继续
+
+
+#
+# 运行在Node进程上面，管理所有正在被查看的日志的TailSource，同一个日志文件只会创建一个TailSource，
+# 所有查看这个日志的LogSender都共享它，最后一个查看的人离开KEEP_TIME秒之后，TailSource才会被关闭，
+# 例如页面刷新或者网络闪断的时候，重连上来的人带着原来的位置可以精确的继续，而不是收到跳过了多少字节
+#
+class TailManager(Bean):
+    def __init__(self):
+        Bean.__init__(self, TAIL_MANAGER)
+        self._sources = dict()              # 日志路径与TailSource的关联
+        self._releasing = dict()            # 日志路径与等待关闭TailSource的协程的关联
+
+    def subscribe(self, log_path):
+        """
+        订阅一个日志文件，如果这个文件还没有TailSource，那么创建一个并启动
+        :param log_path:  日志文件的路径
+        :return:          (TailSource, 订阅者的初始游标)
+        """
+        let = self._releasing.pop(log_path, None)
+        if let is not None:
+            let.kill(block=False)
+        source = self._sources.get(log_path)
+        if source is None or not source.started:
+            source = TailSource(log_path)
+            self._sources[log_path] = source
+            source.start()
+            logging.info("TailSource start, path:%s", log_path)
+        return source, source.add_subscriber()
+
+    def unsubscribe(self, source):
+        """
+        取消订阅，如果已经没有订阅者了，那么KEEP_TIME秒之后关闭这个TailSource，已经出错停止了的直接移除
+        """
+        if source.remove_subscriber() > 0:
+            return
+        if source.started and self._sources.get(source.log_path) is source:
+            if source.log_path not in self._releasing:
+                self._releasing[source.log_path] = gevent.spawn_later(KEEP_TIME, self._release, source)
+            return
+        self._release(source)
+
+    def _release(self, source):
+        if self._releasing.get(source.log_path) is gevent.getcurrent():
+            del self._releasing[source.log_path]
+        if source.subscribers <= 0:
+            source.stop()
+            if self._sources.get(source.log_path) is source:
+                del self._sources[source.log_path]
+            logging.info("TailSource stop, path:%s", source.log_path)
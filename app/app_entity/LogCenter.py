@@ -10,6 +10,7 @@ from lib.LetPool import run_task
 import logging
 import traceback
 import json
+import sys
 
 
 CHECK_TIME = 60                            # 每过一段时间来check一下节点的状态
@@ -125,7 +126,7 @@ class LogCenter(Entity):
             logging.error(traceback.format_exc())
 
     @rpc_method()
-    def get_remote_grep_info(self, node_name, log_name, content):
+    def get_remote_grep_info(self, node_name, log_name, content, options=None):
         """
         在需要对远端的日志进行grep操作之前，web进程会通过center来在对应的node上面出创建LogGrep对象
 
@@ -133,16 +134,71 @@ class LogCenter(Entity):
         注意：这里get_remote_info不一样，一个用来grep，一个用来tail
         :param node_name:
         :param log_name:
-        :return:  远端进程的监听地址和创建的grep的id
+        :param options:  查找的选项，原样传给node
+        :return:  远端进程的监听地址和创建的grep的id，创建失败的话返回 {"error": 失败的原因}，由web进程告诉web端
         """
         try:
             node_info = self._nodes[node_name]
             stub = node_info["node_stub"]
-            sender_id = stub.create_grep(log_name, content)
+            sender_id = stub.create_grep(log_name, content, options)
+            if isinstance(sender_id, dict):
+                return sender_id                            # node拒绝了这次查找，例如正则不安全
             return node_info["address"], sender_id
         except:
             logging.error("创建远端grep异常")
             logging.error(traceback.format_exc())
+            return dict(error=str(sys.exc_info()[1]) or "create grep failed")
+
+    @rpc_method()
+    def get_cluster_grep_infos(self, logs, content, options=None):
+        """
+        在多个节点上同时创建LogGrep，用于在整个集群里面查找，所有节点是并发的创建的，
+        某一个节点创建失败了也不会影响其他的节点，web进程拿到之后同时从所有的节点获取结果
+        :param logs:     日志的名字，表示所有在线而且有这个日志的节点，也可以是 {节点的名字: 日志的名字}
+        :param content:  需要grep的内容
+        :param options:  查找的选项，原样传给每一个node
+        :return:         [{"node": 节点的名字, "address": 监听地址, "grep_id": 创建的grep的id}]，创建失败的节点没有grep_id，
+                         而是 "error": 失败的原因
+        """
+        if isinstance(logs, dict):
+            targets = logs.items()
+        else:
+            targets = [(node_name, logs) for node_name, node_info in self._nodes.items()
+                       if node_info["online"] and logs in node_info.get("log_list", [])]
+
+        def _create(node_name, log_name):
+            info = dict(node=node_name)
+            try:
+                node_info = self._nodes[node_name]
+                info["address"] = node_info["address"]
+                grep_id = node_info["node_stub"].create_grep(log_name, content, options)
+                if isinstance(grep_id, dict):
+                    info.update(grep_id)                    # node拒绝了这次查找，带回来的是失败的原因
+                else:
+                    info["grep_id"] = grep_id
+            except:
+                logging.error("创建远端grep异常: %s", node_name)
+                logging.error(traceback.format_exc())
+                info["error"] = str(sys.exc_info()[1]) or "create grep failed"
+            return info
+
+        tasks = [gevent.spawn(_create, node_name, log_name) for node_name, log_name in targets]
+        gevent.joinall(tasks)
+        return [task.value for task in tasks]
+
+    @rpc_method()
+    def get_segments(self, node_name, log_name):
+        """
+        获取远端node上面日志切割出来的文件，用于web端选择需要grep的文件
+        :return:  [(文件名, 大小, 是否已经建立了索引)]，从新到老排序
+        """
+        try:
+            node_info = self._nodes[node_name]
+            return node_info["node_stub"].get_segments(log_name)
+        except:
+            logging.error("获取远端切割文件异常")
+            logging.error(traceback.format_exc())
+            return []
 
     @rpc_method()
     def add_node(self, address):
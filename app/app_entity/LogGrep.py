@@ -2,16 +2,40 @@
 __author__ = 'fjs'
 
 from bean.Entity import Entity, rpc_method
-import subprocess
+from app_lib.GrepEngine import encode_content, create_pattern, MultiPattern, FileScanner, RangeScanner, ReverseScanner
+from app_lib.ParallelScanner import ParallelScanner, HistoryScanner, ChildScanner, PARALLEL_MIN_SIZE
+from app_lib.ResultBuffer import ResultBuffer
+from app_lib.LogIndex import TimeParser
+from app_bean.GrepCache import GREP_CACHE, ENTRY_BYTES
+from app_bean.GrepManager import GREP_MANAGER
+from bean.BeanManager import get_manager
+from config import NodeConfig
+from gevent.event import Event
+import os
 import gevent.timeout
 import gevent
 import sys
 from lib.TimeUtil import get_time
-from gevent.queue import Queue
 import logging
+import traceback
 
 
 GLOBAL_ID = 0
+MAX_MATCHES = 1000000     # 默认最多返回这么多匹配的行，结果太多的时候会写到临时文件里面，所以内存的占用是有上限的
+PAGE_LINES = 1000         # 默认每一页最多这么多行
+PAGE_BYTES = 256 * 1024   # 默认每一页最多这么多字节
+MAX_WAIT = 5              # 获取一页数据的时候，最多等待这么多秒
+MAX_CONTEXT = 20          # 匹配的行前后最多带上这么多行
+CONTEXT_BYTES = 64 * 1024  # 读取前后的行的时候，最多读取这么多字节
+
+TIME_OUT = getattr(NodeConfig, "GREP_TIMEOUT", 10)                          # 在当前进程里面查找的超时时间
+PARALLEL_TIME_OUT = getattr(NodeConfig, "GREP_PARALLEL_TIMEOUT", 120)       # 由子进程并行查找的超时时间
+HISTORY_TIME_OUT = getattr(NodeConfig, "GREP_HISTORY_TIMEOUT", 1800)        # 查找切割出来的多个文件的超时时间
+
+MODE_LINES = "lines"          # 返回匹配的行
+MODE_COUNT = "count"          # 只统计匹配的行数
+MODE_HISTOGRAM = "histogram"  # 按照行里面的时间分段统计匹配的行数
+DEFAULT_BUCKET = 60           # 按时间统计的时候，默认每一段的秒数
 
 
 def _create_id():
@@ -27,85 +51,356 @@ def _create_id():
 
 class Grep(object):
     """
-    用于启动并管理grep的子进程
+    在进程内部对日志文件进行查找，用来替代原来的grep子进程
+
+    按块扫描文件，每扫描完一块让出一次协程，所以不会阻塞其他的请求，读取的速度受IoLimit的预算限制，
+    查找出来的数据放到ResultBuffer里面，远端通过游标分页获取，远端获取得慢也不会让查找停下来，最多保存limit行
+
+    文件很大的时候，切分成多段交给多个子进程并行的查找，结果还是按照文件中的顺序返回，
+    查找的条件里面有用户的正则的话，不管文件多大都放到子进程里面执行，正则在回溯的话不会卡住当前进程，
+    查找的是切割出来的文件，而且已经建立了三元组索引的话，只查找索引过滤之后可能匹配的那几块
+
+    查找整个文件的时候会用到GrepCache，同样的条件之前完整的查找过的话，直接用缓存的结果，只查找文件后面新增加的数据，
+    完整的查找结束之后再把合并之后的结果放回缓存里面
+
+    同样条件的查找同时只会执行一次，由GrepManager来共享，每一个订阅者通过自己的游标来获取结果，最后一个订阅者离开之后才停止，
+    同时执行的查找太多的话，需要在GrepManager里面排队，轮到了之后才开始扫描文件
+
+    content可以是一个列表，表示同时查找多个条件，只需要扫描一次文件，结果里面会带上每一行匹配了哪几个条件，参考MultiPattern
+
+    每一条结果为 (偏移, 行号, 行)，需要带上其他的信息的时候为 (偏移, 行号, 行, 附加信息)，附加信息是一个字典：
+    （1）segment:  所在的文件名，查找多个文件的时候才有
+    （2）before/after:  之前/之后的几行，连接成一个字符串
+    （3）tags:     同时查找多个条件的时候，这一行匹配的条件的下标的列表
+
+    支持的选项：
+    （1）ignore_case:  忽略大小写
+    （2）fixed:        将content当做普通的字符串，而不是正则表达式
+    （3）limit:        最多返回多少行
+    （4）offset:       从文件的哪个偏移开始查找
+    （5）end:          查找到文件的哪个偏移为止
+    （6）line_no:      offset那一行的行号，没有的话行号是从offset开始算的
+    （7）segment:      查找日志切割出来的某一个文件，由Node来处理，为 * 或者压缩过的文件的时候，Node会准备好sources，
+                       每一个文件在一个子进程中查找，结果的附加信息里面带上文件名
+    （8）mode:         lines返回匹配的行（默认），count只统计匹配的行数，histogram按照行里面的时间每bucket秒统计一次，
+                       后面两种只在本地统计，不返回匹配的行，统计的结果在get_stats里面
+    （9）bucket:       按时间统计的时候每一段的秒数
+    （10）before/after/context:  每一个匹配的行带上之前/之后/前后的几行，放在结果的附加信息里面，
+                       查找多个文件或者压缩过的文件的时候不支持
+    （11）reverse:     从文件的末尾往前查找，结果从新到老，找到limit行就停止，只需要最近的几条结果的时候很快，
+                       查找多个文件或者压缩过的文件的时候不支持
+    （12）end_line:    从后往前查找的时候end那一行的行号，由Node通过索引计算，没有的话行号为负数，表示倒数第几行
     """
-    def __init__(self, log_path, content, timeout):
+    def __init__(self, log_path, content, timeout=None, options=None, segment_index=None, sources=None, parser=None):
+        options = options or {}
         self._log_path = log_path         # 文件路径
-        self._time_out = timeout          # 子进程timeout
+        self._time_out = timeout          # 查找的超时时间，None的话按照查找的方式决定，参考_default_timeout
         self._content = content           # 需要grep的内容
+        self._mode = options.get("mode", MODE_LINES)
+        self._bucket = options.get("bucket", DEFAULT_BUCKET)
+        self._parser = parser or TimeParser()                   # 按时间统计的时候用于解析行里面的时间
+        self._histogram = dict()          # 每一段时间的开始与这一段时间里面匹配的行数的关联
+        self._untimed = 0                 # 按时间统计的时候，解析不出时间的匹配的行数
+        context = options.get("context", 0)
+        self._before = min(options.get("before", context), MAX_CONTEXT)
+        self._after = min(options.get("after", context), MAX_CONTEXT)
+        if self._mode == MODE_LINES:
+            self._limit = options.get("limit", MAX_MATCHES)
+        else:
+            self._limit, self._before, self._after = sys.maxint, 0, 0  # 只是统计的话，不需要限制行数
+        if (self._before or self._after) and sources is not None:
+            raise ValueError("context lines are not supported when grep multiple or compressed files")
+        self._reverse = options.get("reverse", False)
+        if self._reverse and sources is not None:
+            raise ValueError("reverse grep is not supported when grep multiple or compressed files")
+        ignore_case, fixed = options.get("ignore_case", False), options.get("fixed", False)
+        self._pattern = create_pattern(content, ignore_case, fixed)
+        self._multiple = isinstance(self._pattern, MultiPattern)
+        self._tag_counts = [0] * len(content) if self._multiple else None   # 每一个条件匹配的行数
+        offset, end = options.get("offset", 0), options.get("end")
+        self._line_base = 0 if self._reverse else options.get("line_no", 1) - 1
+        self._results = ResultBuffer()    # grep出来的数据将会放到这里来等待获取，每一项为 (偏移, 行号, 行)
+        self._count = 0                   # 已经匹配的行数
+        self._cached = 0                  # 直接从缓存中得到的行数
+
+        self._cache = get_manager().get_bean(GREP_CACHE)
+        self._cache_key = None            # 只有查找整个文件，而且不需要前后的行的时候才会用到缓存
+        if self._cache is not None and sources is None and not self._reverse and not offset and end is None and "line_no" not in options \
+                and not self._before and not self._after:
+            self._cache_key = (tuple(content) if self._multiple else content, ignore_case, fixed)
+            self._ino = os.stat(log_path).st_ino
+            entry = self._cache.get(log_path, self._cache_key)
+            if entry is not None:
+                self._consume(entry.records)
+                self._cached = self._count
+                offset, self._line_base = entry.end, entry.lines    # 只需要查找缓存之后新增加的数据
+
+        size = os.path.getsize(log_path) if end is None else end
+        self._size = size
+        ranges = None
+        if segment_index is not None and not self._reverse and not offset and end is None and segment_index.size == size:
+            ranges = segment_index.candidates(self._pattern.required)
+        self._indexed = ranges is not None
+        risky = self._pattern.risky                     # 需要执行用户的正则，放到子进程里面
+        if sources is not None:
+            self._scanner = HistoryScanner(sources, self._pattern, limit=self._limit)
+        elif self._reverse:
+            self._scanner = ReverseScanner(log_path, self._pattern, start=offset, end=end,
+                                           end_line=options.get("end_line"))
+            if risky:
+                self._scanner = ChildScanner(self._scanner, limit=self._limit)
+        elif ranges is not None:
+            self._scanner = RangeScanner(log_path, self._pattern, ranges)
+            if risky:
+                self._scanner = ChildScanner(self._scanner, limit=self._limit)
+        elif size - offset >= PARALLEL_MIN_SIZE or risky:
+            self._scanner = ParallelScanner(log_path, self._pattern, start=offset, end=end, limit=self._limit)
+        else:
+            self._scanner = FileScanner(log_path, self._pattern, start=offset, end=end)
+        if self._time_out is None:
+            self._time_out = self._default_timeout()
+
+        self._event = Event()             # 有新的数据或者查找结束的时候用于唤醒等待数据的协程
+        self._over = False                # 用于标记查找是否已经执行完毕了
+        self._is_time_out = False         # 用于标记查找是否执行超时
+        self._error = None                # 查找出错的原因，例如正则回溯太多被杀掉了
+        self._stopped = False             # 用于标记是否已经被停止了
+        self._subscribers = 0             # 当前共享这个查找的LogGrep的数量
+        self._manager = get_manager().get_bean(GREP_MANAGER)
+        self._greenlet = gevent.spawn(self._start)      # 在一个单独的协程中执行查找
+
+    def _default_timeout(self):
+        """
+        几个GB的文件由子进程并行查找的时候，10秒一般是查找不完的，所以使用更长的超时时间，
+        在当前进程里面查找的一般是小文件或者只是文件后面新增加的数据，使用短的超时时间，
+        查找所有的历史的时候，要一个一个的解压一周甚至更久的压缩文件，需要更长的时间
+        """
+        if isinstance(self._scanner, HistoryScanner):
+            return HISTORY_TIME_OUT
+        if isinstance(self._scanner, ParallelScanner):
+            return PARALLEL_TIME_OUT
+        return TIME_OUT
+
+    @property
+    def over(self):
+        return self._over
 
-        self._process = None              # 用于引用创建的子进程
+    @property
+    def subscribers(self):
+        return self._subscribers
 
-        self._datas = Queue(maxsize=10)   # grep出来的数据将会放到这里来等待获取
-        self._over = False                # 用于标记子进程是否已经执行完毕了
-        self._is_time_out = False         # 用于标记子进程是否执行超时
-        gevent.spawn(self._start)         # 在一个单独的协程中启动一个子进程
+    def add_subscriber(self):
+        self._subscribers += 1
+
+    def remove_subscriber(self):
+        """
+        移除一个订阅者，返回剩下的订阅者的数量
+        """
+        self._subscribers -= 1
+        return self._subscribers
 
     def _start(self):
         """
-        这个方法需要在一个协程中单独的执行，用于启动一个子进程，然后执行grep方法，并通过过标准输出来获取数据
+        这个方法需要在一个协程中单独的执行，按块扫描文件，每一块之间让出协程，同时检查是否需要停止
 
-        通过一个超时了控制子进程的运行时间，防止grep执行过久，占用太多系统资源，在超时之后要保证启动的grep进程被关闭
+        通过一个超时了控制查找的运行时间，防止执行过久，占用太多系统资源，排队等待的时间不算在里面
         """
+        batches = self._scanner.batches()
         try:
+            if self._manager is not None:
+                self._manager.admit(self)               # 同时执行的查找太多了的话，在这里排队
             with gevent.timeout.Timeout(self._time_out):
-                p = subprocess.Popen(["grep", self._content, self._log_path], stdout=subprocess.PIPE)
-                self._process = p
-                while 1:
-                    line = p.stdout.readline()
-                    if not line:                       # 这个一般是子进程退出了
+                for batch in batches:
+                    if self._stopped or self._count >= self._limit:
                         break
-                    self._datas.put(line)
+                    if batch:
+                        if self._line_base:
+                            batch = [(r[0], r[1] + self._line_base) + r[2:] for r in batch]
+                        more = self._consume(batch)
+                        self._event.set()
+                        if not more:
+                            break
+                    gevent.sleep(0)                     # 扫描文件并不会让出协程，这里主动让出一下
+                else:
+                    self._save_cache()                  # 没有被中断，是一次完整的查找
         except:
             """
             如果发发生了异常，那么判断异常的类型，如果是超时异常，那么需要设置超时标志位
             """
             ex = sys.exc_info()[1]
-            if isinstance(ex, gevent.Timeout):
-                logging.error(u"grep执行超时 %s:%s", self._log_path, self._content)
+            if isinstance(ex, gevent.GreenletExit):
+                pass                                    # 被stop停止了
+            elif isinstance(ex, gevent.Timeout):
+                logging.error(u"grep执行超时 %s:%r", self._log_path, self._content)
                 self._is_time_out = True
+            else:
+                logging.error(u"grep执行异常 %s:%r", self._log_path, self._content)
+                logging.error(traceback.format_exc())
+                self._error = str(ex)
         finally:
-            if self._process and self._process.returncode is None:
-                self._process.kill()
+            batches.close()                             # 并行查找的时候，保证子进程都被关闭了
+            if self._manager is not None:
+                self._manager.release(self)
             self._over = True
+            self._event.set()
 
-    def get_data(self):
+    def _consume(self, batch):
+        """
+        按照查找的模式处理一批匹配的行
+        :return:  是否还需要继续查找
         """
-        获取已经grep出来的数据，如果没有数据，那么返回None，同时需要返回启动的子进程是否已经结束，是否是超时
+        if self._mode == MODE_LINES:
+            batch = batch[:self._limit - self._count]
+        if self._multiple:
+            self._count_tags(batch)
+        if self._mode == MODE_HISTOGRAM:
+            for record in batch:
+                ts = self._parser.parse(record[2])
+                if ts is None:
+                    self._untimed += 1
+                else:
+                    key = int(ts // self._bucket * self._bucket)
+                    self._histogram[key] = self._histogram.get(key, 0) + 1
+        if self._mode != MODE_LINES:
+            self._count += len(batch)
+            return True
+        if self._before or self._after:
+            batch = self._add_context(batch)
+        full = not self._results.extend(batch)
+        self._count = len(self._results)
+        return not full and self._count < self._limit
+
+    def _count_tags(self, batch):
         """
-        if self._datas.qsize() > 0:
-            out = self._datas
-            self._datas = Queue(maxsize=10)
-            out_data = []
-            while out.qsize() > 0:
-                out_data.append(out.get())
-            return out_data, self._over, self._is_time_out
+        同时查找多个条件的时候，统计每一个条件匹配的行数，每一行匹配了哪几个条件已经由scanner放到附加信息里面了，
+        有用户的正则的话是在子进程里面确认的，这里不能再执行正则
+        """
+        for record in batch:
+            for index in record[3]["tags"]:
+                self._tag_counts[index] += 1
+
+    def _add_context(self, batch):
+        """
+        为每一个匹配的行读取之前以及之后的几行，前后的行分别连接成一个字符串
+        """
+        out = []
+        with open(self._log_path, "rb") as f:
+            for record in batch:
+                offset, line_no, line = record[:3]
+                before, after = "", ""
+                if self._before and offset > 0:
+                    start = max(0, offset - CONTEXT_BYTES)
+                    f.seek(start)
+                    data = f.read(offset - start)
+                    pos = len(data)
+                    for _ in xrange(self._before):
+                        pos = data.rfind("\n", 0, pos - 1) + 1
+                        if pos <= 0:
+                            break
+                    before = data[pos:]
+                if self._after:
+                    f.seek(offset + len(line))
+                    data = f.read(CONTEXT_BYTES)
+                    pos = 0
+                    for _ in xrange(self._after):
+                        pos = data.find("\n", pos) + 1
+                        if pos <= 0:
+                            pos = len(data)
+                            break
+                    after = data[:pos]
+                extra = dict(record[3]) if len(record) > 3 else {}
+                extra["before"], extra["after"] = before, after
+                out.append((offset, line_no, line, extra))
+        return out
+
+    def _save_cache(self):
+        """
+        将完整查找的结果放到缓存里面，结果太多的话就不缓存了，只是统计的时候没有保存结果，所以也不缓存
+        """
+        if self._cache_key is None or self._mode != MODE_LINES or self._scanner.scanned == 0 or self._results.full:
+            return
+        if self._results.bytes > ENTRY_BYTES:
+            return
+        if self._indexed:
+            end, lines = self._size, None                 # 通过索引跳过了一些块，所以不知道总的行数
         else:
-            return None, self._over, self._is_time_out
+            end, lines = self._scanner.position, self._line_base + self._scanner.lines
+        records = self._results.get_page(0, len(self._results), self._results.bytes + 1)[0]
+        self._cache.put(self._log_path, self._cache_key, self._ino, end, lines, records)
+
+    def stop(self):
+        """
+        停止查找，直接杀掉执行查找的协程，正在等待子进程的数据或者还在排队的话也会马上退出，子进程会被杀掉，
+        同时释放保存的结果
+        """
+        self._stopped = True
+        self._greenlet.kill(block=False)
+        self._over = True                               # 协程还没有开始执行的话，就不会再执行了
+        self._results.close()
+        self._event.set()
+
+    def get_page(self, cursor, max_lines=PAGE_LINES, max_bytes=PAGE_BYTES, wait=0):
+        """
+        获取从游标开始的一页数据，如果还没有新的数据，而且查找还没有结束，那么最多等待wait秒
+        :return:  (数据的列表, 下一页的游标)
+        """
+        if wait and cursor >= len(self._results) and not self._over:
+            self._event.clear()
+            self._event.wait(min(wait, MAX_WAIT))
+        return self._results.get_page(cursor, max_lines, max_bytes)
+
+    def get_stats(self):
+        """
+        :return:  当前的状态，包括是否结束，是否超时，匹配的行数，其中直接从缓存中得到的行数，可以获取的结果的数量，
+                  扫描过的字节数，结果是否因为太多而被截断了，在队列中的位置（0表示已经开始执行了），出错的话还有出错的原因，按时间统计的时候还有每一段时间的行数以及解析不出时间的行数，
+                  同时查找多个条件的时候还有每一个条件匹配的行数
+        """
+        out = dict(over=self._over, time_out=self._is_time_out, matches=self._count, cached=self._cached,
+                   results=len(self._results), scanned=self._scanner.scanned,
+                   truncated=self._results.full or self._count >= self._limit,
+                   queued=self._manager.position(self) if self._manager is not None else 0)
+        if self._mode == MODE_HISTOGRAM:
+            out["histogram"], out["untimed"] = sorted(self._histogram.items()), self._untimed
+        if self._multiple:
+            out["tags"] = self._tag_counts
+        if self._error is not None:
+            out["error"] = self._error
+        return out
 
 
 #
-# 用于远端需要一个grep的功能的时候，将会创建这么一个entity，用于启动一个子进程来grep相应的文件
+# 用于远端需要一个grep的功能的时候，将会创建这么一个entity，通过GrepManager订阅一个Grep，
+# 同样条件的查找正在执行的话直接共享它，每一个entity都有自己的游标
 #
 class LogGrep(Entity):
-    def __init__(self, log_path, content, time_out=10):
+    def __init__(self, log_path, content, time_out=None, options=None, segment_index=None, sources=None, parser=None):
         """
         :param log_path:   需要grep的文件路径，这里最好是使用绝对路径
         :param content:    需要grep的内容
-        :param time_out:   子进程超时时间，防止grep消耗太多
+        :param time_out:   查找的超时时间，防止grep消耗太多，None的话使用配置的超时时间，参考Grep._default_timeout
+        :param options:    查找的选项，具体参考Grep
+        :param segment_index:  查找的是切割出来的文件的时候，这个文件的三元组索引
+        :param sources:        查找多个文件或者压缩过的文件的时候，需要查找的文件，参考HistoryScanner
+        :param parser:         日志的TimeParser，按时间统计的时候用来解析行里面的时间
         """
+        content = encode_content(content)                    # 日志是utf-8的字节，查找条件也需要是字节
+
+        # 代理这个的方法来获取grep的数据，先订阅，排队的查找太多了或者正则不安全的话直接抛出异常，
+        # 这时候当前entity还没有注册，定时器也还没有启动，不需要释放
+        grep = get_manager().get_bean(GREP_MANAGER).subscribe(
+            log_path, content, options, lambda: Grep(log_path, content, time_out, options, segment_index, sources, parser))
         Entity.__init__(self, _create_id())
+        self._grep = grep
         self._log_path = log_path
         self._time_out = time_out
         self._content = content
         self._last_time = get_time()                          # 记录上次访问时间
+        self._cursor = 0                                      # get_data已经获取到的位置
 
         # 创建一个定时器来检查上次访问时间，保证当前Entity一定会被释放
         self._check_timer = gevent.get_hub().loop.timer(20, 20)
         self._check_timer.start(self._check)
 
-        self._grep = Grep(log_path, content, time_out)        # 代理这个的方法来获取grep的数据
-
     def _check(self):
         """
         在定时器中检查上次访问时间，长时间没有访问了，需要释放当前entity
@@ -117,16 +412,40 @@ class LogGrep(Entity):
     def get_data(self):
         """
         远端会通过不断的调用这个方法来获取grep出来的数据和grep的状态
+        数据为 (偏移, 行号, 行) 的列表
+        """
+        self._last_time = get_time()
+        out_data, self._cursor = self._grep.get_page(self._cursor)
+        stats = self._grep.get_stats()
+        return out_data or None, stats["over"], stats["time_out"]
+
+    @rpc_method()
+    def get_page(self, cursor=0, max_lines=PAGE_LINES, max_bytes=PAGE_BYTES, wait=0):
+        """
+        通过游标分页获取grep出来的数据，获取过的数据不会被删除，所以可以从任意的位置重新获取
+        :param cursor:     从第几条结果开始获取，第一次为0，之后使用返回的游标
+        :param max_lines:  这一页最多多少行
+        :param max_bytes:  这一页最多多少字节，不过至少会返回一行
+        :param wait:       没有新数据而且查找还没有结束的时候，最多等待多少秒，避免远端频繁的调用
+        :return:           {"data": [(偏移, 行号, 行)], "cursor": 下一页的游标, "over": 是否结束, "time_out": 是否超时,
+                            "matches": 匹配的行数, "cached": 其中直接从缓存中得到的行数, "results": 可以获取的结果的数量,
+                            "scanned": 扫描过的字节数, "truncated": 结果是否被截断了, "queued": 在队列中的位置}，
+                            具体参考Grep.get_stats
         """
         self._last_time = get_time()
-        return self._grep.get_data()
+        data, cursor = self._grep.get_page(cursor, max_lines, max_bytes, wait)
+        out = self._grep.get_stats()
+        out["data"], out["cursor"] = data, cursor
+        return out
 
     @rpc_method()
     def close(self):
         """
         远端可以调用这个方法来释放当前entity
-        这里直接调用release方法，对于grep，反正超时之后都会自己关闭的，就不管了，释放引用就好了
+        这里需要取消订阅，没有其他人共享的话，还在进行的查找会被停止，然后调用release方法
         """
-        self._grep = None
+        if self._grep is not None:
+            get_manager().get_bean(GREP_MANAGER).unsubscribe(self._grep)
+            self._grep = None
         self.release()
         self._check_timer.stop()
@@ -3,18 +3,21 @@ __author__ = 'fjs'
 
 
 from bean.Entity import Entity
-from gevent.lock import RLock
-import subprocess
-from collections import deque
-from lib.LetPool import run_task
-from bean.Entity import rpc_method
+from bean.Entity import rpc_method, rpc_message, create_push_stub
+from bean.BeanManager import get_manager
+from app_bean.TailManager import TAIL_MANAGER
+from app_lib.TailSource import MAX_BYTES
+from app_lib.FileFollower import read_tail
 from lib.TimeUtil import get_time
+from lib.LetPool import run_task
+from gevent.event import Event
 import gevent
 import logging
 
 
 GLOBAL_ID = 0       # 计数器，用于为LogSender分配entityID
 MOST_TIME = 60      # 最长超过这么多秒都没有访问get_data方法的话，就可以释放资源了
+PUSH_CREDIT = 4     # 推送模式下，默认最多有这么多批数据已经推送出去但是还没有被确认
 
 
 def _create_id():
@@ -28,68 +31,6 @@ def _create_id():
     return str(GLOBAL_ID)
 
 
-class LogGetter(object):
-    """
-    用于创建一个子进程来tail 需要监控的文件，然后在协程中不断的通过pip来读取数据，将其放到队列里面等待
-    别的进程来获取
-    """
-    def __init__(self, log_path):
-        self._log_path = log_path
-        self._started = False
-        self._lock = RLock()
-        self._process = None
-        self._datas = deque()
-
-    def get_data(self):
-        with self._lock:
-            if not self._started:
-                self._start()
-            if self._datas:
-                out = self._datas
-                self._datas = deque()
-                return out
-            else:
-                return None
-
-    def stop(self):
-        """
-        用于停止子进程
-        """
-        if self._started:
-            self._started = False
-            self._process.kill()
-
-    def _start(self):
-        """
-        启动一个子进程，然后在协程中不断的通过pip来获取数据，将获取的到数据放到队列中
-
-        注意：如果数据过多，都超过了100行，那么会直接移除，用于保证数据做多100行
-        """
-        p = subprocess.Popen(["tail", "-f", self._log_path], stdout=subprocess.PIPE)
-        self._process = p
-        self._started = True
-
-        def _run():
-            while self._started:
-                try:
-                    data = p.stdout.readline()
-                    if not data:
-                        break
-                    self._datas.append(data)
-                    if len(self._datas) > 100:
-                        self._datas.popleft()
-                except:
-                    break
-            if self._started:
-                self._started = False
-                try:
-                    p.kill()
-                except:
-                    pass
-
-        run_task(_run)
-
-
 #
 # 远端会要求在Node节点上创建一个这个对象，用于远端通过rpc方法来获取日志的数据
 #
@@ -98,24 +39,124 @@ class LogSender(Entity):
         """
         远程会要求log节点进程创建一个这种entity，用于远程通过rpc方法来获取监控的日志的数据
 
+        同一个日志的所有LogSender共享TailManager上面的同一个TailSource，这里只保存一个位置，
+        表示自己已经获取到了数据流的哪里
+
         注意：为了防止一些意外，会启动一个定时器，检测上次访问时间，如果很长时间都没有访问了，那么会自动
-             停止LogGetter对象，然后清除当前entity，主要为了在一些异常情况下能够关闭开启了的子进程，释放占用的资源
+             取消对TailSource的订阅，然后清除当前entity，主要为了在一些异常情况下能够及时的释放占用的资源
         :param log_path:    日志的路径
         """
         Entity.__init__(self, _create_id())
         self._log_path = log_path
-        self._getter = LogGetter(log_path)
+        self._source, self._cursor = get_manager().get_bean(TAIL_MANAGER).subscribe(log_path)
+        self._receiver = None                               # 推送模式下，远端用于接收数据的entity的PushStub
+        self._credit = 0                                    # 推送模式下，还可以推送多少批数据
+        self._wake = Event()                                # 推送模式下，有新数据或者有了新的额度的时候用于唤醒推送协程
         self._last_time = get_time()                        # 用于记录上一次访问时间
         self._check_timer = gevent.get_hub().loop.timer(40, 40)
         self._check_timer.start(self._check)                # 用于检测上次访问时间的timer
 
     @rpc_method()
-    def get_data(self):
+    def get_data(self, since_offset=None, max_bytes=MAX_BYTES):
         """
         远端会不断的调用这个方法来获取当前日志的最新数据用于在web界面上显示
+
+        远端可以带上自己上次获取到的位置，这样子即使是断线重连之后重新创建的LogSender，也可以从原来的地方继续，
+        如果没有带上位置，那么就从当前LogSender自己记录的位置继续
+        :param since_offset:  上次获取到的数据的结束位置
+        :param max_bytes:     这次最多返回的字节数
+        :return: (行的列表, 这些行的结束位置, 跳过的字节数)，跳过的字节数不为0表示获取得太慢，有数据已经不在缓冲区里面了
         """
         self._last_time = get_time()      # 更新该方法的上次访问时间
-        return self._getter.get_data()
+        if self._source is None:
+            return [], since_offset, 0
+        if self._source.error is not None:
+            raise IOError("tail source stopped: %s" % self._source.error)
+        if since_offset is None:
+            since_offset = self._cursor
+        lines, self._cursor, gap = self._source.read_since(since_offset, max_bytes)
+        return lines, self._cursor, gap
+
+    @rpc_method()
+    def get_tail(self, lines, max_bytes=MAX_BYTES):
+        """
+        获取日志最后的几行，用于新打开的页面马上就能看到最近的日志，而不是要等到日志有新的数据，
+        TailSource的缓冲区里面已经有足够的行的话直接从缓冲区里面取，否则从文件的尾部往回读取一次
+
+        返回的结束位置可以直接作为get_data或者subscribe的since_offset，从这些行之后继续
+        :param lines:      最多返回的行数
+        :param max_bytes:  最多返回的字节数
+        :return:           (行的列表, 这些行的结束位置)
+        """
+        self._last_time = get_time()
+        if self._source is None:
+            return [], None
+        if self._source.end is None:
+            return read_tail(self._log_path, lines, max_bytes)  # TailSource刚启动还没有读取，位置与文件偏移一致
+        out, offset, _ = self._source.read_since(self._source.tail_offset(lines), max_bytes)
+        if len(out) < lines:
+            file_lines, file_end = read_tail(self._log_path, lines, max_bytes)
+            if file_end == offset and len(file_lines) > len(out):
+                return file_lines, file_end                     # 缓冲区里面的行不够，文件也没有新数据，直接用文件里面的
+        return out, offset
+
+    @rpc_method()
+    def subscribe(self, receiver_id, since_offset=None, credit=PUSH_CREDIT):
+        """
+        切换到推送模式，之后不再需要远端不断的调用get_data，有了新的数据之后直接通过远端调用这个方法的那条连接，
+        以单向消息的方式推送给远端的receiver的on_data方法，日志没有新数据的时候没有任何开销
+
+        通过额度来做流控：每推送一批数据消耗一个额度，远端处理完一批数据之后调用ack归还额度，
+        额度用完了就停止推送，数据会留在TailSource的缓冲区里面，远端太慢的话会收到跳过了多少字节的通知
+
+        注意：调用方与当前进程的连接断开之后，当前sender会直接释放
+        :param receiver_id:   远端进程上接收数据的entity的id，它需要有on_data(lines, offset, gap)这个rpc_message方法
+        :param since_offset:  从哪个位置开始推送，None表示从当前sender记录的位置开始
+        :param credit:        最多同时推送出去还没有被确认的批数
+        """
+        if self._source is None or self._receiver is not None:
+            return False
+        self._receiver = create_push_stub(receiver_id)
+        self._receiver.add_close_listener(self._do_close)
+        if since_offset is not None:
+            self._cursor = since_offset
+        self._credit = credit
+        self._source.add_listener(self._wake.set)
+        run_task(self._push)
+        return True
+
+    @rpc_message()
+    def ack(self, count=1):
+        """
+        远端处理完了推送过去的数据之后调用这个方法来归还额度
+        """
+        self._last_time = get_time()
+        self._credit += count
+        self._wake.set()
+
+    def _push(self):
+        """
+        推送模式下的推送协程，有额度而且有新数据的时候就推送一批，否则在event上面等待
+        """
+        while self._receiver is not None:
+            self._wake.clear()
+            if self._source is not None and self._source.error is not None:
+                logging.error("LogSender source stopped, id:%s, error:%s", self.id, self._source.error)
+                self._do_close()                             # 连接上的receiver会被关闭，远端会重连
+                break
+            if self._credit > 0 and self._source is not None:
+                lines, offset, gap = self._source.read_since(self._cursor, MAX_BYTES)
+                if lines or gap:
+                    self._cursor = offset
+                    self._credit -= 1
+                    try:
+                        self._receiver.on_data(lines, offset, gap)
+                    except:
+                        logging.error("LogSender push error, id:%s", self.id)
+                        self._do_close()
+                        break
+                    continue
+            self._wake.wait()
 
     @rpc_method()
     def close(self):
@@ -131,14 +172,23 @@ class LogSender(Entity):
         logging.info("LogSender release, id:%s", self.id)
         self.release()
         self._check_timer.stop()
-        self._getter.stop()
+        if self._receiver is not None:
+            self._receiver.remove_close_listener(self._do_close)
+            self._receiver = None
+        if self._source is not None:
+            self._source.remove_listener(self._wake.set)
+            get_manager().get_bean(TAIL_MANAGER).unsubscribe(self._source)
+            self._source = None
+        self._wake.set()                                     # 唤醒推送协程，让其退出
 
     def _check(self):
         """
         用于在定时器中运行，通过检测上次访问时间来及时的释放资源
+
+        注意：推送模式下日志没有新数据的时候远端并不会访问，这个时候依靠连接断开来释放
         """
         now = get_time()
-        if now - self._last_time >= 60:
+        if self._receiver is None and now - self._last_time >= 60:
             self._do_close()
 
 
@@ -2,10 +2,14 @@ __author__ = 'fjs'
 # -*- coding: utf-8 -*-
 
 
+import logging
 from bean.Entity import Entity
 from bean.Entity import rpc_method
+from bean.BeanManager import get_manager
+from app_bean.IndexManager import INDEX_MANAGER
 from app_entity.LogSender import LogSender
 from app_entity.LogGrep import LogGrep
+from app_lib.GrepEngine import is_compressed
 
 #
 # 被监控的服务器进程的提供基本服务的entity，每一个被监控的服务器都应该启动一个进程
@@ -49,13 +53,63 @@ class Node(Entity):
         return sender.id
 
     @rpc_method()
-    def create_grep(self, log_name, content):
+    def create_grep(self, log_name, content, options=None):
         """
         用于创建一个LogGrep对象，然后返回它的id
         :param log_name:  需要grep的文件的名字
         :param content:   需要grep的内容
+        :param options:   查找的选项，例如 {"ignore_case": True, "limit": 1000}，具体参考LogGrep，
+                          另外还可以通过since/until指定一个时间窗口，只查找这个窗口里面的行，
+                          时间可以是时间戳，也可以是 "2016-04-15 14:00:00" 这种格式的字符串，content为空的话返回窗口里面所有的行，
+                          通过segment可以指定查找日志切割出来的某一个文件，参考get_segments，
+                          segment为 * 的话查找所有切割出来的文件以及当前的日志，结果按时间从老到新，每一项带上文件名，
+                          通过mode可以只在这边统计匹配的行数或者按时间统计，这时候使用日志配置的时间格式来解析行里面的时间
+        :return:          grep的id，不能查找的话（例如正则不安全，排队的查找太多了，切割出来的文件不存在）返回 {"error": 原因}，
+                          rpc抛出去的异常在调用方只能拿到rpc execute error，所以原因只能作为返回值带回去
         """
-        log_path = self._log_infos[log_name]
-        grep = LogGrep(log_path, content)
+        try:
+            return self._create_grep(log_name, content, options)
+        except (ValueError, IOError) as e:
+            logging.warning("create grep failed, log:%s, content:%r, error:%s", log_name, content, e)
+            return dict(error=str(e))
+
+    def _create_grep(self, log_name, content, options):
+        index_manager = get_manager().get_bean(INDEX_MANAGER)
+        index = index_manager.get_index(log_name)
+        parser = index.parser if index is not None else None
+        segment = options and options.get("segment")
+        if segment == "*" or segment and is_compressed(segment):
+            sources = index_manager.prepare_sources(log_name, options)
+            grep = LogGrep(self._log_infos[log_name], content, options=options, sources=sources, parser=parser)
+            return grep.id
+        if segment:
+            log_path, segment_index = index_manager.resolve_segment(log_name, segment)
+        else:
+            log_path, segment_index = self._log_infos[log_name], None
+        options = index_manager.prepare_options(log_name, options, log_path if segment else None)
+        grep = LogGrep(log_path, content, options=options, segment_index=segment_index, parser=parser)
         return grep.id
 
+    @rpc_method()
+    def get_segments(self, log_name):
+        """
+        获取日志切割出来的文件
+        :return:  [(文件名, 大小, 是否已经建立了索引)]，从新到老排序
+        """
+        return get_manager().get_bean(INDEX_MANAGER).get_segments(log_name)
+
+    @rpc_method()
+    def locate(self, log_name, line_no=None, timestamp=None):
+        """
+        通过日志的索引来定位某一行或者某一个时间在文件中的位置，只需要读取很少的数据
+        :param log_name:   日志的名字
+        :param line_no:    需要定位的行号
+        :param timestamp:  需要定位的时间戳，返回第一个不早于这个时间的行
+        :return:           (偏移, 行号)，例如可以作为create_grep的offset选项，日志不存在或者没有索引的话抛出异常
+        """
+        index = get_manager().get_bean(INDEX_MANAGER).get_index(log_name)
+        if index is None:
+            raise IOError("log not indexed: %s" % log_name)
+        if line_no is not None:
+            return index.locate_line(line_no)
+        return index.locate_time(timestamp)
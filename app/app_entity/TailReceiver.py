@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+from bean.Entity import Entity, rpc_message
+from gevent.queue import Queue
+
+
+GLOBAL_ID = 0       # 计数器，用于为TailReceiver分配entityID
+
+
+def _create_id():
+    """
+    用于为TailReceiver分配ID
+    """
+    global GLOBAL_ID
+    GLOBAL_ID += 1
+    if GLOBAL_ID > 100000:
+        GLOBAL_ID = 1
+    return str(GLOBAL_ID) + "recv"
+
+
+#
+# 生活在web进程里面，Node上面的LogSender切换到推送模式之后，会把日志数据推送到这个entity上面来
+# 这里只是把数据放到队列里面，由websocket那边的协程按顺序取出来发送，保证数据的顺序
+#
+class TailReceiver(Entity):
+    def __init__(self):
+        Entity.__init__(self, _create_id())
+        self._datas = Queue()
+
+    @rpc_message()
+    def on_data(self, lines, offset, gap):
+        """
+        LogSender推送过来的一批数据
+        :param lines:   行的列表
+        :param offset:  这些行的结束位置
+        :param gap:     因为太慢而跳过的字节数
+        """
+        self._datas.put((lines, offset, gap))
+
+    def get(self):
+        """
+        获取一批推送过来的数据，没有的话阻塞等待，返回None表示已经关闭了
+        """
+        return self._datas.get()
+
+    def close(self):
+        """
+        释放当前entity，同时唤醒还在等待数据的协程
+        """
+        self.release()
+        self._datas.put(None)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+from geventwebsocket import WebSocketServer
+from geventwebsocket.handler import WebSocketHandler
+from geventwebsocket.websocket import WebSocket, Header, MSG_ALREADY_CLOSED, MSG_SOCKET_DEAD
+from geventwebsocket.exceptions import ProtocolError, WebSocketError
+from socket import error
+import zlib
+
+
+#
+# geventwebsocket不支持websocket的扩展，这里实现permessage-deflate（RFC 7692）：
+# 浏览器握手的时候带上了这个扩展的话，发送给web端的每一条消息（tail的数据帧，grep的结果）都用deflate压缩，
+# 日志的文本一般可以压缩5到10倍，通过vpn看线上日志的时候带宽小很多，日志写得很快的时候也能跟得上
+#
+# （1）level：        压缩级别，越高压缩率越好，cpu也用得越多
+# （2）window_bits：  压缩窗口的大小，9到15，越小每一个连接占用的内存越少，不过压缩率也会差一些，
+#                    握手的时候通过server_max_window_bits告诉浏览器
+# （3）min_bytes：    比这个小的消息直接发送，压缩它们省不了多少字节，还要浪费cpu
+#
+# 压缩的上下文在一个连接的所有消息之间保留（context takeover），后面的消息可以引用前面消息的内容，
+# 日志的行之间重复的内容很多，这样子压缩率会好很多，浏览器要求server_no_context_takeover的话每条消息单独压缩
+#
+EXTENSION = "permessage-deflate"
+RSV1 = Header.RSV0_MASK           # geventwebsocket里面的编号从0开始，它的RSV0就是RFC里面的RSV1
+TAIL = b"\x00\x00\xff\xff"        # 每一条压缩过的消息末尾都是这4个字节，发送的时候去掉，接收的时候补上
+DEFAULT_LEVEL = 3
+DEFAULT_WINDOW_BITS = 15
+DEFAULT_MIN_BYTES = 256
+MIN_WINDOW_BITS = 9               # zlib不支持8的窗口
+
+
+def parse_offers(header):
+    """
+    解析浏览器握手的时候带上来的Sec-WebSocket-Extensions
+    :return:  permessage-deflate的每一个候选的参数，[{参数: 值}]，没有值的参数值为None
+    """
+    offers = []
+    for item in (header or "").split(","):
+        parts = [part.strip() for part in item.split(";")]
+        if parts[0] != EXTENSION:
+            continue
+        params = dict()
+        for part in parts[1:]:
+            if not part:
+                continue
+            name, _, value = part.partition("=")
+            params[name.strip()] = value.strip().strip('"') or None
+        offers.append(params)
+    return offers
+
+
+def negotiate(header, window_bits=DEFAULT_WINDOW_BITS):
+    """
+    从浏览器的候选里面选择第一个能接受的，有不认识的参数或者参数不合法的候选跳过
+    :return:  (回复给浏览器的扩展的描述, 服务器这边压缩的窗口大小, 是否每条消息单独压缩)，都不能接受的话返回None
+    """
+    window_bits = max(MIN_WINDOW_BITS, min(15, window_bits))
+    for params in parse_offers(header):
+        response = [EXTENSION]
+        bits = window_bits
+        reset = False
+        try:
+            for name, value in params.items():
+                if name == "server_no_context_takeover" and value is None:
+                    reset = True
+                    response.append(name)
+                elif name == "client_no_context_takeover" and value is None:
+                    pass                                # 不影响服务器这边的解压
+                elif name == "server_max_window_bits":
+                    bits = min(bits, int(value))
+                    if bits < MIN_WINDOW_BITS:
+                        raise ValueError(value)
+                elif name == "client_max_window_bits":
+                    if value is not None and not 8 <= int(value) <= 15:
+                        raise ValueError(value)
+                else:
+                    raise ValueError(name)
+        except (ValueError, TypeError):
+            continue
+        response.append("server_max_window_bits=%d" % bits)
+        return "; ".join(response), bits, reset
+    return None
+
+
+class Deflater(object):
+    """
+    一个连接的压缩以及解压的上下文
+    """
+    def __init__(self, level, window_bits, reset, min_bytes):
+        object.__init__(self)
+        self._level = level
+        self._window_bits = window_bits
+        self._reset = reset
+        self._compressor = None
+        self._decompressor = zlib.decompressobj(-15)    # 浏览器的窗口不会超过15，用最大的窗口就能解压
+        self.min_bytes = min_bytes
+
+    def compress(self, message):
+        if self._compressor is None or self._reset:
+            self._compressor = zlib.compressobj(self._level, zlib.DEFLATED, -self._window_bits)
+        data = self._compressor.compress(message) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data[:-len(TAIL)] if data.endswith(TAIL) else data
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data + TAIL)
+
+
+class DeflateWebSocket(WebSocket):
+    """
+    支持permessage-deflate的websocket，握手成功之后由DeflateHandler把刚创建的WebSocket转换过来，
+    WebSocket用了__slots__，所以这里不能有新的属性，压缩的上下文放在handler上面，参考Deflater
+    """
+    __slots__ = ()
+
+    def send_frame(self, message, opcode):
+        """
+        文本和二进制的消息超过min_bytes的话压缩之后再发送，同时设置RSV1，控制帧不能压缩
+        """
+        if opcode not in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            return WebSocket.send_frame(self, message, opcode)
+        if self.closed:
+            self.current_app.on_close(MSG_ALREADY_CLOSED)
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+        if opcode == self.OPCODE_TEXT:
+            message = self._encode_bytes(message)
+        else:
+            message = bytes(message)
+        flags = 0
+        if len(message) >= self.handler.deflater.min_bytes:
+            message = self.handler.deflater.compress(message)
+            flags = RSV1
+        header = Header.encode_header(True, opcode, b'', len(message), flags)
+        try:
+            self.raw_write(header + message)
+        except error:
+            raise WebSocketError(MSG_SOCKET_DEAD)
+
+    def read_frame(self):
+        """
+        与WebSocket.read_frame一样，只是允许数据帧带上RSV1，表示这一条消息是压缩过的
+        """
+        header = Header.decode_header(self.stream)
+        if header.flags & ~RSV1 or (header.flags and header.opcode > 0x07):
+            raise ProtocolError
+        if not header.length:
+            return header, b''
+        try:
+            payload = self.raw_read(header.length)
+        except Exception:
+            payload = b''
+        if len(payload) != header.length:
+            raise WebSocketError('Unexpected EOF reading frame payload')
+        if header.mask:
+            payload = header.unmask_payload(payload)
+        return header, payload
+
+    def read_message(self):
+        """
+        与WebSocket.read_message一样，只是第一帧带有RSV1的话，整条消息收完之后先解压，
+        压缩过的文本只能在解压之后再检查utf8
+        """
+        opcode = None
+        compressed = False
+        message = bytearray()
+        while True:
+            header, payload = self.read_frame()
+            f_opcode = header.opcode
+            if f_opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+                if opcode:
+                    raise ProtocolError("The opcode in non-fin frame is expected to be zero, "
+                                        "got {0!r}".format(f_opcode))
+                self.utf8validator.reset()
+                self.utf8validate_last = (True, True, 0, 0)
+                opcode = f_opcode
+                compressed = bool(header.flags & RSV1)
+            elif f_opcode == self.OPCODE_CONTINUATION:
+                if not opcode or header.flags:
+                    raise ProtocolError("Unexpected frame with opcode=0")
+            elif f_opcode == self.OPCODE_PING:
+                self.handle_ping(header, payload)
+                continue
+            elif f_opcode == self.OPCODE_PONG:
+                self.handle_pong(header, payload)
+                continue
+            elif f_opcode == self.OPCODE_CLOSE:
+                self.handle_close(header, payload)
+                return
+            else:
+                raise ProtocolError("Unexpected opcode={0!r}".format(f_opcode))
+            if opcode == self.OPCODE_TEXT and not compressed:
+                self.validate_utf8(payload)
+            message += payload
+            if header.fin:
+                break
+        if compressed:
+            try:
+                message = bytearray(self.handler.deflater.decompress(bytes(message)))
+            except zlib.error:
+                raise ProtocolError("Invalid deflate data")
+        if opcode == self.OPCODE_TEXT:
+            self.validate_utf8(message)
+            return self._decode_bytes(message)
+        return message
+
+
+class DeflateHandler(WebSocketHandler):
+    """
+    握手的时候协商permessage-deflate，浏览器不支持的话与原来的WebSocketHandler完全一样
+    """
+    def upgrade_connection(self):
+        self._deflate = None
+        self.deflater = None
+        if self.server.deflate_level is not None:
+            self._deflate = negotiate(self.environ.get("HTTP_SEC_WEBSOCKET_EXTENSIONS"),
+                                      self.server.deflate_window_bits)
+        return WebSocketHandler.upgrade_connection(self)
+
+    def start_response(self, status, headers, exc_info=None):
+        """
+        握手成功的时候在回复里面带上协商好的扩展，同时把刚创建的WebSocket转换为DeflateWebSocket，
+        不替换成新的对象是因为WebSocket在__del__里面会发送close帧
+        """
+        if status.startswith("101") and getattr(self, "_deflate", None) is not None:
+            extension, window_bits, reset = self._deflate
+            headers.append(("Sec-WebSocket-Extensions", extension))
+            self.deflater = Deflater(self.server.deflate_level, window_bits, reset, self.server.deflate_min_bytes)
+            self.websocket.__class__ = DeflateWebSocket
+        return WebSocketHandler.start_response(self, status, headers, exc_info)
+
+
+class DeflateWebSocketServer(WebSocketServer):
+    """
+    :param deflate_level:        压缩级别，None表示不使用压缩
+    :param deflate_window_bits:  服务器这边压缩的窗口大小
+    :param deflate_min_bytes:    超过这么多字节的消息才压缩
+    """
+    handler_class = DeflateHandler
+
+    def __init__(self, *args, **kwargs):
+        self.deflate_level = kwargs.pop("deflate_level", DEFAULT_LEVEL)
+        self.deflate_window_bits = kwargs.pop("deflate_window_bits", DEFAULT_WINDOW_BITS)
+        self.deflate_min_bytes = kwargs.pop("deflate_min_bytes", DEFAULT_MIN_BYTES)
+        WebSocketServer.__init__(self, *args, **kwargs)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+import os
+import errno
+
+
+READ_SIZE = 256 * 1024             # 每次从文件描述符读取的数据大小
+MAX_READ_ONCE = 4 * 1024 * 1024    # 一次read最多读取这么多数据，防止文件突然增长太多的时候一次占用太多内存
+MAX_LINE_SIZE = 1024 * 1024        # 半行数据超过这么长还没有遇到换行符，那么直接当成一行输出
+BACK_READ_SIZE = 64 * 1024         # 从文件尾部往回查找行的时候，每次读取的数据大小
+TAIL_LINES = 10                    # 与tail -f保持一致，刚开始跟踪的时候先输出最后10行
+
+
+def find_tail_offset(fd, size, lines):
+    """
+    从文件的尾部往回读取，找到最后lines行的起始偏移
+
+    注意：如果文件最后并没有以换行符结尾，那么最后那半行并不算在lines里面
+    :param fd:     文件描述符
+    :param size:   文件的大小
+    :param lines:  需要的行数
+    :return:       最后lines行数据的起始偏移
+    """
+    if lines <= 0 or size <= 0:
+        return size
+    end = size
+    need = lines + 1                                 # 需要找到lines + 1个换行符才能确定起始位置
+    while end > 0:
+        start = max(0, end - BACK_READ_SIZE)
+        os.lseek(fd, start, os.SEEK_SET)
+        data = os.read(fd, end - start)
+        if not data:
+            break
+        if end == size and data[-1] != "\n":
+            need -= 1                                 # 最后的半行数据并不需要换行符来结束
+        index = len(data)
+        while need > 0:
+            index = data.rfind("\n", 0, index)
+            if index < 0:
+                break
+            need -= 1
+        if need == 0:
+            return start + index + 1
+        end = start
+    return 0
+
+
+def read_tail(log_path, lines, max_bytes):
+    """
+    从文件的尾部往回读取最后lines行，最多max_bytes字节，最后没有换行符的半行不算在里面，
+    超过了max_bytes的话只返回最后那些完整的行
+    :return:  (行的列表, 这些行在文件中的结束偏移)，文件不存在的话返回 ([], None)
+    """
+    try:
+        fd = os.open(log_path, os.O_RDONLY)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return [], None
+        raise
+    try:
+        size = os.fstat(fd).st_size
+        start = find_tail_offset(fd, size, lines)
+        clipped = start < size - max_bytes
+        if clipped:
+            start = size - max_bytes
+        os.lseek(fd, start, os.SEEK_SET)
+        data = os.read(fd, size - start)
+    finally:
+        os.close(fd)
+    end = data.rfind("\n") + 1
+    out = data[:end].splitlines(True)
+    if clipped and out:
+        out.pop(0)                                      # 从一行的中间开始的，丢掉这半行
+    return out, start + end
+
+
+class FileFollower(object):
+    """
+    在进程内部跟踪一个文件追加的数据，用来替代原来为每一个查看者启动的tail -f子进程
+
+    （1）直接通过文件描述符大块的读取新追加的数据，然后一次性的切分成行，没有逐行的系统调用
+    （2）通过记录inode和文件大小来检测日志的切割和截断，切割之后会把老文件剩下的数据读完再重新打开新的文件
+    （3）并不自己阻塞等待，由上层代码定期的调用read方法来获取新的数据
+    """
+    def __init__(self, log_path, tail_lines=TAIL_LINES):
+        """
+        :param log_path:    需要跟踪的文件路径
+        :param tail_lines:  第一次打开文件的时候先输出的最后多少行，与tail -f的行为一致
+        """
+        object.__init__(self)
+        self._log_path = log_path
+        self._tail_lines = tail_lines
+        self._fd = None                    # 当前打开的文件描述符
+        self._ino = None                   # 当前打开的文件的inode，用于检测日志切割
+        self._offset = 0                   # 已经从文件中读取到的位置
+        self._remain = ""                  # 还没有遇到换行符的半行数据
+        self._opened_once = False          # 是否已经打开过文件，只有第一次打开的时候才需要从尾部开始
+        self._position = None              # 已经返回出去的数据在整个数据流中的结束位置
+
+    @property
+    def log_path(self):
+        return self._log_path
+
+    @property
+    def offset(self):
+        """
+        已经以完整行的形式返回出去的数据在当前文件中的结束偏移
+        """
+        return self._offset - len(self._remain)
+
+    @property
+    def position(self):
+        """
+        已经返回出去的数据在整个数据流中的结束位置，文件还没有打开过的时候为None
+
+        刚开始的时候与文件偏移一致，之后每返回一行就增加这一行的长度，日志切割或者截断之后也会继续增长，
+        所以这个位置是一直递增的，上层可以用它来标记数据流中的位置
+        """
+        return self._position
+
+    def _open(self):
+        """
+        打开需要跟踪的文件，如果是第一次打开，那么从最后几行开始，否则说明是切割之后的新文件，从头开始读
+        :return: 文件不存在的时候返回False
+        """
+        try:
+            fd = os.open(self._log_path, os.O_RDONLY)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False                                    # 文件暂时还不存在，例如刚好在切割的过程中
+            raise
+        st = os.fstat(fd)
+        if self._opened_once:
+            offset = 0
+        else:
+            offset = find_tail_offset(fd, st.st_size, self._tail_lines)
+            self._position = offset
+        os.lseek(fd, offset, os.SEEK_SET)
+        self._fd, self._ino, self._offset = fd, st.st_ino, offset
+        self._opened_once = True
+        return True
+
+    def _rotated(self):
+        """
+        通过路径上面文件的inode与当前打开的文件的inode比较，判断文件是否已经被切割了
+        """
+        try:
+            return os.stat(self._log_path).st_ino != self._ino
+        except OSError:
+            return True                                         # 原来的文件已经被移走了，新的还没有创建
+
+    def _read_to(self, size, out):
+        """
+        将当前文件描述符中的数据读取到size的位置，读取的数据块放到out里面
+        :return: 这次读取的数据的长度
+        """
+        total = 0
+        while self._offset < size and total < MAX_READ_ONCE:
+            data = os.read(self._fd, min(READ_SIZE, size - self._offset))
+            if not data:
+                break
+            out.append(data)
+            self._offset += len(data)
+            total += len(data)
+        return total
+
+    def _split(self, chunks):
+        """
+        将读取到的数据块一次性的切分成行，最后不完整的那一行保存起来等待下次读取
+        """
+        if not chunks:
+            return []
+        data = self._remain + "".join(chunks) if self._remain else "".join(chunks)
+        index = data.rfind("\n")
+        if index < 0:
+            if len(data) > MAX_LINE_SIZE:                       # 实在太长了，直接当做一行输出
+                self._remain = ""
+                self._position += len(data)
+                return [data]
+            self._remain = data
+            return []
+        self._remain = data[index + 1:]
+        self._position += index + 1
+        return data[:index + 1].splitlines(True)
+
+    def read(self):
+        """
+        读取文件新追加的数据，返回完整的行的列表，没有新的数据的话返回空列表
+
+        （1）如果文件大小比已经读到的位置还小，说明文件被截断了，那么从头开始读
+        （2）读到文件尾部之后检查一下文件是否已经被切割，如果切割了，那么将半行数据也输出，然后打开新的文件
+        """
+        if self._fd is None and not self._open():
+            return []
+        chunks = []
+        size = os.fstat(self._fd).st_size
+        if size < self._offset:                                 # 文件被截断了
+            self._offset, self._remain = 0, ""
+            os.lseek(self._fd, 0, os.SEEK_SET)
+        self._read_to(size, chunks)
+        if self._offset >= size and self._rotated():
+            self._read_to(os.fstat(self._fd).st_size, chunks)  # 把老文件最后写入的数据读完
+            lines = self._split(chunks)
+            if self._remain:
+                lines.append(self._remain)
+                self._position += len(self._remain)
+                self._remain = ""
+            self._close_fd()
+            if self._open():
+                chunks = []
+                self._read_to(os.fstat(self._fd).st_size, chunks)
+                lines.extend(self._split(chunks))
+            return lines
+        return self._split(chunks)
+
+    def _close_fd(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+            self._ino = None
+
+    def close(self):
+        """
+        关闭打开的文件，释放资源
+        """
+        self._close_fd()
+        self._remain = ""
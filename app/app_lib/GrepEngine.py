@@ -0,0 +1,765 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+from app_lib.LogIndex import last_time, find_time
+from app_lib.IoLimit import io_wait, advise_sequential, drop_cache, DROP_MIN_BYTES
+from contextlib import closing
+from collections import OrderedDict
+import sre_parse
+import gzip
+import bz2
+import os
+import re
+import mmap
+
+
+CHUNK_SIZE = 1024 * 1024          # 每次扫描的数据块的大小，每扫描完一块都会让出一次协程
+REGEX_SPECIAL = ".^$*+?{}[]\\|()"  # 正则表达式里面有特殊含义的字符
+COMPRESSED_SUFFIXES = (".gz", ".bz2")
+REGEX_CACHE_SIZE = 256            # 最多缓存这么多个编译好的正则
+PATTERN_CACHE_SIZE = 64           # 最多缓存这么多个Pattern
+
+_regex_cache = OrderedDict()      # (正则, flags) 与编译好的正则的关联，按照最近使用的顺序排列
+_pattern_cache = OrderedDict()    # (查找的内容, 忽略大小写, 按字符串查找) 与Pattern的关联
+
+
+def is_compressed(path):
+    return path.endswith(COMPRESSED_SUFFIXES)
+
+
+def open_stream(path):
+    """
+    打开一个文件用于顺序的读取，压缩过的文件在读取的时候解压
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.BZ2File(path, "rb")
+    return open(path, "rb")
+
+
+def _lru_get(cache, key, create, size):
+    value = cache.pop(key, None)
+    if value is None:
+        value = create()
+    cache[key] = value                                          # 移到最后，表示最近使用过
+    while len(cache) > size:
+        cache.popitem(last=False)
+    return value
+
+
+def compile_regex(source, flags=0):
+    """
+    编译正则表达式，编译好的正则按照LRU缓存起来，所有的查找共用，
+    re模块自己的缓存满了之后是整个清空的，查找的条件比较多的时候经常需要重新编译
+    """
+    return _lru_get(_regex_cache, (source, flags), lambda: re.compile(source, flags), REGEX_CACHE_SIZE)
+
+
+_CATEGORY_CHARS = {
+    sre_parse.CATEGORY_DIGIT: frozenset(ord(c) for c in "0123456789"),
+    sre_parse.CATEGORY_WORD: frozenset(ord(c) for c in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_"),
+    sre_parse.CATEGORY_SPACE: frozenset(ord(c) for c in " \t\n\r\f\v"),
+}
+
+
+def _union(a, b):
+    """
+    None表示可能是任意的字符
+    """
+    if a is None or b is None:
+        return None
+    return a | b
+
+
+def _overlap(a, b):
+    if a is None:
+        return b is None or bool(b)
+    if b is None:
+        return bool(a)
+    return bool(a & b)
+
+
+def _first(items, flags):
+    """
+    分析正则解析出来的一段可能出现的第一个字符，只用于check_backtracking，分析不了的都当作任意字符
+    :return:  (第一个字符的集合，None表示任意字符, 这一段是否可以为空)
+    """
+    chars = frozenset()
+    for op, av in items:
+        nullable = False
+        if op == sre_parse.LITERAL:
+            first = frozenset([av])
+            if flags & re.IGNORECASE and av < 128:
+                first = frozenset([ord(chr(av).lower()), ord(chr(av).upper())])
+        elif op == sre_parse.IN:
+            first = frozenset()
+            for in_op, in_av in av:
+                if in_op == sre_parse.LITERAL:
+                    first = _union(first, _first([(in_op, in_av)], flags)[0])
+                elif in_op == sre_parse.RANGE and in_av[1] - in_av[0] <= 256 and not flags & re.IGNORECASE:
+                    first = _union(first, frozenset(xrange(in_av[0], in_av[1] + 1)))
+                elif in_op == sre_parse.CATEGORY and in_av in _CATEGORY_CHARS:
+                    first = _union(first, _CATEGORY_CHARS[in_av])
+                else:
+                    first = None                                # 取反或者分析不了的字符集
+        elif op == sre_parse.SUBPATTERN:
+            first, nullable = _first(av[1], flags)
+        elif op == sre_parse.BRANCH:
+            first = frozenset()
+            for branch in av[1]:
+                branch_first, branch_nullable = _first(branch, flags)
+                first = _union(first, branch_first)
+                nullable = nullable or branch_nullable
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            first, nullable = _first(av[2], flags)
+            nullable = nullable or av[0] == 0
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            first, nullable = frozenset(), True                 # 不占用字符
+        elif op in (sre_parse.NOT_LITERAL, sre_parse.ANY):
+            first = None
+        else:
+            first, nullable = None, True
+        chars = _union(chars, first)
+        if not nullable:
+            return chars, False
+    return chars, True
+
+
+def check_backtracking(content, flags=0):
+    """
+    检查正则里面是否有嵌套的无限重复，例如 (a+)+  (\\w+\\s?)*  (.*)*，这种正则在不匹配的行上面回溯的次数是指数级的，
+    python的正则是没法中途打断的，一个这样的正则就可以让整个进程卡住，所以直接拒绝
+
+    判断的方法：一个无限的重复里面也有无限的重复，而且除了这些重复之外的部分都可以不出现，
+    那么同样的一段数据就可以有非常多种拆分方式，像 (\\w+\\.)+ 这种每一次重复都必须有一个分隔符的就没有问题
+
+    另外一种是无限的重复里面的分支可以匹配同样的开头，例如 (a|aa)+  (a|a?)+，同样可以有指数级的拆分方式，
+    这里按每一个分支可能出现的第一个字符来判断，可以为空的分支还要算上它后面的内容，判断不了的字符都当作会重叠
+    :raise ValueError:  有嵌套的无限重复，或者重复里面的分支有重叠
+    """
+    parsed = sre_parse.parse(content, flags)
+
+    def _unbounded(op, av):
+        return op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[1] == sre_parse.MAXREPEAT
+
+    def _ambiguous(items):
+        found = False
+        for op, av in items:
+            if _unbounded(op, av):
+                found = True
+            elif op == sre_parse.SUBPATTERN and _ambiguous(av[1]):
+                found = True
+            elif op == sre_parse.BRANCH and any(_ambiguous(branch) for branch in av[1]):
+                found = True
+            elif sre_parse.SubPattern(parsed.pattern, [(op, av)]).getwidth()[0] > 0:
+                return False                                    # 每一次重复都必须出现的部分
+        return found
+
+    def _overlapping(items, follow):
+        """
+        items里面是否有分支的两个选项可能以同一个字符开始，follow是items后面可能出现的第一个字符
+        """
+        for i, (op, av) in enumerate(items):
+            rest, nullable = _first(items[i + 1:], flags)
+            after = _union(rest, follow) if nullable else rest
+            if op == sre_parse.BRANCH:
+                starts = []
+                for branch in av[1]:
+                    chars, empty = _first(branch, flags)
+                    starts.append(_union(chars, after) if empty else chars)
+                for j in xrange(len(starts)):
+                    if any(_overlap(starts[j], other) for other in starts[j + 1:]):
+                        return True
+                if any(_overlapping(branch, after) for branch in av[1]):
+                    return True
+            elif op == sre_parse.SUBPATTERN and _overlapping(av[1], after):
+                return True
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and \
+                    _overlapping(av[2], _union(_first(av[2], flags)[0], after)):
+                return True
+        return False
+
+    def _check(items):
+        for op, av in items:
+            if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+                if _unbounded(op, av) and _ambiguous(av[2]):
+                    raise ValueError("nested quantifier may cause catastrophic backtracking: %s" % content)
+                if _unbounded(op, av) and _overlapping(av[2], _first(av[2], flags)[0]):
+                    raise ValueError("overlapping alternation may cause catastrophic backtracking: %s" % content)
+                _check(av[2])
+            elif op == sre_parse.SUBPATTERN:
+                _check(av[1])
+            elif op == sre_parse.BRANCH:
+                for branch in av[1]:
+                    _check(branch)
+    _check(parsed)
+
+
+def required_literal(content):
+    """
+    从正则表达式中找出一段匹配的行里面一定会出现的字符串，用来在执行正则之前先用字符串查找做一次过滤
+
+    这里只处理最常见的情况，分析不了的直接返回None，那么就只能每一行都执行正则了：
+    （1）有|或者(?i)之类的扩展语法的话，直接放弃
+    （2）括号以及[]里面的内容都跳过，只取最外层的字符
+    （3）后面跟着*?{的字符不一定出现，需要从当前这一段里面去掉
+    :param content:  正则表达式
+    :return:         最长的那一段一定会出现的字符串，没有的话返回None
+    """
+    if "|" in content or "(?" in content:
+        return None
+    best, run = "", []
+    depth, index, size = 0, 0, len(content)
+
+    def _cut():
+        return "".join(run) if len("".join(run)) > len(best) else best
+
+    while index < size:
+        c = content[index]
+        if c == "\\" and index + 1 < size:
+            n = content[index + 1]
+            index += 2
+            if depth == 0 and not n.isalnum():
+                run.append(n)                                   # 转义的标点符号就是它自己
+            else:
+                best, run = _cut(), []                          # \d \w之类的字符集合
+            continue
+        index += 1
+        if c == "[":
+            best, run = _cut(), []
+            if index < size and content[index] == "^":
+                index += 1
+            if index < size and content[index] == "]":
+                index += 1                                      # []]这种写法，第一个]是普通字符
+            while index < size and content[index] != "]":
+                index += 2 if content[index] == "\\" else 1
+            index += 1
+        elif c in "*?{":
+            if run:
+                run.pop()                                       # 前面那个字符可以不出现
+            best, run = _cut(), []
+            if c == "{":
+                while index < size and content[index] != "}":
+                    index += 1
+                index += 1
+        elif c == "(":
+            best, run = _cut(), []
+            depth += 1
+        elif c == ")":
+            depth = max(0, depth - 1)
+            best, run = _cut(), []
+        elif c in REGEX_SPECIAL:
+            best, run = _cut(), []
+        elif depth == 0:
+            run.append(c)
+    best = _cut()
+    return best or None
+
+
+class Pattern(object):
+    """
+    编译好的查找条件，在进程内部对一大块数据进行查找，找出所有匹配的行
+
+    content按照python的正则表达式来处理，如果不是一个合法的正则，那么当成普通的字符串，
+    如果content里面本来就没有正则的特殊字符，那么直接使用字符串查找，不需要执行正则，
+    有嵌套的无限重复的正则会被拒绝，参考check_backtracking
+
+    Pattern创建之后不会再变化，所以通过create_pattern创建的会被缓存起来共用
+    """
+    def __init__(self, content, ignore_case=False, fixed=False):
+        """
+        :param content:      需要查找的内容
+        :param ignore_case:  是否忽略大小写
+        :param fixed:        为True的话将content当做普通的字符串，不当做正则表达式
+        """
+        object.__init__(self)
+        self._content = content
+        flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+        if not fixed and not any(c in REGEX_SPECIAL for c in content):
+            fixed = True
+        if not fixed:
+            try:
+                self._regex = compile_regex(content, flags)
+            except re.error:
+                fixed = True
+            else:
+                check_backtracking(content, flags)
+        self._risky = not fixed
+        self._source = re.escape(content) if fixed else content
+        if fixed:
+            self._literal = content
+            self._regex = compile_regex(self._source, flags) if ignore_case else None
+        else:
+            self._literal = required_literal(content)
+        self._required = self._literal
+        if ignore_case:
+            self._literal = None                                # 忽略大小写的时候没法直接用字符串查找来过滤
+
+    @property
+    def content(self):
+        return self._content
+
+    @property
+    def source(self):
+        """
+        实际使用的正则表达式，按字符串查找的时候是转义之后的content
+        """
+        return self._source
+
+    @property
+    def risky(self):
+        """
+        是否需要执行用户的正则，这样的查找可能会很慢，需要放到子进程里面执行，参考ParallelScanner
+        """
+        return self._risky
+
+    @property
+    def literal(self):
+        """
+        用于预先过滤的字符串，None表示没有
+        """
+        return self._literal
+
+    @property
+    def required(self):
+        """
+        匹配的行里面一定会出现的字符串，不过忽略大小写的时候只是在忽略大小写之后一定会出现，可以用来查询不区分大小写的索引
+        """
+        return self._required
+
+    def match_line(self, line):
+        """
+        判断一行数据是否匹配
+        """
+        if self._literal is not None and self._literal not in line:
+            return False
+        return self._regex is None or self._regex.search(line) is not None
+
+    def record(self, offset, line_no, line):
+        """
+        scanner找到一个匹配的行之后，通过这个方法生成这一行的结果，参考FileScanner
+        """
+        return offset, line_no, line
+
+    def scan(self, data, pos=0, end=None):
+        """
+        在一大块数据里面查找所有匹配的行，data里面的数据需要是按行对齐的
+
+        先用字符串查找或者正则在整块数据上面找到一个可能的位置，然后再确认这个位置所在的那一行是否真的匹配，
+        这样子大部分不匹配的行都不需要单独处理
+        :param data:  需要查找的数据
+        :param pos:   开始查找的位置，需要是一行的开头
+        :param end:   结束查找的位置
+        :return:      生成器，每一个匹配的行的 (起始位置, 结束位置)，结束位置包含换行符
+        """
+        if end is None:
+            end = len(data)
+        literal, regex = self._literal, self._regex
+        while pos < end:
+            if literal is not None:
+                hit = data.find(literal, pos, end)
+            else:
+                m = regex.search(data, pos, end)
+                hit = -1 if m is None else m.start()
+            if hit < 0:
+                break
+            line_start = data.rfind("\n", pos, hit) + 1 or pos
+            line_end = data.find("\n", hit, end)
+            line_end = end if line_end < 0 else line_end + 1
+            if regex is None or literal is None and m.end() < line_end:
+                yield line_start, line_end
+            else:
+                stop = line_end - 1 if data[line_end - 1:line_end] == "\n" else line_end
+                if regex.search(data, line_start, stop) is not None:
+                    yield line_start, line_end
+            pos = line_end
+
+
+class MultiPattern(Pattern):
+    """
+    同时查找多个条件，一行匹配其中任意一个就算匹配，多个条件共用一次文件的读取，每一块数据在内存中查找：
+    （1）字符串的条件，以及可以找出一定会出现的字符串的正则：每一个都直接在整块数据上面做字符串查找，
+        这个是在C里面执行的，比在python里面逐个字节的跑Aho-Corasick自动机快很多
+    （2）其他的正则：合并成一个 (?:a)|(?:b)|... 的正则，整块数据只需要执行一次
+    最后把所有匹配的行按照位置合并起来，找到匹配的行之后，再用每一个条件单独的确认一下这一行匹配了哪几个条件，参考record
+    """
+    def __init__(self, contents, ignore_case=False, fixed=False):
+        """
+        :param contents:  需要查找的内容的列表
+        """
+        if not contents:
+            raise ValueError("empty pattern list")
+        object.__init__(self)
+        self._patterns = [Pattern(content, ignore_case, fixed) for content in contents]
+        self._content = list(contents)
+        self._risky = any(pattern.risky for pattern in self._patterns)
+        self._source = "|".join("(?:%s)" % pattern.source for pattern in self._patterns)
+        self._literal = self._required = None                  # 没有一定会出现的字符串
+        self._literals = [pattern for pattern in self._patterns if pattern.literal is not None]
+        sources = ["(?:%s)" % pattern.source for pattern in self._patterns if pattern.literal is None]
+        flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+        self._regex = compile_regex("|".join(sources), flags) if sources else None
+
+    @property
+    def patterns(self):
+        return self._patterns
+
+    def match_line(self, line):
+        return any(pattern.match_line(line) for pattern in self._patterns)
+
+    def tags(self, line):
+        """
+        :return:  这一行匹配的条件的下标的列表
+        """
+        out = []
+        for index, pattern in enumerate(self._patterns):
+            literal, regex = pattern._literal, pattern._regex     # 与match_line一样，这里展开是因为每一个匹配的行都要执行
+            if literal is not None and literal not in line:
+                continue
+            if regex is None or regex.search(line) is not None:
+                out.append(index)
+        return out
+
+    def record(self, offset, line_no, line):
+        """
+        结果的附加信息里面带上这一行匹配了哪几个条件，这里会执行每一个用户的正则，
+        所以是在scanner里面找到匹配的行的时候就确认，有用户的正则的查找都在子进程里面，不会卡住当前进程
+        """
+        return offset, line_no, line, {"tags": self.tags(line)}
+
+    def scan(self, data, pos=0, end=None):
+        hits = dict(Pattern.scan(self, data, pos, end)) if self._regex is not None else {}
+        for pattern in self._literals:
+            hits.update(pattern.scan(data, pos, end))
+        for line_start in sorted(hits):
+            yield line_start, hits[line_start]
+
+
+def encode_content(content):
+    """
+    web端带上来的查找条件经过json之后是unicode，而日志的数据是字节，两者直接比较的时候会按ascii解码日志的数据，
+    遇到非ascii的行就会出错，所以查找之前统一编码为utf-8，content为列表的话每一个条件都编码
+    """
+    if isinstance(content, unicode):
+        return content.encode("utf-8")
+    if isinstance(content, (list, tuple)):
+        return [encode_content(item) for item in content]
+    return content
+
+
+def create_pattern(content, ignore_case=False, fixed=False):
+    """
+    content为列表的话创建一个MultiPattern，否则创建一个Pattern，同样的条件直接返回缓存的
+    """
+    if isinstance(content, (list, tuple)):
+        content = tuple(content)
+        create = lambda: MultiPattern(content, ignore_case, fixed)
+    else:
+        create = lambda: Pattern(content, ignore_case, fixed)
+    return _lru_get(_pattern_cache, (content, ignore_case, fixed), create, PATTERN_CACHE_SIZE)
+
+
+class FileScanner(object):
+    """
+    按块顺序读取文件中的一段数据进行查找，每一块都是按行对齐的
+
+    读取受IoLimit的预算限制，扫描的数据比较多的话，扫描过的块会从page cache里面丢掉，不会挤掉机器上其他服务的缓存，
+    所以这里没有用mmap，mmap映射着的页面是没法丢掉的
+
+    查找的结果按块返回，每一个匹配的行为 (行在文件中的偏移, 行号, 行的数据)，
+    行号从开始查找的位置算起，第一行为1，如果是从文件的中间开始查找，那么上层需要自己加上前面的行数
+    """
+    def __init__(self, log_path, pattern, start=0, end=None, chunk_size=CHUNK_SIZE):
+        """
+        :param log_path:    需要查找的文件
+        :param pattern:     Pattern对象
+        :param start:       开始查找的偏移，如果不是一行的开头，那么从下一行开始
+        :param end:         结束查找的偏移，None表示查找到打开文件的时候文件的末尾
+        :param chunk_size:  每一块数据的大小
+        """
+        object.__init__(self)
+        self._log_path = log_path
+        self._pattern = pattern
+        self._start = start
+        self._end = end
+        self._chunk_size = chunk_size
+        self._lines = 0                     # 已经扫描过的行数
+        self._position = start              # 已经扫描到的位置
+        self._scanned = 0                   # 已经扫描过的字节数
+
+    @property
+    def lines(self):
+        """
+        已经扫描过的完整的行的数量
+        """
+        return self._lines
+
+    @property
+    def position(self):
+        """
+        已经扫描到的位置
+        """
+        return self._position
+
+    @property
+    def scanned(self):
+        """
+        已经扫描过的字节数
+        """
+        return self._scanned
+
+    def batches(self):
+        """
+        生成器，每扫描完一块数据返回这一块中所有匹配的行的列表，没有匹配的块返回空列表，
+        调用方可以在每一块之间让出协程或者检查是否需要停止
+        """
+        with open(self._log_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if self._end is None else min(self._end, size)
+            if self._start >= end:
+                return
+            if self._start > 0:
+                f.seek(self._start - 1)
+                if f.read(1) != "\n":
+                    f.readline()                                    # 从下一行开始
+                    self._start = self._position = min(f.tell(), end)
+            advise_sequential(f.fileno())
+            for batch in self._scan(f, end):
+                yield batch
+
+    def _scan(self, f, end):
+        pattern = self._pattern
+        pos = self._start
+        drop = end - pos >= DROP_MIN_BYTES
+        f.seek(pos)
+        while pos < end:
+            data = f.read(min(self._chunk_size, end - pos))
+            if not data:
+                break
+            if pos + len(data) < end:
+                data = (data + f.readline())[:end - pos]            # 按行对齐
+            stop = pos + len(data)
+            out = []
+            last, line_no = 0, self._lines
+            for line_start, line_end in pattern.scan(data):
+                line_no += data.count("\n", last, line_start)
+                last = line_start
+                out.append(pattern.record(pos + line_start, line_no + 1, data[line_start:line_end]))
+            self._lines += data.count("\n")
+            self._scanned += len(data)
+            if drop:
+                drop_cache(f.fileno(), pos, len(data))
+            self._position = pos = stop
+            io_wait(len(data))
+            yield out
+
+
+class ReverseScanner(object):
+    """
+    从文件的末尾往前按块查找，每一块都是按行对齐的，块里面匹配的行也是从后往前返回的，所以结果是从新到老的，
+    只需要最近的几条结果的时候，上层拿到足够的行之后直接关闭生成器就好了，不管文件有多大，都只需要读取最后的几块
+
+    往前查找没法知道一行前面有多少行，所以行号是通过end那一行的行号往前推算的，不知道的话为负数，-1表示最后一个完整的行
+    """
+    def __init__(self, log_path, pattern, start=0, end=None, end_line=None, chunk_size=CHUNK_SIZE):
+        """
+        :param start:     查找到哪个偏移为止，如果不是一行的开头，那么从下一行开始
+        :param end:       从哪个偏移开始往前查找，None表示打开文件的时候文件的末尾
+        :param end_line:  end所在的那一行的行号，也就是end之前的行数加一，None表示不知道
+        """
+        object.__init__(self)
+        self._log_path = log_path
+        self._pattern = pattern
+        self._start = start
+        self._end = end
+        self._end_line = end_line or 0
+        self._chunk_size = chunk_size
+        self._lines = 0                     # 已经扫描过的行数
+        self._position = end                # 已经往前扫描到的位置
+        self._scanned = 0
+
+    @property
+    def lines(self):
+        return self._lines
+
+    @property
+    def position(self):
+        return self._position
+
+    @property
+    def scanned(self):
+        return self._scanned
+
+    def batches(self):
+        with open(self._log_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if self._end is None else min(self._end, size)
+            if self._start >= end:
+                return
+            mm = mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ)
+            try:
+                start = self._start
+                if start > 0 and mm[start - 1] != "\n":
+                    index = mm.find("\n", start, end)
+                    start = end if index < 0 else index + 1
+                for batch in self._scan(mm, start, end):
+                    yield batch
+            finally:
+                mm.close()
+
+    def _scan(self, mm, start, end):
+        pos = end
+        while pos > start:
+            block_start = max(start, pos - self._chunk_size)
+            if block_start > start:
+                block_start = mm.rfind("\n", start, block_start) + 1 or start     # 按行对齐
+            data = mm[block_start:pos]
+            out = []
+            after, last = self._lines, len(data)            # after为一行的开头到end之间的换行符的数量
+            for line_start, line_end in reversed(list(self._pattern.scan(data))):
+                after += data.count("\n", line_start, last)
+                last = line_start
+                out.append(self._pattern.record(block_start + line_start, self._end_line - after,
+                                                data[line_start:line_end]))
+            self._lines += data.count("\n")
+            self._scanned += len(data)
+            self._position = pos = block_start
+            io_wait(len(data))
+            yield out
+
+
+class RangeScanner(object):
+    """
+    只查找文件中的某几段数据，例如通过索引过滤之后可能匹配的那几块，接口与FileScanner一致
+
+    每一段都需要知道它前面有多少行，这样子返回的行号就是文件中真实的行号
+    """
+    def __init__(self, log_path, pattern, ranges, chunk_size=CHUNK_SIZE):
+        """
+        :param ranges:  [(起始偏移, 结束偏移, 之前的行数)]，按照偏移排好序，每一段都是按行对齐的
+        """
+        object.__init__(self)
+        self._log_path = log_path
+        self._pattern = pattern
+        self._ranges = ranges
+        self._chunk_size = chunk_size
+        self._lines = 0
+        self._position = ranges[0][0] if ranges else 0
+        self._scanned = 0
+
+    @property
+    def lines(self):
+        return self._lines
+
+    @property
+    def position(self):
+        return self._position
+
+    @property
+    def scanned(self):
+        return self._scanned
+
+    def batches(self):
+        scanned = 0
+        for start, end, lines in self._ranges:
+            scanner = FileScanner(self._log_path, self._pattern, start, end, self._chunk_size)
+            for batch in scanner.batches():
+                if lines:
+                    batch = [(record[0], record[1] + lines) + record[2:] for record in batch]
+                self._lines = lines + scanner.lines
+                self._position = scanner.position
+                self._scanned = scanned + scanner.scanned
+                yield batch
+            scanned += scanner.scanned
+
+
+class StreamScanner(object):
+    """
+    用于查找压缩过的文件（.gz/.bz2），这种文件没法mmap，也没法随机访问，只能从头开始按块解压，然后按行对齐之后查找，
+    接口与FileScanner一致，偏移和行号都是解压之后的数据里面的，行号从文件的开头算起
+
+    通过parser/since/until可以只查找一个时间窗口里面的行，与按时间定位一样，前提是日志基本上是按时间顺序追加的：
+    最后一行都早于since的块直接跳过，遇到第一个不早于until的行就停止了
+    """
+    def __init__(self, log_path, pattern, parser=None, since=None, until=None, chunk_size=CHUNK_SIZE):
+        """
+        :param log_path:  需要查找的文件
+        :param pattern:   Pattern对象
+        :param parser:    TimeParser，需要按时间窗口过滤的时候才需要
+        :param since:     时间窗口的开始，时间戳，None表示不限制
+        :param until:     时间窗口的结束，时间戳，None表示不限制
+        """
+        object.__init__(self)
+        self._log_path = log_path
+        self._pattern = pattern
+        self._parser = parser
+        self._since = since if parser is not None else None
+        self._until = until if parser is not None else None
+        self._chunk_size = chunk_size
+        self._lines = 0
+        self._position = 0
+        self._scanned = 0
+
+    @property
+    def lines(self):
+        return self._lines
+
+    @property
+    def position(self):
+        return self._position
+
+    @property
+    def scanned(self):
+        """
+        已经解压过的字节数
+        """
+        return self._scanned
+
+    def _window(self, data):
+        """
+        :return:  这一块数据里面需要查找的范围 (开始, 结束)，结束小于数据的长度表示已经过了时间窗口了
+        """
+        start, stop = 0, len(data)
+        if self._since is not None:
+            ts = last_time(self._parser, data)
+            if ts is None or ts < self._since:
+                return stop, stop
+            start = find_time(self._parser, data, self._since)
+            self._since = None                              # 之后的数据都不会早于since了
+        if self._until is not None:
+            ts = last_time(self._parser, data)
+            if ts is not None and ts >= self._until:
+                stop = find_time(self._parser, data, self._until, start)
+        return start, stop
+
+    def batches(self):
+        with closing(open_stream(self._log_path)) as f:
+            rest = ""
+            while True:
+                data = f.read(self._chunk_size)
+                if data:
+                    data = rest + data
+                    index = data.rfind("\n")
+                    if index < 0:
+                        rest = data
+                        continue
+                    data, rest = data[:index + 1], data[index + 1:]      # 按行对齐，剩下的留到下一块
+                elif rest:
+                    data, rest = rest, ""
+                else:
+                    break
+                start, stop = self._window(data)
+                pos, out = self._position, []
+                last, line_no = 0, self._lines
+                for line_start, line_end in self._pattern.scan(data, start, stop):
+                    line_no += data.count("\n", last, line_start)
+                    last = line_start
+                    out.append(self._pattern.record(pos + line_start, line_no + 1, data[line_start:line_end]))
+                self._lines += data.count("\n")
+                self._scanned += len(data)
+                self._position += len(data)
+                io_wait(len(data))
+                yield out
+                if stop < len(data):
+                    break
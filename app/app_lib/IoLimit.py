@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+import ctypes
+import ctypes.util
+import logging
+import time
+import os
+import gevent
+from gevent.monkey import get_original
+
+
+#
+# node和业务的服务跑在同一台机器上面，扫描大文件（查找，建立索引）的时候要尽量不影响机器上正在运行的服务：
+# （1）所有的扫描共享一个每秒读取的字节数的预算，超过了之后扫描的协程或者子进程等待一会
+# （2）顺序读取的时候通过posix_fadvise告诉内核是顺序读取的，扫描过的数据直接从page cache里面丢掉，
+#      不然扫描一遍大文件会把业务的服务用到的缓存都挤出去
+# （3）用于扫描的子进程可以降低cpu和io的优先级
+#
+# 这些都通过configure来设置，node启动的时候根据NodeConfig调用，没有调用的话都不生效
+#
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+DROP_MIN_BYTES = 64 * 1024 * 1024     # 扫描的数据超过这么多才从page cache里面丢掉，小文件留在缓存里面下次查找更快
+LOW_NICE = 10                         # 降低优先级的时候，子进程的nice值增加这么多
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3                 # 只有磁盘空闲的时候才会执行这个进程的io
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_SET = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30}    # ioprio_set的系统调用号，python里面没有封装
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+except OSError:
+    _libc = None
+
+
+class IoThrottle(object):
+    """
+    令牌桶，每秒补充rate个字节，最多积累一秒的量，rate为0表示不限制
+    """
+    def __init__(self, rate=0):
+        object.__init__(self)
+        self._rate = rate
+        self._allowance = rate
+        self._last = time.time()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def consume(self, nbytes):
+        """
+        :return:  读取了nbytes之后需要等待的秒数
+        """
+        if self._rate <= 0:
+            return 0
+        now = time.time()
+        self._allowance = min(self._rate, self._allowance + (now - self._last) * self._rate)
+        self._last = now
+        self._allowance -= nbytes
+        return -self._allowance / float(self._rate) if self._allowance < 0 else 0
+
+
+_throttle = IoThrottle()
+_drop_cache = False
+_low_priority = False
+_pid = os.getpid()                    # 调用configure的进程，fork出来的子进程里面等待的时候不能用gevent.sleep
+_blocking_sleep = get_original("time", "sleep")
+
+
+def configure(rate=0, drop_cache=False, low_priority=False):
+    """
+    :param rate:          所有的扫描每秒最多读取这么多字节，0表示不限制
+    :param drop_cache:    扫描过的大文件的数据是否从page cache里面丢掉
+    :param low_priority:  扫描的子进程是否降低cpu和io的优先级
+    """
+    global _throttle, _drop_cache, _low_priority, _pid
+    _throttle = IoThrottle(rate)
+    _drop_cache = drop_cache
+    _low_priority = low_priority
+    _pid = os.getpid()
+
+
+def share(count):
+    """
+    在fork出来的子进程里面调用，count个子进程同时扫描，每一个分到预算的1/count
+    """
+    global _throttle
+    if _throttle.rate > 0:
+        _throttle = IoThrottle(max(1, _throttle.rate / count))
+
+
+def io_wait(nbytes):
+    """
+    读取了nbytes之后调用，超过了预算的话等待一会，只会让出协程，不会阻塞进程里面其他的请求
+
+    注意：fork出来的扫描子进程里面复制了父进程的hub以及所有的协程，在子进程里面gevent.sleep的话，
+         父进程的TailSource，LogSender的推送以及定时器都会在子进程里面跑起来，共享的文件描述符和连接会被弄乱，
+         所以子进程里面直接阻塞的sleep，子进程本来就只做扫描这一件事情
+    """
+    delay = _throttle.consume(nbytes)
+    if delay > 0:
+        if os.getpid() == _pid:
+            gevent.sleep(delay)
+        else:
+            _blocking_sleep(delay)
+
+
+def _fadvise(fd, offset, length, advice):
+    if _libc is None:
+        return
+    _libc.posix_fadvise(fd, ctypes.c_int64(offset), ctypes.c_int64(length), advice)
+
+
+def advise_sequential(fd):
+    """
+    告诉内核这个文件是顺序读取的，预读会更积极一些
+    """
+    _fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+
+
+def drop_cache(fd, offset, length):
+    """
+    把文件中已经扫描过的一段数据从page cache里面丢掉，只在开启了drop_cache的时候有效
+    """
+    if _drop_cache and length > 0:
+        _fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+
+
+def lower_priority():
+    """
+    在扫描的子进程里面调用，开启了low_priority的话降低当前进程的cpu和io优先级，失败了也不影响扫描
+    """
+    if not _low_priority:
+        return
+    try:
+        os.nice(LOW_NICE)
+        number = IOPRIO_SET.get(os.uname()[4])         # platform.machine()会通过popen执行uname，在fork出来的子进程里面会失败
+        if _libc is not None and number is not None:
+            _libc.syscall(number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+    except EnvironmentError:
+        logging.error("降低扫描进程的优先级失败")
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+from bisect import bisect_right, bisect_left
+import time
+import re
+import os
+import gevent
+from app_lib.IoLimit import io_wait, advise_sequential, drop_cache, DROP_MIN_BYTES
+
+
+INDEX_BYTES = 512 * 1024           # 每隔这么多字节记录一个索引项，大概是几千行
+READ_SIZE = 4 * 1024 * 1024        # 建立索引的时候每次读取的数据大小
+TIME_LINES = 16                    # 索引项所在的行解析不出时间的话，最多再往后看这么多行
+SEARCH_BLOCK = 64 * 1024           # 二分查找时间的时候，每次读取的数据大小，范围小于这个的时候直接顺序查找
+DEFAULT_TIME_REGEX = r"(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})"
+DEFAULT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def to_timestamp(value):
+    """
+    将查询的时间转换为时间戳，可以是时间戳，也可以是 "2016-04-15 14:00:00" 这种格式的本地时间字符串
+    """
+    if isinstance(value, basestring):
+        return time.mktime(time.strptime(value.strip(), DEFAULT_TIME_FORMAT))
+    return float(value)
+
+
+def _first_time(parser, data, pos, end):
+    """
+    从pos这一行开始，找到第一个能解析出时间的行，最多看TIME_LINES行
+    :return:  (时间, 这一行的开头)，找不到的话返回 (None, None)
+    """
+    for _ in xrange(TIME_LINES):
+        if pos >= end:
+            break
+        line_end = data.find("\n", pos, end)
+        line_end = end if line_end < 0 else line_end + 1
+        ts = parser.parse(data[pos:line_end])
+        if ts is not None:
+            return ts, pos
+        pos = line_end
+    return None, None
+
+
+def last_time(parser, data):
+    """
+    从后往前找到一段按行对齐的数据里面最后一个能解析出时间的行，最多看TIME_LINES行
+    :return:  时间，找不到的话返回None
+    """
+    end = len(data)
+    for _ in xrange(TIME_LINES):
+        if end <= 0:
+            break
+        start = data.rfind("\n", 0, end - 1) + 1
+        ts = parser.parse(data[start:end])
+        if ts is not None:
+            return ts
+        end = start
+    return None
+
+
+def find_time(parser, data, ts, pos=0):
+    """
+    在一段按行对齐的数据里面顺序查找第一个时间不早于ts的行，解析不出时间的行会被跳过
+    :return:  这一行的开头，都比ts早的话返回数据的长度
+    """
+    while pos < len(data):
+        line_end = data.find("\n", pos) + 1 or len(data)
+        line_ts = parser.parse(data[pos:line_end])
+        if line_ts is not None and line_ts >= ts:
+            return pos
+        pos = line_end
+    return len(data)
+
+
+def search_time(log_path, parser, ts, start=0, end=None):
+    """
+    在文件的 [start, end) 范围内找到第一个时间不早于ts的行，不需要索引，直接在文件上面按字节二分查找，
+    每次在中间位置读取一小块数据，解析出中间位置之后第一个有时间的行，然后决定往哪边继续找
+
+    前提是日志基本上是按时间顺序追加的，解析不出时间的行（例如异常堆栈）会被跳过
+    :param start:  需要是一行的开头
+    :param end:    None表示文件的末尾
+    :return:       这一行的开头的偏移，都比ts早的话返回end
+    """
+    with open(log_path, "rb") as f:
+        if end is None:
+            end = os.fstat(f.fileno()).st_size
+        lo, hi = start, end                                 # 需要找的行的开头一定在 [lo, hi] 之间
+        while hi - lo > SEARCH_BLOCK:
+            mid = (lo + hi) / 2
+            f.seek(mid)
+            data = f.read(min(SEARCH_BLOCK, hi - mid))
+            index = data.find("\n")
+            line_ts, pos = _first_time(parser, data, index + 1, len(data)) if index >= 0 else (None, None)
+            if line_ts is None:
+                break                                       # 中间这一段都没有时间，只能顺序查找了
+            if line_ts < ts:
+                lo = mid + pos
+            else:
+                hi = mid + pos
+        f.seek(lo)
+        while lo < hi:
+            data = f.read(min(READ_SIZE, hi - lo))
+            if not data:
+                break
+            index = data.rfind("\n")
+            if index >= 0 and lo + len(data) < hi:
+                data = data[:index + 1]                     # 按行对齐
+            pos = 0
+            while pos < len(data):
+                line_ts, line_start = _first_time(parser, data, pos, len(data))
+                if line_ts is None:
+                    break
+                if line_ts >= ts:
+                    return lo + line_start
+                pos = data.find("\n", line_start) + 1 or len(data)
+            lo += len(data)
+            f.seek(lo)
+        return hi
+
+
+class TimeParser(object):
+    """
+    从日志行中解析出时间，返回本地时间的时间戳（秒）
+
+    先通过正则从行中找出时间的字符串（所有的分组用空格连接起来），然后通过time.strptime来解析，
+    日志中连续的行时间字符串大多是一样的，所以这里缓存一下上一次解析的结果
+    """
+    def __init__(self, time_regex=DEFAULT_TIME_REGEX, time_format=DEFAULT_TIME_FORMAT, search_size=128):
+        """
+        :param time_regex:   用于找出时间字符串的正则
+        :param time_format:  时间字符串的格式，与time.strptime一致
+        :param search_size:  只在每一行的前面这么多个字符里面找时间
+        """
+        object.__init__(self)
+        self._regex = re.compile(time_regex)
+        self._format = time_format
+        self._search_size = search_size
+        self._last = (None, None)
+
+    def parse(self, line):
+        """
+        :return:  时间戳，解析不出来的话返回None
+        """
+        m = self._regex.search(line, 0, self._search_size)
+        if m is None:
+            return None
+        value = " ".join(m.groups()) if m.groups() else m.group(0)
+        if value == self._last[0]:
+            return self._last[1]
+        try:
+            ts = time.mktime(time.strptime(value, self._format))
+        except (ValueError, OverflowError):
+            return None
+        self._last = (value, ts)
+        return ts
+
+
+class LogIndex(object):
+    """
+    为一个日志文件维护一个稀疏的索引，每隔INDEX_BYTES字节，在下一行的开头记录一个索引项：
+    (行在文件中的偏移, 行号, 这一行的时间)
+
+    索引是增量维护的，每次update只处理文件新增加的数据，文件被切割或者截断之后，索引直接作废然后重新建立
+
+    有了索引之后，按行号或者时间定位都只需要一次二分查找，再加上读取两个索引项之间的一小段数据
+    注意：按时间定位的前提是日志基本上是按时间顺序追加的，解析不出时间的索引项沿用前一项的时间
+    """
+    def __init__(self, log_path, parser=None):
+        object.__init__(self)
+        self._log_path = log_path
+        self._parser = parser or TimeParser()
+        self._reset()
+
+    def _reset(self):
+        self._ino = None
+        self._offset = 0                  # 已经建立索引的位置，总是一行的开头
+        self._lines = 0                   # _offset之前的行数
+        self._next = 0                    # 下一个索引项的位置（在这个位置之后的第一行的开头）
+        self._offsets = []                # 每一个索引项的偏移
+        self._line_nos = []               # 每一个索引项的行号
+        self._times = []                  # 每一个索引项的时间，解析不出来的沿用前一项，最前面的为0
+
+    @property
+    def log_path(self):
+        return self._log_path
+
+    @property
+    def parser(self):
+        return self._parser
+
+    @property
+    def offset(self):
+        """
+        已经建立了索引的位置
+        """
+        return self._offset
+
+    @property
+    def lines(self):
+        """
+        已经建立了索引的行数
+        """
+        return self._lines
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def update(self):
+        """
+        处理文件新增加的数据，每读取一块数据让出一次协程，需要在协程中执行，
+        第一次建立索引的时候需要读取整个文件，这时候读过的数据会从page cache里面丢掉，平时只是读取最后新写入的一小段
+        :return:  这次处理了多少字节
+        """
+        try:
+            st = os.stat(self._log_path)
+        except OSError:
+            return 0
+        if st.st_ino != self._ino or st.st_size < self._offset:
+            self._reset()                                   # 文件被切割或者截断了，重新建立
+            self._ino = st.st_ino
+        total = 0
+        with open(self._log_path, "rb") as f:
+            if os.fstat(f.fileno()).st_ino != self._ino:
+                return 0                                    # 刚好在切割，下次再说
+            drop = st.st_size - self._offset >= DROP_MIN_BYTES
+            if drop:
+                advise_sequential(f.fileno())
+            while self._offset < st.st_size:
+                f.seek(self._offset)
+                data = f.read(min(READ_SIZE, st.st_size - self._offset))
+                index = data.rfind("\n")
+                if index < 0:
+                    if len(data) < READ_SIZE:
+                        break                               # 最后的半行数据，等写完了再处理
+                    index = len(data) - 1
+                data = data[:index + 1]
+                if drop:
+                    drop_cache(f.fileno(), self._offset, len(data))
+                self._add(data)
+                total += len(data)
+                io_wait(len(data))
+                gevent.sleep(0)
+        return total
+
+    def _add(self, data):
+        """
+        处理一块按行对齐的数据，找出其中需要记录的索引项
+        """
+        base, lines, counted = self._offset, self._lines, 0
+        size = len(data)
+        while self._next - base < size:
+            target = self._next - base
+            if target <= 0:
+                line_start = 0
+            else:
+                line_start = data.find("\n", target - 1) + 1
+                if line_start <= 0 or line_start >= size:
+                    break
+            lines += data.count("\n", counted, line_start)
+            counted = line_start
+            ts = self._time_at(data, line_start)
+            if ts is None:
+                ts = self._times[-1] if self._times else 0
+            self._offsets.append(base + line_start)
+            self._line_nos.append(lines + 1)
+            self._times.append(ts)
+            self._next = base + line_start + INDEX_BYTES
+        self._lines += data.count("\n")
+        self._offset = base + size
+
+    def _time_at(self, data, pos):
+        for _ in xrange(TIME_LINES):
+            end = data.find("\n", pos)
+            if end < 0:
+                end = len(data)
+            ts = self._parser.parse(data[pos:end])
+            if ts is not None or end >= len(data):
+                return ts
+            pos = end + 1
+        return None
+
+    def _block(self, index):
+        """
+        读取第index个索引项到下一个索引项之间的数据
+        """
+        start = self._offsets[index]
+        end = self._offsets[index + 1] if index + 1 < len(self._offsets) else self._offset
+        with open(self._log_path, "rb") as f:
+            f.seek(start)
+            return start, f.read(end - start)
+
+    def locate_line(self, line_no):
+        """
+        找到line_no这一行的开头在文件中的偏移
+        :return:  (偏移, 行号)，超出了已经建立索引的范围的话返回已经建立索引的位置
+        """
+        if line_no > self._lines or not self._offsets:
+            return self._offset, self._lines + 1
+        index = max(0, bisect_right(self._line_nos, line_no) - 1)
+        start, data = self._block(index)
+        pos, current = 0, self._line_nos[index]
+        while current < line_no:
+            pos = data.find("\n", pos) + 1
+            if pos <= 0:
+                break
+            current += 1
+        return start + pos, current
+
+    def count_lines(self, end):
+        """
+        计算文件中end之前的行数，已经建立了索引的部分通过索引计算，后面还没有建立索引的那一小段直接读取
+        """
+        if end < self._offset:
+            return self.line_at(end) - 1
+        count = 0
+        with open(self._log_path, "rb") as f:
+            f.seek(self._offset)
+            remain = end - self._offset
+            while remain > 0:
+                data = f.read(min(READ_SIZE, remain))
+                if not data:
+                    break
+                count += data.count("\n")
+                remain -= len(data)
+        return self._lines + count
+
+    def line_at(self, offset):
+        """
+        计算offset所在的那一行的行号
+        """
+        if offset >= self._offset or not self._offsets:
+            return self._lines + 1
+        index = max(0, bisect_right(self._offsets, offset) - 1)
+        start, data = self._block(index)
+        return self._line_nos[index] + data.count("\n", 0, offset - start)
+
+    def locate_time(self, ts):
+        """
+        找到第一个时间不早于ts的行，解析不出时间的行会被跳过
+
+        先通过索引找到ts所在的两个索引项之间的那一段，然后在这一段里面二分查找，
+        ts比最后一个索引项还要晚的话，最后的那一段包括了还没有建立索引的数据
+        :return:  (偏移, 行号)，所有的行都比ts早的话返回文件的末尾，超出了已经建立索引的范围的话行号为None
+        """
+        lo, hi = 0, None
+        if self._offsets:
+            index = max(0, bisect_left(self._times, ts) - 1)        # 最后一个比ts早的索引项
+            lo = self._offsets[index]
+            if index + 1 < len(self._offsets):
+                hi = self._offsets[index + 1]
+        offset = search_time(self._log_path, self._parser, ts, lo, hi)
+        if offset < self._offset:
+            return offset, self.line_at(offset)
+        return offset, self._lines + 1 if offset == self._offset else None
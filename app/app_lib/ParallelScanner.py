@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+from app_lib.GrepEngine import FileScanner, RangeScanner, StreamScanner, is_compressed
+from app_lib.IoLimit import share, lower_priority
+from gevent.select import select
+import multiprocessing
+import resource
+import cPickle
+import struct
+import signal
+import errno
+import mmap
+import os
+
+
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024    # 文件小于这个大小的话，直接在当前进程里面查找就好了
+MIN_RANGE_SIZE = 16 * 1024 * 1024       # 每一段数据最小的大小，太小的话fork的开销就不划算了
+RANGES_PER_WORKER = 4                   # 每一个子进程平均分到这么多段数据，段数多一些，各个子进程的负载会更均衡
+READ_SIZE = 256 * 1024                  # 每次从子进程的管道中读取的数据大小
+HEADER = struct.Struct("!I")            # 子进程发送的每一个数据包的长度头
+CHUNK_CPU_SECONDS = 5                   # 子进程查找每一块数据最多使用这么多秒的cpu，超过了说明正则在疯狂的回溯，直接被内核杀掉
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def split_ranges(log_path, start, end, count):
+    """
+    将文件中 [start, end) 这一段数据切分成count段，每一段的边界都在一行的开头
+    :return:  [(起始偏移, 结束偏移), ...]
+    """
+    step = max(MIN_RANGE_SIZE, (end - start) / count + 1)
+    bounds = [start]
+    with open(log_path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ)
+        try:
+            offset = start + step
+            while offset < end:
+                index = mm.find("\n", offset - 1, end)
+                if index < 0 or index + 1 >= end:
+                    break
+                bounds.append(index + 1)
+                offset = index + 1 + step
+        finally:
+            mm.close()
+    bounds.append(end)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _write_message(fd, message):
+    data = cPickle.dumps(message, 2)
+    data = HEADER.pack(len(data)) + data
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _no_core():
+    """
+    在子进程中调用，SIGXCPU默认的处理是杀掉进程并且生成core文件，每一个被杀掉的正则都会在node的工作目录下面
+    留下一个fork出来的进程的core文件，所以先关掉core文件
+    """
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+
+def _cpu_budget(seconds):
+    """
+    从现在开始，当前进程最多再使用这么多秒的cpu，超过了之后内核会发送SIGXCPU把进程杀掉，
+    正则是在C里面执行的，没法通过信号或者超时打断，只能这样子限制，调用之前需要先调用_no_core
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    soft = int(usage.ru_utime + usage.ru_stime) + 1 + seconds
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _run_child(fd, scanner, limit):
+    """
+    在子进程中执行，查找一段数据，然后通过管道把结果发送给父进程，每一块数据最多使用CHUNK_CPU_SECONDS秒的cpu
+
+    发送的数据包：("b", 一批匹配的行) 以及最后的 ("e", (这一段数据的行数, 扫描过的字节数))
+    """
+    _no_core()
+    count = 0
+    batches = scanner.batches()
+    while True:
+        _cpu_budget(CHUNK_CPU_SECONDS)
+        batch = next(batches, None)
+        if batch is None:
+            break
+        if batch:
+            _write_message(fd, ("b", batch))
+            count += len(batch)
+            if limit and count >= limit:
+                break
+    _write_message(fd, ("e", (scanner.lines, scanner.scanned)))
+
+
+class _Range(object):
+    """
+    记录一段数据的查找状态
+    """
+    def __init__(self, start, end, source=None):
+        object.__init__(self)
+        self.start = start
+        self.end = end
+        self.source = source       # 查找多个文件的时候，这一段对应的文件，参考HistoryScanner
+        self.pid = None
+        self.fd = None
+        self.buf = ""
+        self.batches = []          # 已经收到，但是因为前面的数据还没有返回，所以暂时还不能返回出去的数据
+        self.lines = None          # 这一段数据的行数，收到了结束的数据包之后才会有
+        self.scanned = 0           # 这一段数据扫描过的字节数
+        self.failed = False
+        self.status = 0            # 子进程的退出状态
+
+
+class ParallelScanner(object):
+    """
+    用于对很大的文件进行查找，将文件切分成多段按行对齐的数据，然后fork出多个子进程并行的查找，
+    子进程的数量与机器的核数一致，每一个子进程完成一段之后再启动一个新的子进程查找下一段
+
+    虽然各段是并行查找的，不过结果还是按照文件中的顺序返回的，前面的段还没有完成的时候，后面的段的结果先保存起来，
+    而且后面的段的行号要加上前面所有段的行数，所以第一段的结果是可以直接返回的
+
+    接口与FileScanner一致，batches返回的生成器在等待子进程的数据的时候会让出协程，
+    生成器被关闭或者出现异常（例如超时）的时候，还在运行的子进程会被直接杀掉
+    """
+    def __init__(self, log_path, pattern, start=0, end=None, workers=None, limit=None):
+        """
+        :param log_path:  需要查找的文件
+        :param pattern:   Pattern对象
+        :param start:     开始查找的偏移
+        :param end:       结束查找的偏移，None表示查找到文件的末尾
+        :param workers:   最多同时运行的子进程的数量，默认与cpu的核数一致
+        :param limit:     每一个子进程最多返回这么多行，超过之后子进程就停止了
+        """
+        object.__init__(self)
+        self._log_path = log_path
+        self._pattern = pattern
+        self._start = start
+        self._end = end
+        self._workers = workers or cpu_count()
+        self._limit = limit
+        self._lines = 0                     # 已经按顺序完成的段的总行数
+        self._position = start              # 已经按顺序完成的段的结束位置
+        self._scanned = 0                   # 已经完成的段的总字节数
+
+    @property
+    def lines(self):
+        return self._lines
+
+    @property
+    def position(self):
+        return self._position
+
+    @property
+    def scanned(self):
+        return self._scanned
+
+    def _fork(self, item):
+        """
+        为一段数据fork一个子进程，子进程执行完之后直接退出，不做任何的清理，
+        同时运行的子进程平分读取的预算，另外配置了的话，子进程的cpu和io优先级会被降低
+        """
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                os.close(r)
+                share(self._workers)
+                lower_priority()
+                _run_child(w, self._create_scanner(item), self._limit)
+            except:
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(w)
+        item.pid, item.fd = pid, r
+
+    def _read(self, item):
+        """
+        从子进程的管道中读取数据，解析出完整的数据包
+        :return:  管道是否已经关闭了
+        """
+        try:
+            data = os.read(item.fd, READ_SIZE)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return False
+            data = ""
+        if not data:
+            if item.lines is None:
+                item.failed = True                      # 子进程没有发送结束的数据包就退出了
+            return True
+        item.buf += data
+        while len(item.buf) >= HEADER.size:
+            length = HEADER.unpack_from(item.buf)[0]
+            if len(item.buf) < HEADER.size + length:
+                break
+            kind, value = cPickle.loads(item.buf[HEADER.size:HEADER.size + length])
+            item.buf = item.buf[HEADER.size + length:]
+            if kind == "b":
+                item.batches.append(value)
+            else:
+                item.lines, item.scanned = value
+        return False
+
+    def _finish(self, item, kill=False):
+        if item.fd is not None:
+            os.close(item.fd)
+            item.fd = None
+        if item.pid is not None:
+            if kill:
+                try:
+                    os.kill(item.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            try:
+                item.status = os.waitpid(item.pid, 0)[1]
+            except OSError:
+                pass
+            item.pid = None
+
+    def _split(self):
+        """
+        :return:  需要查找的所有的段，_Range的列表
+        """
+        with open(self._log_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+        end = size if self._end is None else min(self._end, size)
+        if self._start >= end:
+            return []
+        return [_Range(s, e) for s, e in split_ranges(self._log_path, self._start, end,
+                                                      self._workers * RANGES_PER_WORKER)]
+
+    def _create_scanner(self, item):
+        """
+        在子进程中调用，创建用于查找一段数据的scanner
+        """
+        return FileScanner(self._log_path, self._pattern, item.start, item.end)
+
+    def _records(self, item, batch):
+        """
+        把子进程返回的一批结果转换为最终的结果，后面的段的行号要加上前面所有段的行数
+        """
+        base = self._lines
+        return [(record[0], record[1] + base) + record[2:] for record in batch]
+
+    def batches(self):
+        """
+        生成器，按照文件中的顺序返回匹配的行，每一项的格式与FileScanner一致
+        """
+        ranges = self._split()
+        pending = list(ranges)
+        running = dict()                                # 管道的文件描述符与段的关联
+        index = 0                                       # 下一个需要按顺序返回结果的段
+        try:
+            while index < len(ranges):
+                while pending and len(running) < self._workers:
+                    item = pending.pop(0)
+                    self._fork(item)
+                    running[item.fd] = item
+                readable, _, _ = select(running.keys(), [], [])
+                for fd in readable:
+                    item = running[fd]
+                    if self._read(item):
+                        del running[fd]
+                        self._finish(item)
+                        if item.failed and os.WIFSIGNALED(item.status) and os.WTERMSIG(item.status) == signal.SIGXCPU:
+                            raise IOError("regex too slow, used more than %d seconds of cpu on one block, "
+                                          "it may be backtracking" % CHUNK_CPU_SECONDS)
+                        if item.failed:
+                            raise IOError("grep child process failed, range:%s-%s" % (item.start, item.end))
+                        self._scanned += item.scanned
+                while index < len(ranges):
+                    item = ranges[index]
+                    for batch in item.batches:
+                        yield self._records(item, batch)
+                    item.batches = []
+                    if item.lines is None or item.pid is not None:
+                        break
+                    self._lines += item.lines
+                    self._position = item.end
+                    index += 1
+        finally:
+            for item in running.values():
+                self._finish(item, kill=True)
+
+
+class ChildScanner(ParallelScanner):
+    """
+    把另外一个scanner（例如RangeScanner，ReverseScanner）放到一个子进程里面执行，用于执行用户的正则的时候，
+    正则在回溯的话只会卡住子进程，超过了cpu的预算之后被杀掉，不会卡住当前进程里面的其他请求
+    """
+    def __init__(self, scanner, limit=None):
+        ParallelScanner.__init__(self, None, None, workers=1, limit=limit)
+        self._scanner = scanner
+        self._position = scanner.position
+
+    def _split(self):
+        return [_Range(self._scanner.position, None)]
+
+    def _create_scanner(self, item):
+        return self._scanner
+
+    def _records(self, item, batch):
+        return batch
+
+
+class HistoryScanner(ParallelScanner):
+    """
+    查找日志切割出来的多个文件（包括压缩过的）以及当前的日志，每一个文件交给一个子进程查找，最多同时运行cpu核数个子进程，
+    结果按照给定的文件的顺序（从老到新）返回，每一个匹配的行后面加上它所在的文件的名字：(偏移, 行号, 行, {"segment": 文件名})，
+    同时查找多个条件的时候附加信息里面还有tags
+
+    每一个文件的查找方式：
+    （1）压缩过的文件：有三元组索引而且整个文件都不可能匹配的话直接跳过，否则通过StreamScanner流式的解压查找，
+                     时间窗口在解压的时候过滤
+    （2）有三元组索引，而且查找的是整个文件：只查找索引过滤之后可能匹配的那几块
+    （3）其他的：通过FileScanner查找 [start, end) 这一段
+    """
+    def __init__(self, sources, pattern, workers=None, limit=None):
+        """
+        :param sources:  需要查找的文件，按照返回的顺序排列，每一项为 {"name": 文件名, "path": 路径, "start": 开始的偏移,
+                         "end": 结束的偏移, "index": 三元组索引, "parser": TimeParser, "since": 时间戳, "until": 时间戳}，
+                         start之后的都是可选的，parser/since/until只对压缩过的文件有用
+        """
+        ParallelScanner.__init__(self, None, pattern, workers=workers, limit=limit)
+        self._sources = sources
+
+    def _split(self):
+        return [_Range(source.get("start", 0), source.get("end"), source) for source in self._sources]
+
+    def _create_scanner(self, item):
+        source = item.source
+        index = source.get("index")
+        if is_compressed(source["path"]):
+            if index is not None and index.candidates(self._pattern.required) == []:
+                return RangeScanner(source["path"], self._pattern, [])     # 整个文件都不可能匹配，不需要解压
+            return StreamScanner(source["path"], self._pattern, source.get("parser"),
+                                 source.get("since"), source.get("until"))
+        if index is not None and not item.start and item.end is None and index.size == os.path.getsize(source["path"]):
+            ranges = index.candidates(self._pattern.required)
+            if ranges is not None:
+                return RangeScanner(source["path"], self._pattern, ranges)
+        return FileScanner(source["path"], self._pattern, item.start, item.end)
+
+    def _records(self, item, batch):
+        name = item.source["name"]
+        return [record[:3] + (dict(record[3] if len(record) > 3 else {}, segment=name),) for record in batch]
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+from array import array
+import tempfile
+import cPickle
+import struct
+
+
+MEMORY_BYTES = 4 * 1024 * 1024        # 内存中最多保存这么多字节的结果，超过之后写到临时文件里面
+MAX_BYTES = 256 * 1024 * 1024         # 一共最多保存这么多字节的结果，超过之后就不再接收了
+HEADER = struct.Struct("!I")
+
+
+def record_size(record):
+    """
+    一条结果的字节数，结果为 (偏移, 行号, 行) 或者 (偏移, 行号, 行, 附加信息)，附加信息里面有前后的行的话也要算上
+    """
+    if len(record) > 3:
+        extra = record[3]
+        return len(record[2]) + len(extra.get("before", "")) + len(extra.get("after", ""))
+    return len(record[2])
+
+
+class ResultBuffer(object):
+    """
+    用于保存grep出来的结果，每一条结果按照加入的顺序编号，远端通过编号（游标）来分页获取，
+    获取过的数据也不会删除，所以远端可以从任意的位置重新获取
+
+    最新的结果保存在内存中，超过了MEMORY_BYTES之后整批写到一个临时文件里面，只在内存中记录每一条结果在文件中的位置，
+    这样子即使结果非常多，内存的占用也是有上限的，总的数据量超过了MAX_BYTES之后就不再接收新的结果了
+    """
+    def __init__(self, memory_bytes=MEMORY_BYTES, max_bytes=MAX_BYTES):
+        object.__init__(self)
+        self._memory_bytes = memory_bytes
+        self._max_bytes = max_bytes
+        self._records = []                # 还在内存中的结果
+        self._records_start = 0           # 内存中的第一条结果的编号
+        self._memory = 0                  # 内存中的结果的字节数
+        self._bytes = 0                   # 一共保存的结果的字节数
+        self._file = None                 # 用于保存写出去的结果的临时文件
+        self._positions = array("L")      # 写到文件中的每一条结果在文件中的位置
+        self._file_size = 0
+        self._full = False
+
+    def __len__(self):
+        return self._records_start + len(self._records)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    @property
+    def full(self):
+        """
+        是否因为超过了MAX_BYTES而不再接收新的结果了
+        """
+        return self._full
+
+    def extend(self, records):
+        """
+        加入一批结果，每一条结果为 (偏移, 行号, 行)
+        :return:  是否全部都加入了，超过了上限的话返回False
+        """
+        for record in records:
+            size = record_size(record)
+            if self._bytes + size > self._max_bytes:
+                self._full = True
+                return False
+            self._records.append(record)
+            self._memory += size
+            self._bytes += size
+        if self._memory > self._memory_bytes:
+            self._spill()
+        return True
+
+    def _spill(self):
+        """
+        将内存中的结果全部写到临时文件里面
+        """
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix="grep_")
+        self._file.seek(self._file_size)
+        chunks = []
+        for record in self._records:
+            data = cPickle.dumps(record, 2)
+            self._positions.append(self._file_size)
+            self._file_size += HEADER.size + len(data)
+            chunks.append(HEADER.pack(len(data)))
+            chunks.append(data)
+        self._file.write("".join(chunks))
+        self._records_start += len(self._records)
+        self._records = []
+        self._memory = 0
+
+    def _read_spilled(self, cursor, max_lines, max_bytes, out):
+        """
+        从临时文件中读取游标开始的结果
+        :return:  读取的字节数
+        """
+        self._file.flush()
+        self._file.seek(self._positions[cursor])
+        size = 0
+        while cursor < self._records_start and len(out) < max_lines and (size < max_bytes or not out):
+            length = HEADER.unpack(self._file.read(HEADER.size))[0]
+            record = cPickle.loads(self._file.read(length))
+            out.append(record)
+            size += record_size(record)
+            cursor += 1
+        return size
+
+    def get_page(self, cursor, max_lines, max_bytes):
+        """
+        获取从游标开始的一页结果，最多max_lines条，max_bytes字节，不过只要有结果，至少会返回一条
+        :return:  (结果的列表, 下一页的游标)
+        """
+        cursor = max(0, cursor)
+        out = []
+        size = 0
+        if cursor < self._records_start:
+            size = self._read_spilled(cursor, max_lines, max_bytes, out)
+        index = cursor + len(out) - self._records_start
+        while index < len(self._records) and len(out) < max_lines and (size < max_bytes or not out):
+            record = self._records[index]
+            out.append(record)
+            size += record_size(record)
+            index += 1
+        return out, cursor + len(out)
+
+    def close(self):
+        """
+        释放临时文件
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._records = []
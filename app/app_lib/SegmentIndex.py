@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+from app_lib.IoLimit import io_wait, advise_sequential, drop_cache, lower_priority
+from app_lib.GrepEngine import open_stream, is_compressed
+from contextlib import closing
+from array import array
+import cPickle
+import struct
+import zlib
+import re
+import os
+
+
+BLOCK_SIZE = 1024 * 1024          # 每一块数据的大小，索引只能定位到块，查找的时候跳过不可能匹配的块
+MAGIC = "TRI1"
+HEADER = struct.Struct("!4sI")    # 魔数以及头部数据的长度
+TOKEN_RE = re.compile(r"\w{3,}")
+TRIGRAM_RE = re.compile(r"(?=(\w{3}))")            # 用于一次性的找出所有重叠的三元组
+
+# 只对单词里面的字符（[0-9a-z_]，统一转为小写）建立三元组的索引，一共37个字符，所以三元组可以直接编号，不会有冲突
+_CODES = dict((c, i) for i, c in enumerate("0123456789abcdefghijklmnopqrstuvwxyz_"))
+TRIGRAM_COUNT = len(_CODES) ** 3
+
+
+def trigrams(data):
+    """
+    计算一段数据里面所有单词内部的三元组的编号（不区分大小写）
+
+    先找出所有不重复的单词，然后把它们用空格连接起来再一次性的找出所有的三元组，
+    这样子大部分的工作都是在正则模块里面完成的，比在python里面逐个字符处理要快很多
+    """
+    tokens = set(TOKEN_RE.findall(data.lower()))
+    out = set()
+    for trigram in set(TRIGRAM_RE.findall(" ".join(tokens))):
+        out.add(_CODES[trigram[0]] * 1369 + _CODES[trigram[1]] * 37 + _CODES[trigram[2]])
+    return out
+
+
+def list_segments(log_path):
+    """
+    找出日志已经被切割出来的文件，也就是与日志在同一个目录下面，以日志的文件名加上 . 开头的文件，
+    例如 fjs.log.1  fjs.log.2016-04-15  fjs.log.3.gz，压缩过的文件也包括在里面
+    :return:  [(文件名, 路径)]，按修改时间从新到老排序
+    """
+    dir_name, base_name = os.path.split(os.path.abspath(log_path))
+    out = []
+    try:
+        names = os.listdir(dir_name)
+    except OSError:
+        return out
+    for name in names:
+        if not name.startswith(base_name + "."):
+            continue
+        path = os.path.join(dir_name, name)
+        if os.path.isfile(path):
+            out.append((os.path.getmtime(path), name, path))
+    out.sort(reverse=True)
+    return [(name, path) for _, name, path in out]
+
+
+def segment_key(path):
+    """
+    切割出来的文件还可能会被改名（.1 变成 .2），所以索引文件通过inode和大小来标识，而不是文件名
+    """
+    st = os.stat(path)
+    return "%d_%d" % (st.st_ino, st.st_size)
+
+
+def build_index(segment_path, index_path):
+    """
+    为一个切割出来的文件建立三元组的倒排索引，这个会占用比较多的cpu，一般在子进程中执行，参考build_index_in_child
+
+    压缩过的文件（.gz/.bz2）在流式解压的过程中建立索引，块的偏移是解压之后的数据里面的，
+    这种文件没法随机访问，索引主要用于整个文件都不可能匹配的时候直接跳过，不需要再解压一遍
+
+    索引文件的格式：
+    （1）头部：魔数，头部长度，以及pickle的 {"size": 文件（解压之后）的大小, "blocks": [(起始偏移, 结束偏移, 之前的行数)]}
+    （2）TRIGRAM_COUNT + 1 个偏移，第i个三元组的倒排表在 [偏移i, 偏移i+1) 之间
+    （3）所有的倒排表，每一个是按照块的编号差值编码之后zlib压缩的数组
+    先写到临时文件，完成之后再改名，所以不会读到写了一半的索引，读取的时候受IoLimit的预算限制，读过的数据从page cache里面丢掉
+    """
+    postings = dict()                   # 三元组的编号与包含它的块的编号的列表的关联
+    blocks = []
+    compressed = is_compressed(segment_path)
+    with closing(open_stream(segment_path)) as f:
+        fd = None if compressed else f.fileno()
+        if fd is not None:
+            advise_sequential(fd)
+        start, lines = 0, 0
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                break
+            data += f.readline()                            # 按行对齐
+            block_id = len(blocks)
+            blocks.append((start, start + len(data), lines))
+            for trigram in trigrams(data):
+                posting = postings.get(trigram)
+                if posting is None:
+                    postings[trigram] = posting = array("I")
+                posting.append(block_id)
+            if fd is not None:
+                drop_cache(fd, start, len(data))
+            io_wait(len(data))
+            start += len(data)
+            lines += data.count("\n")
+    size = start
+    table = array("I", [0] * (TRIGRAM_COUNT + 1))
+    body = []
+    position = 0
+    for trigram in xrange(TRIGRAM_COUNT):
+        table[trigram] = position
+        posting = postings.get(trigram)
+        if posting:
+            deltas = array("I", [posting[0]] + [posting[i] - posting[i - 1] for i in xrange(1, len(posting))])
+            data = zlib.compress(deltas.tostring())
+            body.append(data)
+            position += len(data)
+    table[TRIGRAM_COUNT] = position
+    header = cPickle.dumps(dict(size=size, blocks=blocks), 2)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(header)))
+        f.write(header)
+        f.write(table.tostring())
+        for data in body:
+            f.write(data)
+    os.rename(tmp_path, index_path)
+
+
+def build_index_in_child(segment_path, index_path):
+    """
+    fork一个子进程来建立索引，当前协程等待子进程退出，这样子建立索引的时候不会阻塞当前进程的其他请求
+    :return:  是否成功
+    """
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            lower_priority()
+            build_index(segment_path, index_path)
+        except:
+            code = 1
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    return status == 0
+
+
+class SegmentIndex(object):
+    """
+    一个切割出来的文件的三元组索引，只读取头部，倒排表在查找的时候才从文件中读取需要的那几个
+    """
+    def __init__(self, index_path):
+        object.__init__(self)
+        self._index_path = index_path
+        with open(index_path, "rb") as f:
+            magic, length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise IOError("bad trigram index file: %s" % index_path)
+            header = cPickle.loads(f.read(length))
+        self._size = header["size"]
+        self._blocks = header["blocks"]
+        self._table_offset = HEADER.size + length
+        self._body_offset = self._table_offset + (TRIGRAM_COUNT + 1) * 4
+
+    @property
+    def size(self):
+        return self._size
+
+    def _posting(self, f, trigram):
+        f.seek(self._table_offset + trigram * 4)
+        bounds = array("I")
+        bounds.fromstring(f.read(8))
+        start, end = bounds
+        if start == end:
+            return []
+        f.seek(self._body_offset + start)
+        deltas = array("I")
+        deltas.fromstring(zlib.decompress(f.read(end - start)))
+        out, block_id = [], 0
+        for delta in deltas:
+            block_id += delta
+            out.append(block_id)
+        return out
+
+    def candidates(self, literal):
+        """
+        找出可能包含literal的块
+        :param literal:  一定会出现在匹配的行里面的字符串，None表示不知道
+        :return:         [(起始偏移, 结束偏移, 之前的行数)]，相邻的块会被合并，没法通过索引过滤的话返回None
+        """
+        ids = trigrams(literal) if literal else None
+        if not ids:
+            return None
+        found = None
+        with open(self._index_path, "rb") as f:
+            for trigram in ids:
+                posting = self._posting(f, trigram)
+                found = set(posting) if found is None else found.intersection(posting)
+                if not found:
+                    return []
+        out = []
+        for block_id in sorted(found):
+            start, end, lines = self._blocks[block_id]
+            if out and out[-1][1] == start:
+                out[-1] = (out[-1][0], end, out[-1][2])
+            else:
+                out.append((start, end, lines))
+        return out
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+from app_lib.FileFollower import FileFollower, TAIL_LINES
+from lib.LetPool import run_task
+from bisect import bisect_right
+import gevent
+import logging
+import traceback
+
+
+RING_BYTES = 16 * 1024 * 1024     # 共享的环形缓冲区最多保留这么多字节的数据
+RING_SLACK = 64                   # 至少有这么多批数据需要移除的时候才真正做一次裁剪，避免每次追加都移动列表
+POLL_TIME = 0.2                   # 文件没有新数据的时候，等待这么长时间再去读取
+MAX_BYTES = 256 * 1024            # 默认一次最多返回这么多字节的数据
+
+
+class TailSource(object):
+    """
+    Node上面同一个日志文件的唯一读取源，所有查看这个日志的LogSender共享同一个TailSource
+
+    读取出来的数据按批放到一个共享的环形缓冲区里面，每一批数据都记录了它在数据流中的起止位置，
+    LogSender只需要记录一个位置，也就是它已经获取到了哪里，这样子查看的人再多，文件也只会读取一次，
+    每一行数据也只会保存一份
+
+    这里的位置就是FileFollower的position，在日志没有切割或者截断之前与文件的偏移是一致的，之后也会继续递增，
+    所以客户端断线重连之后可以带着原来的位置继续获取，如果需要的数据已经被移出了缓冲区，那么会明确的告诉客户端
+    跳过了多少字节，而不是悄悄的丢掉
+    """
+    def __init__(self, log_path):
+        object.__init__(self)
+        self._log_path = log_path
+        self._follower = FileFollower(log_path)
+        self._batches = []                # 环形缓冲区，每一项为 (起始位置, 结束位置, 行的列表)
+        self._starts = []                 # 每一批数据的起始位置，用于二分查找
+        self._trimmed = 0                 # 已经过期了但是还没有真正移除的批数
+        self._bytes = 0                   # 缓冲区中还有效的数据的字节数
+        self._begin = None                # 缓冲区中最老的数据的起始位置
+        self._end = None                  # 缓冲区中最新的数据的结束位置
+        self._subscribers = 0             # 当前订阅的LogSender的数量
+        self._listeners = []              # 有新数据的时候需要通知的监听函数
+        self._started = False
+        self._error = None                # 读取文件出错之后停止了的话，为出错的原因
+
+    @property
+    def log_path(self):
+        return self._log_path
+
+    @property
+    def subscribers(self):
+        return self._subscribers
+
+    @property
+    def started(self):
+        return self._started
+
+    @property
+    def error(self):
+        """
+        因为读取文件出错而停止了的话为出错的原因，订阅者需要通知远端，否则远端会一直等不到数据
+        """
+        return self._error
+
+    @property
+    def end(self):
+        """
+        当前最新数据的结束位置，还没有读取到任何数据的时候为None
+        """
+        return self._end
+
+    def add_subscriber(self):
+        """
+        增加一个订阅者，返回这个订阅者的初始位置，与tail -f一样，新的订阅者可以先看到最近的几行
+        """
+        self._subscribers += 1
+        return self.tail_offset(TAIL_LINES)
+
+    def remove_subscriber(self):
+        """
+        移除一个订阅者，返回剩下的订阅者的数量
+        """
+        self._subscribers -= 1
+        return self._subscribers
+
+    def add_listener(self, fn):
+        """
+        添加一个新数据的监听函数，每一次有新的数据放到缓冲区，或者当前TailSource停止的时候都会调用
+
+        注意：监听函数是在读取文件的协程里面直接调用的，不能阻塞
+        """
+        self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        if fn in self._listeners:
+            self._listeners.remove(fn)
+
+    def _notify(self):
+        for fn in list(self._listeners):
+            fn()
+
+    def tail_offset(self, lines):
+        """
+        计算缓冲区中最后lines行的起始位置，缓冲区为空的时候返回None，表示从第一批数据开始
+        """
+        index = len(self._batches) - 1
+        while index >= self._trimmed:
+            start, _, batch = self._batches[index]
+            if len(batch) >= lines:
+                return start + sum(len(line) for line in batch[:len(batch) - lines])
+            lines -= len(batch)
+            index -= 1
+        return self._begin
+
+    def read_since(self, since, max_bytes=MAX_BYTES):
+        """
+        获取某一个位置之后的数据，最多返回max_bytes字节，不过至少会返回一行
+
+        （1）since为None表示从缓冲区中最老的数据开始
+        （2）since比缓冲区中最老的数据还要老，那么从最老的数据开始，同时返回跳过的字节数
+        （3）since比最新的数据还要新，一般是客户端带着一个老的位置连接到一个新启动的TailSource，那么直接从最新的位置开始
+        :param since:      订阅者已经获取到的位置
+        :param max_bytes:  最多返回的字节数
+        :return:           (行的列表, 这些行的结束位置, 跳过的字节数)
+        """
+        if self._end is None:
+            return [], since, 0
+        gap = 0
+        if since is None:
+            since = self._begin
+        elif since < self._begin:
+            gap, since = self._begin - since, self._begin
+        elif since > self._end:
+            since = self._end
+        out = []
+        index = bisect_right(self._starts, since, lo=self._trimmed) - 1
+        size = 0
+        while since < self._end and size < max_bytes:
+            start, end, batch = self._batches[index]
+            index += 1
+            if start == since and end - start <= max_bytes - size:
+                out.extend(batch)                           # 整批数据都需要，直接放进去
+                size += end - start
+                since = end
+                continue
+            for line in batch:
+                if start >= since:
+                    if size >= max_bytes:
+                        break
+                    out.append(line)
+                    size += len(line)
+                start += len(line)
+            since = start
+        return out, since, gap
+
+    def _append(self, lines):
+        """
+        将新读取的行放到缓冲区，如果超过了上限，那么将最老的数据移除
+        """
+        end = self._follower.position
+        start = end - sum(len(line) for line in lines)
+        if self._end is None:
+            self._begin = start
+        self._batches.append((start, end, lines))
+        self._starts.append(start)
+        self._end = end
+        self._bytes += end - start
+        while self._bytes > RING_BYTES and self._trimmed < len(self._batches) - 1:
+            first_start, first_end, _ = self._batches[self._trimmed]
+            self._bytes -= first_end - first_start
+            self._trimmed += 1
+            self._begin = first_end
+        if self._trimmed > RING_SLACK:
+            del self._batches[:self._trimmed]
+            del self._starts[:self._trimmed]
+            self._trimmed = 0
+        self._notify()
+
+    def start(self):
+        """
+        在协程中不断的读取文件追加的数据，没有数据的时候等待一下再读
+        """
+        if self._started:
+            return
+        self._started = True
+        follower = self._follower
+
+        def _run():
+            while self._started:
+                try:
+                    lines = follower.read()
+                except Exception as e:
+                    logging.error("读取日志文件异常: %s", self._log_path)
+                    logging.error(traceback.format_exc())
+                    self._error = str(e) or e.__class__.__name__
+                    break
+                if lines:
+                    self._append(lines)
+                    gevent.sleep(0)                     # 读取文件并不会让出协程，这里主动让出一下
+                else:
+                    gevent.sleep(POLL_TIME)
+            self.stop()
+
+        run_task(_run)
+
+    def stop(self):
+        """
+        停止文件的跟踪，释放缓冲区
+        """
+        if self._started:
+            self._started = False
+            self._follower.close()
+            self._batches, self._starts = [], []
+            self._trimmed, self._bytes = 0, 0
+            self._begin, self._end = None, None
+            self._notify()
@@ -5,16 +5,22 @@ __author__ = 'fjs'
 
 from worker.EntityWorker import EntityWorker
 import tornado.web
-from geventwebsocket import WebSocketServer, WebSocketApplication, Resource
+from geventwebsocket import WebSocketApplication, Resource
 from collections import OrderedDict
 from lib.HttpConnector import HttpConnector
 import uuid
 from app_bean.WebSocketManager import WebSocketManager, WS_MANAGER
 from bean.BeanManager import get_manager
 from bean.Entity import get_gem
+from app_bean.TailHub import TailHub, FrameQueue, TAIL_HUB
 from app_entity.LogCenter import LOG_CENTER_NAME
+from app_lib.DeflateWebSocket import DeflateWebSocketServer
+from config import ServerConfig
 import json
-from lib.LetPool import run_task
+import sys
+import logging
+import traceback
+from gevent.lock import Semaphore
 import gevent
 
 
@@ -24,7 +30,10 @@ import gevent
 
 
 WS_PORT = 0               # 用于记录当前进程的websocket的监听端口
-DEFAULT_SLEEP_TIME = 0.2
+MAX_BYTES = 256 * 1024    # 每次从远端grep获取的最大字节数
+GREP_PAGE_LINES = 1000    # 每次从远端grep获取的最大行数
+GREP_WAIT = 2             # 远端grep还没有新的数据的时候，在远端等待这么多秒
+ALL_NODES = "*"           # grep的时候节点的名字为这个，表示在所有有这个日志的节点上查找
 
 
 class ShowLog(tornado.web.RequestHandler):
@@ -56,6 +65,16 @@ class GrepLog(tornado.web.RequestHandler):
         self.render("grep.html", **render_parms)
 
 
+class WsToken(tornado.web.RequestHandler):
+    """
+    websocket断线之后，页面需要重新连接，而原来的token已经用掉了，所以通过这里来重新分配一个token
+    """
+    def get(self, *args, **kwargs):
+        web_socekt_uuid = str(uuid.uuid4())
+        get_manager().get_bean(WS_MANAGER).add_token(web_socekt_uuid)
+        self.write(web_socekt_uuid)
+
+
 class AllNode(tornado.web.RequestHandler):
     """
     用于在web界面上显示当前所有的节点的信息
@@ -118,13 +137,15 @@ class LogWebSocket(WebSocketApplication):
         self._auth = False                 # 用于标记还没有通过token的验证
         self._node_name = None             # 监控的远程节点的名字
         self._log_name = None              # 需要监控的日志文件的名字
-        self._send_stub = None             # 具体需要监控的进程上的sender对象的stub
+        self._feed = None                  # 监控日志的时候，共享的上游数据流，参考TailHub
+        self._queue = None                 # 监控日志的时候，发送给web端的帧的队列，web端跟不上的时候会降级
+        self._offset = None                # 已经推送给web端的数据在日志数据流中的位置
+        self._compact = False              # 是否使用紧凑的二进制格式发送日志数据，参考TailHub里面的Frame
         self._closed = False               # 当前连接是否已经关闭了
 
-        self._last_sleep_time = DEFAULT_SLEEP_TIME        # 初始等待时间
-        self._last_get = False             # 用于标记上次获取远程log数据，是否获取到了数据
-
         self._stop = False                 # 客户端的是否以及功能暂停的标志
+        self._send_lock = Semaphore()      # 同时从多个节点grep的时候，保证每一条消息是完整的写到websocket上面的
+        self._grep_stubs = set()           # 正在获取数据的远端grep，连接断开的时候需要马上关闭它们
 
     def on_open(self):
         pass
@@ -149,12 +170,12 @@ class LogWebSocket(WebSocketApplication):
     def start(self):
         self._stop = False
 
-    def do_grep(self, content):
-        self.grep(content)
+    def do_grep(self, content, options=None):
+        self.grep(content, options)
 
     def register_grep(self, token, node_name, log_name):
         """
-        用于注册grep的连接
+        用于注册grep的连接，注册成功之后将日志切割出来的文件告诉web端，用于选择需要grep的文件
         """
         if not get_manager().get_bean(WS_MANAGER).consume(token):
             self.ws.close()
@@ -162,62 +183,148 @@ class LogWebSocket(WebSocketApplication):
         self._auth = True
         self._node_name = node_name
         self._log_name = log_name
+        if node_name == ALL_NODES:
+            return                                          # 每一个节点切割出来的文件都不一样，只能查找当前的日志或者所有历史
+        center_stub = get_gem().get_remote_entity(LOG_CENTER_NAME)
+        segments = center_stub.get_segments(node_name, log_name)
+        self._send(dict(method="segments", data=segments))
 
-        # self.grep("fjs")
-
-    def grep(self, content):
+    def grep(self, content, options=None):
         """
         对指定的日志进行grep的操作
         （1）向center进行请求，让其在相应的node上面创建logGrep，然后返回相关信息
         （2）这边创建对应entity的stub对象，然后调用相应的方法来获取grep出来的数据
+
+        节点的名字为 * 的话，在所有有这个日志的节点上同时查找，参考_cluster_grep
+
+        选项里面的segment为 * 的话，表示查找所有的历史，node会并行的查找所有切割出来的文件（包括压缩过的）以及当前的日志，
+        结果按时间从老到新返回，每一行后面带上它所在的文件名，web端通过它来区分不同的文件
+        :param content:  需要grep的内容
+        :param options:  web端带上来的查找选项，例如是否忽略大小写
         """
         if not self._auth:
             self.ws.close()
             return
+        options = options or {}
         center_stub = get_gem().get_remote_entity(LOG_CENTER_NAME)
-        remote_info = center_stub.get_remote_grep_info(self._node_name, self._log_name, content)
-        address, entity_id = remote_info
-        grep_stub = get_gem().create_remote_stub(entity_id, {"ip": address[0], "port": address[1]})
+        if self._node_name == ALL_NODES:
+            gevent.spawn(self._cluster_grep, content, options)
+            return
 
         def _run():
             """
             不断的从远端获取grep出来的数据
             """
             try:
-                while 1:
-                    data, is_over, is_time_out = grep_stub.get_data()
-                    if data:                                             # 将数据推送到web
-                        json_data = json.dumps(data)
-                        out_data = dict(method="messages", data=json_data)
-                        self.ws.send(json.dumps(out_data))
-                    if is_time_out:                                     # gerp子进程执行超时
-                        out_data = dict(method="time_out", data="")     # 通知web端，grep执行超时了
-                        self.ws.send(json.dumps(out_data))
-                        grep_stub.close()
-                        break
-                    elif is_over:                                        # grep正常退出
-                        out_data = dict(method="over", data="")     # 通知web端，grep执行超时了
-                        self.ws.send(json.dumps(out_data))
-                        grep_stub.close()
-                        break
-                    if not data:
-                        gevent.sleep(0.5)     # 防止调用太过频繁了，就直接睡眠0.5秒
+                remote_info = center_stub.get_remote_grep_info(self._node_name, self._log_name, content, options)
+                if isinstance(remote_info, dict):                       # 例如node上排队的查找太多了，或者正则不安全
+                    self._send(dict(method="stats", data=dict(error=remote_info.get("error") or "grep failed")))
+                    return
+                address, entity_id = remote_info
+                grep_stub = get_gem().create_remote_stub(entity_id, {"ip": address[0], "port": address[1]})
+                if self._drain_grep(grep_stub):
+                    self._send(dict(method="time_out", data=""))        # 通知web端，grep执行超时了
+                    return
+                self._send(dict(method="over", data=""))                # 通知web端，grep执行完了
             except:
-                pass
+                if not self._closed:
+                    self._send(dict(method="stats", data=dict(error=str(sys.exc_info()[1]) or "grep failed")))
 
         gevent.spawn(_run)
 
-    def register(self, token, node_name, log_name):
+    def _cluster_grep(self, content, options):
         """
-        websocket连接上来之后，先要表示直接要监听的节点的名字和日志的名字
-        这里通过center来到具体的log进程上去创建LogSender对象，然后这里来获取
+        通过center在所有有这个日志的节点上同时创建grep，然后每一个节点一个协程同时获取结果，
+        所以总的时间取决于最慢的那个节点，而不是所有节点的时间加起来
+
+        每一条消息都带上节点的名字，每一个节点查找完之后都会单独的通知web端它的统计以及是否超时，
+        全部的节点都结束之后再通知web端结束了
+        """
+        try:
+            center_stub = get_gem().get_remote_entity(LOG_CENTER_NAME)
+            infos = center_stub.get_cluster_grep_infos(self._log_name, content, options)
+            self._send(dict(method="nodes", data=infos))
+
+            def _run(info):
+                try:
+                    address = info["address"]
+                    grep_stub = get_gem().create_remote_stub(info["grep_id"], {"ip": address[0], "port": address[1]})
+                    self._drain_grep(grep_stub, info["node"])
+                except:
+                    logging.error("集群grep获取节点的数据异常: %s", info["node"])
+                    logging.error(traceback.format_exc())
+                    if not self._closed:
+                        self._send(dict(method="stats", data=dict(error=str(sys.exc_info()[1]) or "grep failed"),
+                                        node=info["node"]))
+
+            gevent.joinall([gevent.spawn(_run, info) for info in infos if "grep_id" in info])
+            self._send(dict(method="over", data=""))
+        except:
+            logging.error("集群grep异常")
+            logging.error(traceback.format_exc())
+            if not self._closed:                                        # 通知web端出错了，不然页面会一直等待
+                try:
+                    self._send(dict(method="stats", data=dict(error=str(sys.exc_info()[1]) or "grep failed")))
+                    self._send(dict(method="over", data=""))
+                except:
+                    logging.error("通知web端集群grep异常失败")
+
+    def _send(self, data):
+        with self._send_lock:
+            self.ws.send(json.dumps(data))
+
+    def _drain_grep(self, grep_stub, node_name=None):
+        """
+        通过游标不断的从远端分页获取grep出来的数据，直到远端查找完毕而且数据都已经获取完了，
+        远端还没有新数据的时候会在远端等待一会，所以这里不需要自己sleep，获取的速度只受限于远端查找的速度
 
-        一切都成功之后，需要启动一个任务来专门执行获取日志的操作，其实就是不断的调用sender_stub的get_data操作
+        最后把匹配的行数以及扫描过的字节数通知web端，只是统计的时候没有数据，只有统计的结果，
+        远端的查找还在排队的话，排队的位置变化的时候通知web端
+        :param node_name:  同时从多个节点grep的时候，发送给web端的消息都带上节点的名字
+        :return:  是否是超时了
+        """
+        cursor = 0
+        queued = 0
+        extra = dict(node=node_name) if node_name else {}
+        self._grep_stubs.add(grep_stub)
+        try:
+            while not self._closed:
+                page = grep_stub.get_page(cursor, GREP_PAGE_LINES, MAX_BYTES, GREP_WAIT)
+                cursor = page["cursor"]
+                if page.get("queued", 0) != queued:
+                    queued = page["queued"]
+                    self._send(dict(extra, method="queued", data=queued))
+                if page["data"]:                                     # 将数据推送到web
+                    self._send(dict(extra, method="messages", data=page["data"]))
+                if page["over"] and cursor >= page.get("results", page["matches"]):
+                    stats = dict(matches=page["matches"], scanned=page["scanned"], truncated=page["truncated"])
+                    if "histogram" in page:
+                        stats["histogram"], stats["untimed"] = page["histogram"], page["untimed"]
+                    if "tags" in page:
+                        stats["tags"] = page["tags"]                 # 同时查找多个条件的时候，每一个条件匹配的行数
+                    if page.get("error"):
+                        stats["error"] = page["error"]               # 例如正则回溯太多，查找被停止了
+                    if node_name:
+                        stats["time_out"] = page["time_out"]
+                    self._send(dict(extra, method="stats", data=stats))
+                    return page["time_out"]
+        finally:
+            if grep_stub in self._grep_stubs:
+                self._grep_stubs.discard(grep_stub)
+                grep_stub.close()
+
+    def register(self, token, node_name, log_name, offset=None, compact=False):
+        """
+        websocket连接上来之后，先要表示直接要监听的节点的名字和日志的名字
+        这里加入TailHub里面这个日志的数据流，还没有的话TailHub会通过center到具体的log进程上去创建LogSender对象，
+        所有在看同一个日志的websocket共享一个数据流，数据编码好之后通过send_frame发送过来
 
-        这里如果出现了异常，可能是远端创建entity的异常，也不好处理，就通知一下客户端
+        这里如果出现了异常，可能是远端创建entity的异常，也不好处理，就关闭连接让web端重连
         :param token:      用于进行连接授权的token，只有token服务器有记录才能连接上
         :param node_name:  监听的节点的名字
         :param log_name:   日志的名字
+        :param offset:     断线重连的时候，web端带上来的已经获取到的位置，用于从原来的地方继续
+        :param compact:    web端支持的话，日志数据通过紧凑的二进制格式发送
         """
         try:
             if not get_manager().get_bean(WS_MANAGER).consume(token):
@@ -226,58 +333,61 @@ class LogWebSocket(WebSocketApplication):
             self._auth = True
             self._node_name = node_name
             self._log_name = log_name
-            center_stub = get_gem().get_remote_entity(LOG_CENTER_NAME)
-            remote_info = center_stub.get_remote_info(self._node_name, self._log_name)
-            address, entity_id = remote_info
-            sender_stub = get_gem().create_remote_stub(entity_id, {"ip": address[0], "port": address[1]})
-            self._send_stub = sender_stub
-            self._start_get()
+            self._offset = offset
+            self._compact = compact
+            self._queue = FrameQueue(self._write_frame, self.close)
+            feed = get_manager().get_bean(TAIL_HUB).attach(node_name, log_name, self, offset)
+            if self._closed:
+                get_manager().get_bean(TAIL_HUB).detach(feed, self)     # 创建数据流的时候连接已经断开了
+                return
+            self._feed = feed
         except:
-            pass
+            self.close()
 
-    def _start_get(self):
+    def send_frame(self, frame):
         """
-        用于在协程中不断的从远端获取日志最新数据，然后通过websocket推送到web端
-        如果出现了异常，那么多半是远端的异常，这里也没啥可做的，通知一下客户端就好了把
+        TailFeed将一帧数据发送过来，这里只是放到发送队列里面，不会阻塞其他的viewer
         """
-        def _run():
-            try:
-                while not self._closed:
-                    log_data = self._send_stub.get_data()
-                    if log_data and not self._stop:      # 这里如果暂停了，那么就直接跳过数据
-                        # 重置标志为以及sleep等待时间
-                        self._last_get = True
-                        self._last_sleep_time = DEFAULT_SLEEP_TIME
-                        out = []
-                        for line in log_data:
-                            out.append(line)
-                        json_data = json.dumps(out)
-                        data = dict(method="messages", data=json_data)
-                        self.ws.send(json.dumps(data))
-                    else:
-                        if self._last_get:
-                            self._last_get = False
-                        else:
-                            self._last_sleep_time += 0.1      # 将sleep的时间延长一点
-                            if self._last_sleep_time > 1:
-                                self._last_sleep_time = 1
-                        gevent.sleep(self._last_sleep_time)
-            except:
-                pass
-            finally:
-                if not self._closed:     # 退出了while循环，多半除了问题，就关闭websocket连接吧
-                    self.ws.close()
+        if self._queue is not None:
+            self._queue.put(frame)
 
-        run_task(_run)
+    def _write_frame(self, frame):
+        """
+        发送队列里面的协程调用，按照web端支持的格式发送编码好的数据，暂停了的话直接跳过，
+        发送失败的话关闭当前连接，web端会重连
+        """
+        self._offset = frame.offset
+        if self._stop or self._closed:               # 这里如果暂停了，那么就直接跳过数据
+            return
+        try:
+            data = frame.binary if self._compact else None
+            if data is not None:
+                self.ws.send(data, binary=True)
+            else:
+                self.ws.send(frame.text)
+        except:
+            self.close()
+
+    def close(self):
+        if not self._closed:
+            self.ws.close()
 
     def on_close(self, reason):
         """
-        在websocket连接断开之后，这里需要通知远端的sender对象，及时的释放资源
+        在websocket连接断开之后，这里需要离开共享的数据流，最后一个离开的会释放远端的sender，及时的释放资源
         """
-        if self._send_stub:
-            self._send_stub.close()
-            self._send_stub = None
         self._closed = True
+        if self._queue is not None:
+            self._queue.close()
+        if self._feed is not None:
+            get_manager().get_bean(TAIL_HUB).detach(self._feed, self)
+            self._feed = None
+        for grep_stub in list(self._grep_stubs):     # 远端的查找会被马上停止，不用等到它自己超时
+            self._grep_stubs.discard(grep_stub)
+            try:
+                grep_stub.close()
+            except:
+                pass
 
 
 class LogViewWorker(EntityWorker):
@@ -299,15 +409,19 @@ class LogViewWorker(EntityWorker):
         WS_PORT = ws_port
 
     def init_entity(self):
-        self._ws_server = WebSocketServer(
+        self._ws_server = DeflateWebSocketServer(                   # 浏览器支持的话，tail和grep的数据都压缩之后发送
             ('', self._ws_port),
-            Resource(OrderedDict({"/": LogWebSocket}))
+            Resource(OrderedDict({"/": LogWebSocket})),
+            deflate_level=getattr(ServerConfig, "WS_DEFLATE_LEVEL", 3),
+            deflate_window_bits=getattr(ServerConfig, "WS_DEFLATE_WINDOW_BITS", 15),
+            deflate_min_bytes=getattr(ServerConfig, "WS_DEFLATE_MIN_BYTES", 256)
         )
         self._ws_server.start()
 
         self._http_server = HttpConnector(self._http_port)
         self._http_server.add_route("/showlog", ShowLog)
         self._http_server.add_route("/greplog", GrepLog)
+        self._http_server.add_route("/wstoken", WsToken)
         self._http_server.add_route("/nodes", AllNode)
         self._http_server.add_route("/nodemanage", NodeManage)
         self._http_server.add_route("/addnode", AddNode)
@@ -315,3 +429,4 @@ class LogViewWorker(EntityWorker):
         self._http_server.start()
 
         WebSocketManager()
+        TailHub()
@@ -3,6 +3,11 @@ __author__ = 'fjs'
 
 from worker.EntityWorker import EntityWorker
 from app_entity.Node import Node
+from app_bean.TailManager import TailManager
+from app_bean.IndexManager import IndexManager
+from app_bean.GrepCache import GrepCache
+from app_bean.GrepManager import GrepManager
+from app_lib.IoLimit import configure
 from config import NodeConfig
 
 
@@ -18,7 +23,15 @@ class NodeWorker(EntityWorker):
         node_name = node_info["name"]
 
         logs = node_info["logs"]
-        Node(node_name, logs)
+        configure(getattr(NodeConfig, "IO_BYTES_PER_SECOND", 0), getattr(NodeConfig, "IO_DROP_CACHE", False),
+                  getattr(NodeConfig, "IO_LOW_PRIORITY", False))
+        TailManager()
+        IndexManager(logs)
+        GrepCache()
+        GrepManager()
+        # 日志的配置可以是路径，也可以是带有时间格式的字典，Node只需要路径
+        log_paths = dict((name, info["path"] if isinstance(info, dict) else info) for name, info in logs.items())
+        Node(node_name, log_paths)
 
 
 
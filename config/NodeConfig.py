@@ -1,5 +1,11 @@
 __author__ = 'fjs'
+# -*- coding: utf-8 -*-
 
+#
+# logs里面每一个日志的配置可以直接是日志的路径，也可以是一个字典，用于指定日志里面时间的格式，按时间查找的时候需要用到：
+# "fjs": {"path": "/home/fjs/fjs.log", "time_regex": r"(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})", "time_format": "%Y-%m-%d %H:%M:%S"}
+# time_regex的所有分组用空格连接起来之后按照time_format来解析，默认就是上面这个格式
+#
 NODE = {
     "name": "fjs-node",
     "logs": {
@@ -7,3 +13,16 @@ NODE = {
     }
 }
 
+
+INDEX_DIR = "index"          # 日志切割出来的文件的三元组索引保存在这个目录下面
+GREP_CACHE_BYTES = 64 * 1024 * 1024     # 最近查找过的结果最多缓存这么多字节
+GREP_MAX_RUNNING = 2                    # 同时最多执行这么多个查找，其他的排队等待
+GREP_MAX_QUEUED = 16                    # 最多这么多个查找排队，再多的话直接拒绝
+GREP_TIMEOUT = 10                       # 在当前进程里面查找一个小文件最多执行这么多秒，排队的时间不算在里面
+GREP_PARALLEL_TIMEOUT = 120             # 很大的文件分成多段由子进程并行查找的时候，最多执行这么多秒
+GREP_HISTORY_TIMEOUT = 1800             # 查找所有切割出来的文件（包括解压压缩过的文件）的时候，最多执行这么多秒
+
+# 扫描文件（查找，建立索引）对机器上其他服务的影响，参考IoLimit
+IO_BYTES_PER_SECOND = 0                 # 所有的扫描每秒最多读取这么多字节，0表示不限制，例如 50 * 1024 * 1024
+IO_DROP_CACHE = True                    # 扫描过的大文件的数据从page cache里面丢掉，避免挤掉其他服务的缓存
+IO_LOW_PRIORITY = True                  # 用于扫描的子进程降低cpu和io的优先级
@@ -6,3 +6,18 @@ __author__ = 'fjs'
 MAIN_LOG_DEV = "./logs/main.log"
 
 HTTP_PORT = 7000
+
+# log_view进程的websocket的permessage-deflate压缩，参考DeflateWebSocket
+WS_DEFLATE_LEVEL = 3              # 压缩级别，None表示不压缩
+WS_DEFLATE_WINDOW_BITS = 15       # 压缩窗口的大小，9到15，越小每个连接占用的内存越少
+WS_DEFLATE_MIN_BYTES = 256        # 超过这么多字节的消息才压缩
+
+# 浏览器跟不上日志的速度的时候降级，参考TailHub里面的FrameQueue
+TAIL_SLOW_QUEUE_BYTES = 1024 * 1024       # 一个websocket排队的数据超过这么多字节就降级
+TAIL_SLOW_LATENCY = 1.0                   # 发送一帧超过这么多秒就降级
+TAIL_MAX_QUEUE_BYTES = 8 * 1024 * 1024    # 降级之后排队的数据还超过这么多字节的话断开连接
+TAIL_SAMPLE_RATE = 10                     # 采样模式下每这么多行只发送一行
+
+# 新打开的页面马上显示最近的行，参考TailHub
+TAIL_REPLAY_LINES = 100                   # 每一个日志保留最近的这么多行
+TAIL_REPLAY_KEEP = 45                     # 没有人看了之后，最近的行还保留这么多秒，不能超过node上面TailSource保留的时间（60秒）
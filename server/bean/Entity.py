@@ -6,6 +6,7 @@ import bean.BeanManager
 import lib.Service
 import worker.Worker
 import lib.ProcessManager
+import lib.FClient
 import gevent.greenlet
 import gevent.queue
 import lib.GreenletLocal
@@ -17,7 +18,7 @@ import errno
 from lib.LetPool import run_task
 from cPickle import loads as cp_loads
 from cPickle import dumps as cp_dumps
-from lib.GreenletLocal import set_greenlet_local, remove_greenlet_local
+from lib.GreenletLocal import set_greenlet_local, remove_greenlet_local, get_greenlet_local
 from bean.BeanManager import get_manager
 import time
 
@@ -334,6 +335,69 @@ class EntityStub(object):
         return _call
 
 
+class PushStub(object):
+    """
+    与EntityStub的方向相反，在rpc方法里面用于引用调用方进程上面的entity，
+    直接通过调用方建立的这条连接向它推送单向的消息，相当于反过来调用对方entity的rpc_message方法，
+    对方进程不需要开放监听，这边也不需要等待返回
+
+    注意：只能调用对方entity的rpc_message类型的方法，而且连接断开之后推送的数据会直接丢掉，
+         所以使用方需要通过add_close_listener来处理连接断开的情况
+    """
+    def __init__(self, entity_id, sock):
+        """
+        :param entity_id:  调用方进程上面的entity的id
+        :param sock:       调用方与当前进程建立的连接
+        :type sock: lib.FSocket.SelectFSocket
+        """
+        object.__init__(self)
+        self._entity_id = entity_id
+        self._sock = sock
+
+    @property
+    def closed(self):
+        """
+        与调用方的连接是否已经断开了
+        """
+        return self._sock.closed
+
+    def add_close_listener(self, fn):
+        """
+        添加连接断开的监听
+        """
+        self._sock.add_disconnect_listener(fn)
+
+    def remove_close_listener(self, fn):
+        """
+        移除连接断开的监听
+        """
+        self._sock.remove_disconnect_listener(fn)
+
+    def __getattr__(self, name):
+        def _call(*args, **kwargs):
+            """
+            将调用的方法和参数打包，用PUSH_RID标记之后直接写到连接上去，调用方的SharedFClient收到之后
+            会交给它的entity管理器来处理
+            """
+            if self._sock.closed:
+                raise Exception("push connection closed, id:%s" % self._entity_id)
+            self._sock.write(cp_dumps((lib.FClient.PUSH_RID, (self._entity_id, name, args, kwargs))))
+
+        return _call
+
+
+def create_push_stub(entity_id):
+    """
+    只能在同步rpc方法里面调用，用当前这次调用所在的连接创建调用方进程上面某一个entity的PushStub
+    :param entity_id:  调用方进程上面的entity的id
+    :rtype: PushStub
+    """
+    context = get_greenlet_local("context")
+    if context is None or context.sock is None:
+        raise Exception("can not create push stub out of rpc context")
+    return PushStub(entity_id, context.sock)
+
+
 # 如果一个rpc方法的执行出现了异常，那么将这个异常信息返还给rpc的调用客户端
 RPC_EXECUTE_EXCEPTION_DATA = cp_dumps(Exception("rpc execute error"))
 
@@ -365,6 +429,8 @@ class GlobalEntityManager(bean.BeanManager.Bean, Entity, lib.Service.Service):
         # 定时将rpc的监控数据推送到stat进程上面去
         self._rpc_push_timers = gevent.get_hub().loop.timer(RPC_INTERVAL, RPC_INTERVAL)
 
+        lib.FClient.set_push_handler(self.on_push)          # 别的进程通过PushStub推送过来的消息由当前对象来处理
+
         if self._tcp_con:
             tcp_con.set_con(self)
             if remote_address:                              # 只有在正常的集群环境先才有可能开启监控功能
@@ -459,6 +525,31 @@ class GlobalEntityManager(bean.BeanManager.Bean, Entity, lib.Service.Service):
             run_task(_call)                                     # 将任务放到协程池中异步运行，当前请求立即返回
             return cp_dumps((rid, None))                        # 对于异步的请求，直接返回空数据回去，让调用客户端无需等待
 
+    def on_push(self, data):
+        """
+        别的进程通过PushStub推送过来的单向消息，由当前进程作为客户端的SharedFClient收到之后交给这里来处理
+        数据是一个四元组：（entity的id，调用的方法，序列参数，默认参数）
+
+        注意：这里是在socket的读事件回调里面调用的，也就是在主loop上面运行，所以和rpc_message一样，
+             方法的执行需要派发到协程池里面去
+        """
+        entity_id, method_name, args, kwargs = data
+        entity = self.get_entity(entity_id)
+        method = getattr(entity, method_name, None) if entity is not None else None
+        if method is None or getattr(method, "r", None) != "m":
+            logging.error("push message can not be handled, id:%s, method:%s", entity_id, method_name)
+            return
+
+        def _call():
+            try:
+                method(*args, **kwargs)
+            except:
+                logging.error("push message execute error")
+                logging.error(traceback.format_exc())
+                sys.exc_clear()
+
+        run_task(_call)
+
     @property
     def config_stub(self):
         """
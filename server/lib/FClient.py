@@ -17,6 +17,19 @@ import gevent.monkey
 select = gevent.monkey.get_original("select", "select")    # 使用原生的select
 
 DEFAULT_REQUEST_TIMEOUT = 30                               # 默认客户端这边超时设置为30秒
+PUSH_RID = 0                                               # 请求的rid都是从1开始分配的，服务端主动推送的数据使用0来标记
+
+_push_handler = None                                       # 服务端主动推送过来的数据将会交给它来处理
+
+
+def set_push_handler(fn):
+    """
+    设置服务端主动推送过来的数据的处理函数，一般是进程的entity管理器
+
+    注意：处理函数是在socket的读事件回调里面调用的，也就是在主loop上面运行，不能阻塞
+    """
+    global _push_handler
+    _push_handler = fn
 
 
 def socket_closed(sock):
@@ -49,6 +62,13 @@ class FClient(object):
         """
         self._disconnect_listeners.append(fn)
 
+    def remove_disconnect_listener(self, fn):
+        """
+        用于移除断线监听器，连接已经关闭了的话就不用管了
+        """
+        if self._disconnect_listeners and fn in self._disconnect_listeners:
+            self._disconnect_listeners.remove(fn)
+
     @property
     def sock(self):
         return self._sock
@@ -357,6 +377,8 @@ class SharedFClient(FClient):
                 rid, message = cp_loads(response_data)
                 if rid in self._events:                                # 找到当前返回数据对应的event
                     self._events[rid].set(message)                     # 找到对应挂起的事件，然后设置，唤醒挂起的协程
+                elif rid == PUSH_RID and _push_handler is not None:    # 服务端主动推送过来的数据
+                    _push_handler(message)
             else:
                 break
 
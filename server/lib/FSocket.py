@@ -84,12 +84,26 @@ class FSocket(object):
         """
         self._need_late_close = True
 
+    @property
+    def closed(self):
+        """
+        当前连接是否已经关闭了
+        """
+        return self._closed
+
     def add_disconnect_listener(self, fn):
         """
         添加断线监听器
         """
         self._dic_connect_listener.add(fn)
 
+    def remove_disconnect_listener(self, fn):
+        """
+        移除断线监听器，如果连接已经关闭了，那么监听器都已经释放了，就不用管了
+        """
+        if self._dic_connect_listener:
+            self._dic_connect_listener.discard(fn)
+
     def process(self):
         """
         经过测试，这种比较的直接的处理方法在响应时间方面具有优势，而且吞吐量好像也差不多
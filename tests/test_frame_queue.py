@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+import os
+import sys
+import logging
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+from app_bean import TailHub as tail_hub
+from app_bean.TailHub import FrameQueue, Frame, MODE_FULL, MODE_SAMPLE, MODE_SUMMARY
+from gevent.event import Event
+import gevent
+
+LINES = ["%08d\n" % i for i in xrange(10)]       # 每一帧10行，每行9字节
+PATCHED = dict(SLOW_QUEUE_BYTES=150, SLOW_LATENCY=60, MAX_QUEUE_BYTES=100000, SAMPLE_RATE=10,
+               MODE_HOLD=0, RECOVER_SECONDS=0, SUMMARY_INTERVAL=0.02)
+
+
+class FrameQueueTest(unittest.TestCase):
+    """
+    浏览器跟不上的时候逐级降级：full -> sample -> summary，跟上了之后逐级恢复，排队的数据太多的话断开
+    """
+    def setUp(self):
+        self._saved = dict((name, getattr(tail_hub, name)) for name in PATCHED)
+        for name, value in PATCHED.items():
+            setattr(tail_hub, name, value)
+        self.sent = []
+        self.gate = Event()                       # 没有set的时候模拟一个卡住的浏览器
+        self.overflowed = False
+        self.queue = FrameQueue(self._send, self._overflow)
+
+    def tearDown(self):
+        self.queue.close()
+        for name, value in self._saved.items():
+            setattr(tail_hub, name, value)
+
+    def _send(self, frame):
+        self.gate.wait()
+        self.sent.append(frame)
+
+    def _overflow(self):
+        self.overflowed = True
+
+    def _put(self, count=1):
+        for _ in xrange(count):
+            self.queue.put(Frame("messages", LINES, 0))
+
+    def _modes(self):
+        return [frame.data["mode"] for frame in self.sent if frame.method == "mode"]
+
+    def test_degrade_and_recover(self):
+        self._put()
+        gevent.sleep(0)                           # 第一帧已经在发送了，卡住
+        self._put(2)
+        self.assertEqual(self.queue.mode, MODE_FULL)
+        self._put()                               # 排队的超过了150字节
+        self.assertEqual(self.queue.mode, MODE_SAMPLE)
+        self.assertEqual(self.queue.depth, (2, 9))  # 排队的行被丢掉了，只剩下mode帧以及采样之后的一行
+        self._put(17)
+        self.assertEqual(self.queue.mode, MODE_SUMMARY)
+        self._put(3)
+        self.assertEqual(self.queue.depth[1], 0)  # 统计模式下不再排队行
+
+        self.gate.set()                           # 浏览器跟上了
+        gevent.sleep(0.1)
+        for _ in xrange(3):
+            self._put()
+            gevent.sleep(0.01)
+        self.assertEqual(self.queue.mode, MODE_FULL)
+        self.assertEqual(self._modes(), [MODE_SAMPLE, MODE_SUMMARY, MODE_SAMPLE, MODE_FULL])
+        self.assertEqual(self.sent[1].data["dropped"], 20)
+        summaries = [frame.data for frame in self.sent if frame.method == "summary"]
+        self.assertEqual(sum(data["lines"] for data in summaries), 40)
+        self.assertEqual(summaries[-1]["last"][-1], LINES[-1])
+        self.assertFalse(self.overflowed)
+
+    def test_sample_keeps_every_nth_line(self):
+        self.queue._switch(MODE_SAMPLE, 0)
+        self.gate.set()
+        self._put(3)
+        gevent.sleep(0.01)
+        lines = [line for frame in self.sent if frame.method == "messages" for line in frame.data]
+        self.assertEqual(lines, [LINES[0]] * 3)
+
+    def test_overflow_closes(self):
+        tail_hub.SLOW_QUEUE_BYTES = 1 << 30
+        tail_hub.MAX_QUEUE_BYTES = 250
+        logging.disable(logging.ERROR)
+        try:
+            self._put(3)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertTrue(self.overflowed)
+        self._put()
+        self.assertEqual(self.queue.depth, (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
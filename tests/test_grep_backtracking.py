@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+from app_lib.GrepEngine import check_backtracking
+
+
+class BacktrackingTest(unittest.TestCase):
+    """
+    回溯是指数级的正则要在创建查找之前拒绝，常见的正则不能误判
+    """
+    def test_nested_quantifier(self):
+        for content in ["(a+)+b", "(\\w+\\s?)*$", "(.*)*x"]:
+            self.assertRaises(ValueError, check_backtracking, content)
+
+    def test_overlapping_alternation(self):
+        for content in ["(a|aa)+", "(a|a?)+", "(?:x|y|)+", "(\\d|\\w)+x"]:
+            self.assertRaises(ValueError, check_backtracking, content)
+
+    def test_safe_patterns(self):
+        for content in ["(foo|bar)+", "(ab|a)+", "(\\w+\\.|-)+", "(GET|POST) /api", "(\\d+\\.){3}\\d+",
+                        "(a(b|)c)+", "ERROR.*timeout"]:
+            check_backtracking(content)
+
+
+if __name__ == "__main__":
+    unittest.main()
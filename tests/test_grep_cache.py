@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+from app_bean.GrepCache import GrepCache
+
+KEY = ("ERROR", False, False)
+
+
+class GrepCacheTest(unittest.TestCase):
+    """
+    日志只是追加的话缓存一直有效，被切割、截断或者前面的数据被改写了之后缓存作废
+    """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".log")
+        os.close(fd)
+        self._write("a", "ok 0\nERROR 1\nok 2\nERROR 3\n")
+        self.cache = GrepCache(1024 * 1024)
+
+    def tearDown(self):
+        self.cache.release()
+        for path in (self.path, self.path + ".1"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _write(self, mode, data):
+        with open(self.path, mode) as f:
+            f.write(data)
+
+    def _put(self, lines=4):
+        size = os.path.getsize(self.path)
+        records = [(5, 2, "ERROR 1\n"), (18, 4, "ERROR 3\n")]
+        self.cache.put(self.path, KEY, os.stat(self.path).st_ino, size, lines, records)
+
+    def test_hit_and_append(self):
+        self._put()
+        entry = self.cache.get(self.path, KEY)
+        self.assertEqual(entry.end, 26)
+        self.assertEqual(len(entry.records), 2)
+        self._write("a", "ERROR 4\n")
+        self.assertIs(self.cache.get(self.path, KEY), entry)   # 只是追加，后面的部分由查找补上
+
+    def test_partial_last_line_not_cached(self):
+        self._write("a", "ERROR 4")
+        size = os.path.getsize(self.path)
+        records = [(5, 2, "ERROR 1\n"), (18, 4, "ERROR 3\n"), (26, 5, "ERROR 4")]
+        self.cache.put(self.path, KEY, os.stat(self.path).st_ino, size, 4, records)
+        entry = self.cache.get(self.path, KEY)
+        self.assertEqual(entry.end, 26)
+        self.assertEqual(len(entry.records), 2)
+
+    def test_shrink_invalidates(self):
+        self._put()
+        self._write("w", "ok 0\n")
+        self.assertIsNone(self.cache.get(self.path, KEY))
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.bytes, 0)
+
+    def test_changed_bytes_invalidate(self):
+        self._put()
+        self._write("w", "ok 0\nERROR 1\nok 2\nWARNS 3\nmore\n")     # 截断之后又写入了更多的数据
+        self.assertIsNone(self.cache.get(self.path, KEY))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_rotation_invalidates(self):
+        self._put()
+        os.rename(self.path, self.path + ".1")
+        self._write("w", "ok 0\nERROR 1\nok 2\nERROR 3\n")
+        self.assertIsNone(self.cache.get(self.path, KEY))
+        self._put()
+        self.assertEqual(len(self.cache), 1)                        # 切割之前的结果被删除了
+        self.assertIsNotNone(self.cache.get(self.path, KEY))
+
+    def test_unknown_lines_only_valid_for_same_size(self):
+        self._put(lines=None)
+        self.assertIsNotNone(self.cache.get(self.path, KEY))
+        self._write("a", "ok 4\n")
+        self.assertIsNone(self.cache.get(self.path, KEY))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+from app_lib.GrepEngine import encode_content, create_pattern, FileScanner
+
+
+class GrepEncodingTest(unittest.TestCase):
+    """
+    web端带上来的查找条件是unicode，日志里面有非ascii的行的时候也要能正常查找
+    """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".log")
+        with os.fdopen(fd, "w") as f:
+            f.write("2016-04-15 14:00:00 INFO 用户登录\n")
+            f.write("2016-04-15 14:00:01 ERROR 中文错误\n")
+            f.write("2016-04-15 14:00:02 ERROR plain\n")
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _grep(self, content, fixed=False):
+        pattern = create_pattern(encode_content(content), fixed=fixed)
+        scanner = FileScanner(self.path, pattern)
+        return [record[2] for batch in scanner.batches() for record in batch]
+
+    def test_literal(self):
+        self.assertEqual(len(self._grep(u"ERROR")), 2)
+
+    def test_regex(self):
+        self.assertEqual(len(self._grep(u"ERR.R")), 2)
+
+    def test_non_ascii(self):
+        self.assertEqual(self._grep(u"中文"), ["2016-04-15 14:00:01 ERROR 中文错误\n"])
+        self.assertEqual(self._grep(u"用户", fixed=True), ["2016-04-15 14:00:00 INFO 用户登录\n"])
+
+    def test_multiple(self):
+        self.assertEqual(len(self._grep([u"中文", u"plain"])), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+from app_bean.GrepManager import GrepManager
+from bean.BeanManager import get_manager
+import gevent
+
+
+class FakeGrep(object):
+    """
+    只实现GrepManager需要的接口
+    """
+    def __init__(self):
+        object.__init__(self)
+        self.over = False
+        self.stopped = False
+        self._subscribers = 0
+
+    @property
+    def subscribers(self):
+        return self._subscribers
+
+    def add_subscriber(self):
+        self._subscribers += 1
+
+    def remove_subscriber(self):
+        self._subscribers -= 1
+        return self._subscribers
+
+    def stop(self):
+        self.stopped = True
+        self.over = True
+
+
+class ManagerCase(unittest.TestCase):
+    """
+    同时最多执行一个查找，最多两个排队
+    """
+    def setUp(self):
+        self.manager = GrepManager(max_running=1, max_queued=2)
+        self.created = []
+        self.lets = []
+
+    def tearDown(self):
+        gevent.killall(self.lets)
+        get_manager().remove_bean(self.manager)                 # GrepManager的release是用来释放查找的
+
+    def _create(self):
+        grep = FakeGrep()
+        self.created.append(grep)
+        return grep
+
+    def _subscribe(self, content="ERROR", options=None):
+        return self.manager.subscribe("/tmp/a.log", content, options, self._create)
+
+
+class GrepManagerTest(ManagerCase):
+    """
+    同样条件的查找同时只执行一次，所有的订阅者共享它，最后一个订阅者离开之后才停止
+    """
+    def test_same_grep_is_shared(self):
+        first = self._subscribe(options={"ignore_case": True, "limit": 10})
+        second = self._subscribe(options={"limit": 10, "ignore_case": True})
+        self.assertIs(first, second)
+        self.assertEqual(len(self.created), 1)
+        self.assertEqual(first.subscribers, 2)
+
+    def test_different_conditions_are_not_shared(self):
+        first = self._subscribe()
+        second = self._subscribe(options={"ignore_case": True})
+        third = self._subscribe(content="WARN")
+        self.assertEqual(len(set(map(id, (first, second, third)))), 3)
+
+    def test_finished_grep_is_not_shared(self):
+        first = self._subscribe()
+        first.over = True
+        second = self._subscribe()
+        self.assertIsNot(first, second)
+
+    def test_last_unsubscribe_stops(self):
+        grep = self._subscribe()
+        self._subscribe()
+        self.manager.unsubscribe(grep)
+        self.assertFalse(grep.stopped)
+        self.manager.unsubscribe(grep)
+        self.assertTrue(grep.stopped)
+        self.assertIsNot(self._subscribe(), grep)
+
+
+class GrepQueueTest(ManagerCase):
+    """
+    超过同时执行的上限之后按顺序排队，排队的位置可以查询，排队的也太多了的话直接拒绝
+    """
+    def _admit(self, count):
+        greps = [FakeGrep() for _ in xrange(count)]
+        lets = [gevent.spawn(self.manager.admit, grep) for grep in greps]
+        self.lets.extend(lets)
+        gevent.sleep(0)
+        return greps, lets
+
+    def test_positions(self):
+        (first, second, third), lets = self._admit(3)
+        self.assertTrue(lets[0].ready())
+        self.assertEqual([self.manager.position(grep) for grep in (first, second, third)], [0, 1, 2])
+        self.manager.release(first)
+        gevent.sleep(0)
+        self.assertTrue(lets[1].ready())
+        self.assertFalse(lets[2].ready())
+        self.assertEqual([self.manager.position(grep) for grep in (second, third)], [0, 1])
+
+    def test_release_while_queued(self):
+        (first, second, third), lets = self._admit(3)
+        self.manager.release(second)                           # 还在排队的时候被停止了
+        self.assertEqual(self.manager.position(third), 1)
+        self.manager.release(first)
+        gevent.sleep(0)
+        self.assertTrue(lets[2].ready())
+        self.assertEqual(self.manager.position(third), 0)
+
+    def test_too_many_queued(self):
+        for content in ("a", "b", "c"):
+            self._subscribe(content)                            # 一个可以执行，两个排队
+        self.assertRaises(IOError, self._subscribe, "d")
+        self._subscribe("a")                                    # 共享已有的查找不需要排队
+        self.assertEqual(len(self.created), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
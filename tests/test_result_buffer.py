@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+from app_lib.ResultBuffer import ResultBuffer
+
+
+def _records(start, stop):
+    return [(i * 10, i + 1, "line %04d\n" % i) for i in xrange(start, stop)]
+
+
+class ResultBufferTest(unittest.TestCase):
+    """
+    结果超过内存的上限之后写到临时文件里面，通过游标获取的时候不管是在文件里面还是内存里面都是一样的
+    """
+    def setUp(self):
+        self.buffer = ResultBuffer(memory_bytes=100, max_bytes=1000)
+
+    def tearDown(self):
+        self.buffer.close()
+
+    def _read_all(self, cursor, max_lines, max_bytes=1 << 20):
+        out = []
+        while True:
+            page, cursor = self.buffer.get_page(cursor, max_lines, max_bytes)
+            if not page:
+                return out, cursor
+            out.extend(page)
+
+    def test_spill_keeps_order(self):
+        self.assertTrue(self.buffer.extend(_records(0, 30)))
+        self.assertTrue(self.buffer.extend(_records(30, 35)))
+        self.assertTrue(self.buffer._records_start > 0)         # 前面的结果已经写到文件里面了
+        self.assertEqual(len(self.buffer), 35)
+        out, cursor = self._read_all(0, 7)
+        self.assertEqual(out, _records(0, 35))
+        self.assertEqual(cursor, 35)
+
+    def test_page_across_spill_boundary(self):
+        self.buffer.extend(_records(0, 20))
+        self.buffer.extend(_records(20, 22))
+        start = self.buffer._records_start
+        page, cursor = self.buffer.get_page(start - 2, 4, 1 << 20)
+        self.assertEqual(page, _records(start - 2, start + 2))
+        self.assertEqual(cursor, start + 2)
+
+    def test_page_bytes_returns_at_least_one(self):
+        self.buffer.extend(_records(0, 3))
+        page, cursor = self.buffer.get_page(0, 10, 1)
+        self.assertEqual(page, _records(0, 1))
+        self.assertEqual(cursor, 1)
+
+    def test_cap_stops_accepting(self):
+        self.assertFalse(self.buffer.extend(_records(0, 200)))
+        self.assertTrue(self.buffer.full)
+        self.assertEqual(len(self.buffer), 100)                  # 每一行10字节，最多1000字节
+        self.assertEqual(self.buffer.bytes, 1000)
+        self.assertFalse(self.buffer.extend(_records(200, 201)))
+        out, _ = self._read_all(0, 50)
+        self.assertEqual(out, _records(0, 100))
+
+
+if __name__ == "__main__":
+    unittest.main()
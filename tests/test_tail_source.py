@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+__author__ = 'fjs'
+
+import os
+import sys
+import logging
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+from app_lib import TailSource as tail_source
+from app_lib.TailSource import TailSource
+import gevent
+
+
+class TailCase(unittest.TestCase):
+    """
+    日志文件里面先写入20行，TailSource与tail -f一样从最后10行开始
+    """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".log")
+        os.close(fd)
+        self._write(0, 20)
+        self.source = TailSource(self.path)
+        self._pump()
+
+    def tearDown(self):
+        self.source.stop()
+        os.remove(self.path)
+
+    def _write(self, start, stop):
+        with open(self.path, "a") as f:
+            for i in xrange(start, stop):
+                f.write("line %d\n" % i)
+
+    def _pump(self):
+        """
+        与读取文件的协程一样，读取文件新追加的数据放到缓冲区里面
+        """
+        lines = self.source._follower.read()
+        if lines:
+            self.source._append(lines)
+
+    def _read_all(self, since, max_bytes=1024):
+        out = []
+        while True:
+            lines, since, gap = self.source.read_since(since, max_bytes)
+            self.assertEqual(gap, 0)
+            if not lines:
+                return out, since
+            out.extend(lines)
+
+
+class TailSourceTest(TailCase):
+    """
+    所有的订阅者共享一个缓冲区，每一个订阅者只记录自己的位置，互相不影响
+    """
+    def test_new_subscriber_starts_from_last_lines(self):
+        offset = self.source.add_subscriber()
+        lines, end, gap = self.source.read_since(offset)
+        self.assertEqual(lines, ["line %d\n" % i for i in xrange(10, 20)])
+        self.assertEqual(end, os.path.getsize(self.path))
+        self.assertEqual(gap, 0)
+
+    def test_cursors_are_independent(self):
+        first = self.source.add_subscriber()
+        second = self.source.add_subscriber()
+        _, first = self._read_all(first)
+        self._write(20, 23)
+        self._pump()
+        lines, first = self._read_all(first)
+        self.assertEqual(lines, ["line 20\n", "line 21\n", "line 22\n"])
+        lines, second = self._read_all(second)
+        self.assertEqual(lines, ["line %d\n" % i for i in xrange(10, 23)])
+        self.assertEqual(first, second)
+        self.assertEqual(self.source.subscribers, 2)
+
+    def test_pages_resume_exactly(self):
+        self._write(20, 40)
+        self._pump()
+        lines, end = self._read_all(None, max_bytes=30)
+        self.assertEqual(lines, ["line %d\n" % i for i in xrange(10, 40)])
+        self.assertEqual(end, self.source.end)
+
+
+class TailGapTest(TailCase):
+    """
+    需要的数据已经被移出了缓冲区的话，明确的告诉订阅者跳过了多少字节，而不是悄悄的丢掉
+    """
+    def setUp(self):
+        self._ring_bytes = tail_source.RING_BYTES
+        tail_source.RING_BYTES = 100
+        TailCase.setUp(self)
+
+    def tearDown(self):
+        tail_source.RING_BYTES = self._ring_bytes
+        TailCase.tearDown(self)
+
+    def test_trimmed_data_reports_gap(self):
+        lines, end, _ = self.source.read_since(None)
+        begin = end - len("".join(lines))
+        for i in xrange(20, 40):
+            self._write(i, i + 1)
+            self._pump()
+        lines, end, gap = self.source.read_since(begin)
+        self.assertTrue(gap > 0)
+        self.assertEqual(lines[-1], "line 39\n")
+        self.assertEqual(begin + gap + len("".join(lines)), end)
+        self.assertEqual(self.source.read_since(end), ([], end, 0))
+
+    def test_position_newer_than_source(self):
+        end = self.source.end
+        self.assertEqual(self.source.read_since(end + 1000), ([], end, 0))
+
+    def test_read_error_stops_source(self):
+        class Broken(object):
+            def read(self):
+                raise IOError("disk gone")
+
+            def close(self):
+                pass
+        self.source._follower = Broken()
+        logging.disable(logging.ERROR)
+        try:
+            self.source.start()
+            gevent.sleep(0.01)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(self.source.error, "disk gone")
+        self.assertFalse(self.source.started)
+        self.assertEqual(self.source.end, None)
+
+
+if __name__ == "__main__":
+    unittest.main()